@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+import tempfile
+import timeit
+from datetime import date, timedelta
+
+from routetracker import analytics, create_app, db
+from routetracker.models import User, Route, Location, Discipline, Grade
+
+
+"""
+Measure the training load analytics of a user with N routes spread over ten
+years: loading the arrays, the NumPy computation, and a cached request.
+
+usage (with routetracker[analytics] installed): python benchmarks/analytics_bench.py [N]
+"""
+
+
+def _populate_db(n):
+    """
+    add one user with n routes, inserted with one set based statement
+    """
+    user = User(email="bench@url.com")
+    location = Location(name="Location")
+    disciplines = [Discipline(name=name) for name in ["Bouldering", "Lead", "Toprope"]]
+    grades = [Grade(name=name) for name in ["5", "5+", "6a", "6a+", "6b", "6b+", "6c", "7a", "7a+", "7b", "V3", "V5"]]
+    db.session.add_all([user, location] + disciplines + grades)
+    db.session.flush()
+    first = date.today() - timedelta(days=3650)
+    db.session.execute(Route.__table__.insert(), [
+        dict(
+            userId=user.id,
+            date=first + timedelta(days=random.randrange(3650)),
+            locationId=location.id,
+            disciplineId=random.choice(disciplines).id,
+            gradeId=random.choice(grades).id,
+            changeSeq=0
+            )
+        for i in range(n)
+        ])
+    db.session.commit()
+
+
+def main(routes=100000, number=10):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        _populate_db(routes)
+        arrays = analytics.load_route_arrays(1)
+        print("{} routes in {} rows".format(routes, len(arrays[0])))
+        duration = timeit.timeit(lambda: analytics.load_route_arrays(1), number=number) / number
+        print("load arrays    {:8.1f} ms".format(duration * 1e3))
+        duration = timeit.timeit(lambda: analytics.training_load(*arrays), number=number) / number
+        print("training load  {:8.1f} ms".format(duration * 1e3))
+
+    client = app.test_client()
+    client.get("/api/users/1/analytics/")
+    duration = timeit.timeit(lambda: client.get("/api/users/1/analytics/"), number=number) / number
+    print("cached request {:8.1f} ms".format(duration * 1e3))
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+import timeit
+from datetime import date
+
+from routetracker import create_app, db
+from routetracker.constants import *
+from routetracker.encoding import ENCODERS
+from routetracker.models import User, Route, Location, Discipline, Grade
+
+
+"""
+Compare the registered encoders against Mason JSON: payload size and the time
+it takes to encode and decode a route collection of N routes.
+
+usage (with routetracker installed): python benchmarks/encoding_bench.py [N]
+"""
+
+
+def _populate_db(n):
+    """
+    add one user with n routes
+    """
+    user = User(email="bench@url.com")
+    locations = [Location(name="Location {}".format(i)) for i in range(5)]
+    disciplines = [Discipline(name="Discipline {}".format(i)) for i in range(3)]
+    grades = [Grade(name="Grade {}".format(i)) for i in range(10)]
+    for i in range(n):
+        db.session.add(Route(
+                        user=user,
+                        date=date.today(),
+                        location=locations[i % 5],
+                        discipline=disciplines[i % 3],
+                        grade=grades[i % 10],
+                        extraInfo="this is route {}".format(i)
+                        ))
+    db.session.commit()
+    return user.id
+
+
+def main(n=1000, repeat=20):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        user = _populate_db(n)
+
+    client = app.test_client()
+    url = "/api/users/{}/routes/".format(user)
+    body = ENCODERS[MASON].loads(client.get(url).data)
+
+    print("{} routes, {} rounds".format(n, repeat))
+    print("{:35} {:>10} {:>12} {:>12}".format("mimetype", "bytes", "encode ms", "decode ms"))
+    for mimetype, encoder in ENCODERS.items():
+        data = encoder.dumps(body)
+        encode = timeit.timeit(lambda: encoder.dumps(body), number=repeat) / repeat
+        decode = timeit.timeit(lambda: encoder.loads(data), number=repeat) / repeat
+        print("{:35} {:>10} {:>12.3f} {:>12.3f}".format(mimetype, len(data), encode * 1000, decode * 1000))
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+import timeit
+from datetime import date
+
+from routetracker import create_app, db, metrics
+from routetracker.models import User, Route, Location, Discipline, Grade
+
+
+"""
+Measure the overhead of the request metrics: the latency of a route
+collection request with METRICS disabled and enabled, and the cost of the
+metric primitives themselves.
+
+usage (with routetracker installed): python benchmarks/metrics_bench.py [N]
+"""
+
+
+def _create_client(metrics_enabled, routes):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "METRICS": metrics_enabled
+        })
+    with app.app_context():
+        db.create_all()
+        user = User(email="bench@url.com")
+        location = Location(name="Location")
+        discipline = Discipline(name="Discipline")
+        grade = Grade(name="6A")
+        for i in range(routes):
+            db.session.add(Route(user=user, date=date.today(), location=location, discipline=discipline, grade=grade))
+        db.session.commit()
+    return app.test_client(), db_fd, db_fname
+
+
+def main(requests=500, routes=20):
+    print("{} requests of a {} route collection".format(requests, routes))
+    # the SQLAlchemy hooks are global, so the disabled case has to run first
+    for enabled in [False, True]:
+        client, db_fd, db_fname = _create_client(enabled, routes)
+        client.get("/api/users/1/routes/")
+        duration = timeit.timeit(lambda: client.get("/api/users/1/routes/"), number=requests) / requests
+        print("METRICS={:5} {:8.1f} us/request".format(str(enabled), duration * 1e6))
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    counter = metrics.MetricFamily("bench_total", "bench", "counter", ["resource"])
+    histogram = metrics.MetricFamily("bench_seconds", "bench", "histogram", ["resource"])
+    number = 100000
+    duration = timeit.timeit(lambda: counter.labels("RouteCollection.get").inc(), number=number) / number
+    print("counter inc       {:8.3f} us".format(duration * 1e6))
+    duration = timeit.timeit(lambda: histogram.labels("RouteCollection.get").observe(0.003), number=number) / number
+    print("histogram observe {:8.3f} us".format(duration * 1e6))
+    duration = timeit.timeit(metrics.render, number=100) / 100
+    print("render            {:8.1f} us".format(duration * 1e6))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -13,10 +13,15 @@ NOTE: THIS FILE IS DIRECT COPY FROM THE pwp-course example __init__.py file.
 # Modified to use Flask SQLAlchemy
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    # decode msgpack request bodies as well as JSON ones
+    from .encoding import MasonRequest
+    app.request_class = MasonRequest
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # days the deletes are kept for the change feeds
+        TOMBSTONE_RETENTION_DAYS=30
     )
 
     if test_config is None:
@@ -33,9 +38,35 @@ def create_app(test_config=None):
 
     from . import models
     from . import api
+    from . import compression
+    from . import jobs
+    from . import instrumentation
+    from . import profiling
+    from . import query_plans
+    from . import streams
+    from . import analytics
+    from . import leaderboards
+    from . import recent
+    from . import autocomplete
+    from . import archive
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.prune_tombstones_command)
     app.cli.add_command(models.generate_test_data)
+    app.cli.add_command(query_plans.check_query_plans_command)
     app.register_blueprint(api.api_bp)
+    jobs.init_app(app)
+    streams.init_app(app)
+    analytics.init_app(app)
+    leaderboards.init_app(app)
+    recent.init_app(app)
+    autocomplete.init_app(app)
+    archive.init_app(app)
+    # after_request hooks run in reverse order, instrumentation is registered
+    # first so that it sees the compressed responses
+    instrumentation.init_app(app)
+    profiling.init_app(app)
+    assets = compression.init_app(app)
+    assets.add_page("html/login.html")
 
     @app.route(LINK_RELATIONS_URL)
     def send_link_relations():
@@ -47,6 +78,6 @@ def create_app(test_config=None):
 
     @app.route("/login/")
     def login_site():
-        return app.send_static_file("html/login.html")
+        return assets.page_response("html/login.html")
 
     return app
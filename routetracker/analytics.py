@@ -0,0 +1,299 @@
+import re
+import threading
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import String, func, select, type_coerce
+from routetracker import db
+from routetracker.metrics import cache_hit, cache_miss
+from routetracker.models import Route, User, Discipline, Grade, Tombstone
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+"""
+Training load analytics of the routes of a user. The routes are loaded as
+compact arrays (day number, grade rank, discipline id) with one query, and
+everything else is computed with vectorized NumPy operations, so that even
+histories of 100k routes are analyzed in a few tens of milliseconds. The
+results are cached by user until the routes of the user change.
+
+Grades are ranked on the French/Fontainebleau scale, 1 for "1a" up to 54 for
+"9c+", and V grades are converted to their Fontainebleau equivalents. Routes
+with other grades count in the volume but not in the load or intensity.
+
+The load of a route is its grade rank, the acute load is the load of the
+last 7 days and the chronic load the weekly average over the last 28 days.
+
+NumPy is optional, the analytics are only available when it is installed.
+"""
+
+# days since 1970-01-01, which was a Thursday
+EPOCH_WEEKDAY = 3
+ACUTE_DAYS = 7
+CHRONIC_DAYS = 28
+
+FRENCH_GRADE = re.compile(r"^([1-9])([abc]?)(\+?)$", re.IGNORECASE)
+V_GRADE = re.compile(r"^v(b|\d{1,2})$", re.IGNORECASE)
+# Fontainebleau equivalents of the V grades
+V_TO_FONT = {
+    "b": "3", "0": "4", "1": "5", "2": "5+", "3": "6a", "4": "6b", "5": "6c", "6": "7a", "7": "7a+",
+    "8": "7b", "9": "7c", "10": "7c+", "11": "8a", "12": "8a+", "13": "8b", "14": "8b+", "15": "8c",
+    "16": "8c+", "17": "9a"
+}
+
+
+def available():
+    return np is not None
+
+
+def grade_rank(name):
+    """
+    Rank of a grade name on the French scale, or None for unknown grades.
+    Grades without a letter ("5", "5+") are ranked as the "a" of the number.
+    """
+    name = name.strip()
+    match = V_GRADE.match(name)
+    if match:
+        name = V_TO_FONT.get(match.group(1).lower())
+        if name is None:
+            return None
+    match = FRENCH_GRADE.match(name)
+    if not match:
+        return None
+    number, letter, plus = match.groups()
+    letter = "abc".index(letter.lower()) if letter else 0
+    return (int(number) - 1) * 6 + letter * 2 + len(plus) + 1
+
+
+def rank_name(rank):
+    """
+    French grade of a rank
+    """
+    number, rest = divmod(int(rank) - 1, 6)
+    letter, plus = divmod(rest, 2)
+    return "{}{}{}".format(number + 1, "abc"[letter], "+" * plus)
+
+
+def _lookup_names(model, ids):
+    """
+    Names of location, discipline or grade rows by id. The names never
+    change, so they are cached in the app and only the unknown ones are
+    queried.
+    """
+    cache = current_app.extensions.setdefault("routetracker_lookup_names", {})
+    names = cache.setdefault(model.__tablename__, {})
+    missing = [lookup_id for lookup_id in ids if lookup_id not in names]
+    if missing:
+        cache_miss("lookup_names")
+        names.update(db.session.query(model.id, model.name).filter(model.id.in_(missing)))
+    else:
+        cache_hit("lookup_names")
+    return names
+
+
+def load_route_arrays(user):
+    """
+    The routes of a user as arrays of day numbers, grade ranks (NaN for
+    unknown grades) and discipline ids (0 for none), with one query that
+    also checks that the user exists. Returns None if the user does not
+    exist.
+
+    The routes are grouped by day in SQL while the covering
+    ix_route_user_date index is read in order, and the grade and discipline
+    ids of each day come as comma separated lists. A few thousand short rows
+    are a lot cheaper to fetch than a row per route or per (day, grade,
+    discipline), and numpy parses the lists at once.
+    """
+    day = type_coerce(func.substr(Route.date, 1, 10), String)
+    # group_concat skips NULLs, which would shift the two lists out of step
+    grade_ids = func.group_concat(func.coalesce(Route.gradeId, 0))
+    discipline_ids = func.group_concat(func.coalesce(Route.disciplineId, 0))
+    rows = db.session.connection().execute(
+        select(day, func.count(Route.id), grade_ids, discipline_ids)
+        .select_from(User).outerjoin(Route, Route.userId == User.id).where(User.id == user)
+        .group_by(Route.date)
+        ).fetchall()
+    if not rows:
+        return None
+    if rows[0][0] is None:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, np.zeros(0), empty
+
+    # the dates are parsed by numpy, which is a lot faster than creating a
+    # date object for every row
+    dates, counts, grade_ids, discipline_ids = zip(*rows)
+    days = np.repeat(np.array(dates, dtype="datetime64[D]").astype(np.int64), counts)
+    grade_ids = np.fromstring(",".join(grade_ids), dtype=np.int64, sep=",")
+    discipline_ids = np.fromstring(",".join(discipline_ids), dtype=np.int64, sep=",")
+
+    # rank the few distinct grades and look the ranks up for every route
+    unique_grades, grade_index = np.unique(grade_ids, return_inverse=True)
+    names = _lookup_names(Grade, [grade_id for grade_id in unique_grades.tolist() if grade_id])
+    ranks = [grade_rank(names[grade_id]) if grade_id in names else None for grade_id in unique_grades.tolist()]
+    ranks = np.array([np.nan if rank is None else rank for rank in ranks], dtype=np.float64)
+    return days, ranks[grade_index], discipline_ids
+
+
+def _rolling_sum(values, window):
+    """
+    sums of the last window values at each position
+    """
+    total = np.concatenate(([0.0], np.cumsum(values)))
+    start = np.maximum(np.arange(1, len(total)) - window, 0)
+    return total[1:] - total[start]
+
+
+def training_load(days, ranks, disciplines, counts=None):
+    """
+    Weekly volume, load, intensity, highest grade and acute:chronic workload
+    ratio, and the progression of the highest grade by discipline, of routes
+    given as arrays. The weeks start on Mondays, from the week of the first
+    route to the week of the last one.
+    : param counts: number of routes of each entry, one by default
+    """
+    if len(days) == 0:
+        return {"weeks": [], "progression": {}}
+
+    start = days.min() - (days.min() + EPOCH_WEEKDAY) % 7
+    day = days - start
+    week = day // 7
+    n_weeks = int(week.max()) + 1
+
+    if counts is None:
+        counts = np.ones(len(days), dtype=np.int64)
+    rated = ~np.isnan(ranks)
+    load = np.where(rated, ranks, 0.0) * counts
+    volume = np.bincount(week, weights=counts, minlength=n_weeks)
+    rated_volume = np.bincount(week, weights=np.where(rated, counts, 0), minlength=n_weeks)
+    weekly_load = np.bincount(week, weights=load, minlength=n_weeks)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        intensity = weekly_load / rated_volume
+
+    # acute and chronic load at the end of each week
+    daily_load = np.bincount(day, weights=load, minlength=n_weeks * 7)
+    acute = _rolling_sum(daily_load, ACUTE_DAYS)[6::7]
+    chronic = _rolling_sum(daily_load, CHRONIC_DAYS)[6::7] / (CHRONIC_DAYS / ACUTE_DAYS)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        acwr = np.where(chronic > 0, acute / chronic, np.nan)
+
+    # highest grade of each week for each discipline, in one array of
+    # disciplines x weeks, carried forward to get the progression
+    codes, discipline_index = np.unique(disciplines, return_inverse=True)
+    highest = np.full((len(codes), n_weeks), -np.inf)
+    np.maximum.at(highest, (discipline_index[rated], week[rated]), ranks[rated])
+    weekly_max = highest.max(axis=0)
+    progression = np.maximum.accumulate(highest, axis=1)
+
+    week_starts = (np.arange(n_weeks) * 7 + start).astype("datetime64[D]").astype(str).tolist()
+    weeks = []
+    for i, week_start in enumerate(week_starts):
+        weeks.append({
+            "week": week_start,
+            "volume": int(volume[i]),
+            "load": float(weekly_load[i]),
+            "intensity": _number(intensity[i]),
+            "maxGrade": _grade(weekly_max[i]),
+            "acwr": _number(acwr[i])
+        })
+    return {
+        "weeks": weeks,
+        "progression": dict(
+            (int(code), [_grade(rank) for rank in curve])
+            for code, curve in zip(codes.tolist(), progression.tolist())
+            )
+    }
+
+
+def _number(value):
+    return None if np.isnan(value) else round(float(value), 3)
+
+
+def _grade(rank):
+    return None if np.isinf(rank) else rank_name(rank)
+
+
+def _change_token(user):
+    """
+    The latest change sequence values of the routes and route deletes of a
+    user, read from the ends of the (userId, changeSeq) indexes. Any write to
+    the routes of the user changes the token. Returns None if the user does
+    not exist.
+    """
+    latest_write = select(func.max(Route.changeSeq)).where(Route.userId == User.id).scalar_subquery()
+    latest_delete = select(func.max(Tombstone.changeSeq)).where(Tombstone.userId == User.id).scalar_subquery()
+    row = db.session.connection().execute(
+        select(User.id, latest_write, latest_delete).where(User.id == user)
+        ).first()
+    if row is None:
+        return None
+    return row[1], row[2]
+
+
+class ResultCache(object):
+    """
+    Least recently used results by user, each with the change token it was
+    computed at
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user, token):
+        with self._lock:
+            entry = self._results.get(user)
+            if entry is None or entry[0] != token:
+                return None
+            self._results.move_to_end(user)
+            return entry[1]
+
+    def put(self, user, token, result):
+        with self._lock:
+            self._results[user] = (token, result)
+            self._results.move_to_end(user)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+
+def user_training_load(user):
+    """
+    Training load analytics of a user, None if the user does not exist. The
+    progression curves are keyed by discipline name. Results are cached
+    until the routes of the user change, so that only the change token is
+    queried while they stay the same.
+    """
+    token = _change_token(user)
+    if token is None:
+        return None
+    cache = current_app.extensions["routetracker_analytics"]
+    result = cache.get(user, token)
+    if result is not None:
+        cache_hit("training_load")
+        return result
+    cache_miss("training_load")
+
+    arrays = load_route_arrays(user)
+    if arrays is None:
+        return None
+    result = training_load(*arrays)
+    names = _lookup_names(Discipline, [code for code in result["progression"] if code])
+    result["progression"] = [
+        {"discipline": names.get(code), "maxGrade": curve}
+        for code, curve in sorted(result["progression"].items())
+        ]
+    cache.put(user, token, result)
+    return result
+
+
+def init_app(app):
+    """
+    Create the result cache of the app
+    """
+    app.config.setdefault("ANALYTICS_CACHE_SIZE", 64)
+    cache = ResultCache(app.config["ANALYTICS_CACHE_SIZE"])
+    app.extensions["routetracker_analytics"] = cache
+    return cache
@@ -1,11 +1,25 @@
 from flask import Blueprint
 from flask_restful import Api
 
+from routetracker.instrumentation import timed_resource
+from routetracker.profiling import profiled_resource
+
 from routetracker.resources.user import UserCollection, UserItem
 from routetracker.resources.route import RouteCollection, RouteItem
 from routetracker.resources.location import LocationCollection, LocationItem
 from routetracker.resources.discipline import DisciplineCollection, DisciplineItem
 from routetracker.resources.grade import GradeCollection, GradeItem
+from routetracker.resources.job import JobItem
+from routetracker.resources.batch import Batch
+from routetracker.resources.change import ChangeFeed
+from routetracker.resources.stream import RouteStream
+from routetracker.resources.analytics import TrainingLoad
+from routetracker.resources.leaderboard import LeaderboardCollection, Leaderboard
+from routetracker.resources.autocomplete import NameSuggestions
+from routetracker.resources.activity import (
+    LocationRoutes, DisciplineRoutes, GradeRoutes, LocationActivity, DisciplineActivity, GradeActivity,
+    RecentRoutes, RouteSelection
+    )
 
 
 """
@@ -13,15 +27,31 @@ Adapted following the pwp-course-sensorhub-api-example api.py example
 """
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
-api = Api(api_bp)
+api = Api(api_bp, decorators=[profiled_resource, timed_resource])
 
 api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<user>/")
 api.add_resource(RouteCollection, "/users/<user>/routes/")
 api.add_resource(RouteItem, "/users/<user>/routes/<route>/")
+api.add_resource(ChangeFeed, "/users/<user>/changes/")
+api.add_resource(RouteStream, "/users/<user>/events/")
+api.add_resource(TrainingLoad, "/users/<user>/analytics/")
 api.add_resource(LocationCollection, "/users/<user>/routes/locations/")
 api.add_resource(LocationItem, "/users/<user>/routes/locations/<location>/")
 api.add_resource(DisciplineCollection, "/users/<user>/routes/disciplines/")
 api.add_resource(DisciplineItem, "/users/<user>/routes/disciplines/<discipline>/")
 api.add_resource(GradeCollection, "/users/<user>/routes/grades/")
 api.add_resource(GradeItem, "/users/<user>/routes/grades/<grade>/")
+api.add_resource(LocationRoutes, "/locations/<item>/routes/")
+api.add_resource(LocationActivity, "/locations/<item>/activity/")
+api.add_resource(DisciplineRoutes, "/disciplines/<item>/routes/")
+api.add_resource(DisciplineActivity, "/disciplines/<item>/activity/")
+api.add_resource(GradeRoutes, "/grades/<item>/routes/")
+api.add_resource(GradeActivity, "/grades/<item>/activity/")
+api.add_resource(RouteSelection, "/routes/")
+api.add_resource(RecentRoutes, "/routes/recent/")
+api.add_resource(NameSuggestions, "/autocomplete/<kind>/")
+api.add_resource(JobItem, "/jobs/<job>/")
+api.add_resource(Batch, "/batch/")
+api.add_resource(LeaderboardCollection, "/leaderboards/")
+api.add_resource(Leaderboard, "/leaderboards/<board>/<item>/")
@@ -0,0 +1,116 @@
+from collections import Counter
+from datetime import date
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+from routetracker import db
+from routetracker.events import routes_changed
+from routetracker.models import ArchivedRoute, Route, Tombstone, change_seq
+
+
+"""
+Archiving of old routes. Routes dated before a cutoff are moved from the
+route table to the route_archive table, so that the route table and its
+indexes only hold the routes that are read most. The archived routes keep
+their ids, and the route collection and items include them with
+?history=full.
+
+Everything derived from the route table (leaderboards, training load,
+recent routes, name suggestions) covers the routes that are not archived.
+Each archived chunk is stamped with a change sequence value and an
+"archive" tombstone per user, so that the leaderboard refresh and the
+analytics caches see the routes leave the table like any other write. The
+change feed does not report these tombstones, clients keep the archived
+routes they have.
+"""
+
+# routes moved per transaction
+ARCHIVE_CHUNK_SIZE = 1000
+
+
+def archive_cutoff(years, today=None):
+    """
+    The date years before today, routes before it are archived
+    """
+    today = today or date.today()
+    try:
+        return today.replace(year=today.year - years)
+    except ValueError:
+        # February 29th
+        return today.replace(year=today.year - years, day=28)
+
+
+def archive_routes(before, chunk_size=ARCHIVE_CHUNK_SIZE, progress=None):
+    """
+    Move the routes dated before a date to the archive in chunks, committing
+    after each so that other writers are not blocked for long. Returns the
+    number of archived routes.
+    : param callable progress: called with the number of routes archived so
+    far after each chunk
+    """
+    columns = [column.name for column in ArchivedRoute.__table__.columns]
+    # the newest route is never archived, so that a database created without
+    # AUTOINCREMENT does not give its id to a new route
+    newest = select(func.max(Route.id)).scalar_subquery()
+    archived = 0
+    while True:
+        # read in date order from the date index
+        rows = db.session.query(Route.id, Route.userId).filter(
+                    Route.date < before, Route.id < newest
+                    ).order_by(Route.date).limit(chunk_size).all()
+        if not rows:
+            break
+        ids = [route_id for route_id, user_id in rows]
+        users = Counter(user_id for route_id, user_id in rows)
+
+        seq = change_seq()
+        db.session.execute(
+            ArchivedRoute.__table__.insert().from_select(
+                columns,
+                select(*[Route.__table__.c[name] for name in columns]).where(Route.id.in_(ids))
+                )
+            )
+        # one tombstone per user stands for their archived routes
+        db.session.execute(
+            Tombstone.__table__.insert(),
+            [{"entity": "archive", "entityId": user_id, "userId": user_id, "changeSeq": seq} for user_id in users]
+            )
+        Route.query.filter(Route.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        for user_id in sorted(users):
+            routes_changed(user_id, {"op": "archive", "count": users[user_id], "seq": seq})
+
+        archived += len(ids)
+        if progress is not None:
+            progress(archived)
+    return archived
+
+
+@click.group("archive")
+def archive_command():
+    """
+    Archiving of old routes.
+    """
+
+
+@archive_command.command("routes")
+@click.option("--years", type=int, default=None, help="archive routes older than this many years")
+@click.option("--chunk-size", type=int, default=ARCHIVE_CHUNK_SIZE, help="routes moved per transaction")
+@with_appcontext
+def archive_routes_command(years, chunk_size):  # pragma: no cover
+    """
+    Move the old routes to the archive.
+    """
+    years = current_app.config["ARCHIVE_AFTER_YEARS"] if years is None else years
+    before = archive_cutoff(years)
+    archived = archive_routes(before, chunk_size, progress=lambda count: print("{} routes archived".format(count)))
+    print("{} routes dated before {} archived".format(archived, before.isoformat()))
+
+
+def init_app(app):
+    """
+    Register the CLI commands
+    """
+    app.config.setdefault("ARCHIVE_AFTER_YEARS", 2)
+    app.cli.add_command(archive_command)
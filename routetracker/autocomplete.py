@@ -0,0 +1,207 @@
+import heapq
+import threading
+import time
+from flask import current_app
+from sqlalchemy import func, select
+from routetracker import db
+from routetracker.events import on_routes_changed
+from routetracker.metrics import cache_hit, cache_miss
+from routetracker.models import Route, Location, Discipline, Grade
+
+
+"""
+Autocompletion of location, discipline and grade names, so that the route
+forms can suggest the existing names instead of creating near-duplicates.
+
+The names are kept in an in-memory prefix trie per kind. Every node of the
+trie keeps the most used names below it, so a lookup only walks the prefix.
+Names are ranked by the number of routes of all users. New routes are
+counted when they are written; updated and deleted routes make the tries
+stale, and they are read again on a lookup at most every
+AUTOCOMPLETE_MAX_AGE seconds.
+"""
+
+# kind in the URL -> (model, column of Route)
+KINDS = {
+    "locations": (Location, "locationId"),
+    "disciplines": (Discipline, "disciplineId"),
+    "grades": (Grade, "gradeId")
+}
+# suggestions kept in each node, the most a lookup can return
+MAX_SUGGESTIONS = 10
+
+
+class _Node(object):
+    __slots__ = ("children", "ids", "top")
+
+    def __init__(self):
+        self.children = {}
+        # ids of the names ending here
+        self.ids = set()
+        # (-routes, name, id) of the most used names below, best first
+        self.top = []
+
+
+class PrefixIndex(object):
+    """
+    Prefix trie of names ranked by usage. Names match case-insensitively.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._names = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def _path(self, name):
+        """
+        nodes from the root to the node of name, created as needed
+        """
+        node = self._root
+        path = [node]
+        for char in name.lower():
+            node = node.children.setdefault(char, _Node())
+            path.append(node)
+        return path
+
+    def _rank(self, node):
+        # the best names of a node are among its own names and the best names
+        # of its children. most nodes are on the single path of one name and
+        # share the list of their child.
+        if not node.ids and len(node.children) == 1:
+            node.top = next(iter(node.children.values())).top
+            return
+        candidates = [(-self._counts[entry_id], self._names[entry_id], entry_id) for entry_id in node.ids]
+        for child in node.children.values():
+            candidates.extend(child.top)
+        node.top = heapq.nsmallest(MAX_SUGGESTIONS, candidates)
+
+    def _rank_all(self, node):
+        for child in node.children.values():
+            self._rank_all(child)
+        self._rank(node)
+
+    def load(self, rows):
+        """
+        add (id, name, routes) rows, e.g. all names when building the index
+        """
+        with self._lock:
+            for entry_id, name, count in rows:
+                self._names[entry_id] = name
+                self._counts[entry_id] = count
+                self._path(name)[-1].ids.add(entry_id)
+            self._rank_all(self._root)
+
+    def add(self, entry_id, name, routes=1):
+        """
+        add a name or routes to an existing one
+        """
+        with self._lock:
+            self._names[entry_id] = name
+            self._counts[entry_id] = self._counts.get(entry_id, 0) + routes
+            path = self._path(name)
+            path[-1].ids.add(entry_id)
+            for node in reversed(path):
+                self._rank(node)
+
+    def lookup(self, prefix, limit=MAX_SUGGESTIONS):
+        """
+        the most used names starting with prefix as (id, name, routes)
+        """
+        with self._lock:
+            node = self._root
+            for char in prefix.lower():
+                node = node.children.get(char)
+                if node is None:
+                    return []
+            return [(entry_id, name, -count) for count, name, entry_id in node.top[:limit]]
+
+
+class Autocomplete(object):
+    """
+    The prefix indexes of all kinds of an app
+    : param int max_age: seconds a stale index is still used
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.indexes = None
+        self.built = None
+        self.stale = False
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        read all names and their numbers of routes, one query per kind
+        served by the (item, date) indexes of the routes
+        """
+        indexes = {}
+        for kind, (model, column) in KINDS.items():
+            counts = select(getattr(Route, column).label("item"), func.count().label("routes")).group_by(
+                        getattr(Route, column)
+                        ).subquery()
+            rows = db.session.execute(
+                        select(model.id, model.name, func.coalesce(counts.c.routes, 0))
+                        .outerjoin(counts, counts.c.item == model.id)
+                        ).all()
+            index = indexes[kind] = PrefixIndex()
+            index.load(rows)
+        with self._lock:
+            self.indexes = indexes
+            self.built = time.time()
+            self.stale = False
+
+    def index(self, kind):
+        """
+        the index of a kind, built again first if needed
+        """
+        if self.indexes is None or (self.stale and time.time() - self.built >= self.max_age):
+            cache_miss("autocomplete")
+            self.build()
+        else:
+            cache_hit("autocomplete")
+        return self.indexes[kind]
+
+    def invalidate(self):
+        with self._lock:
+            self.stale = True
+
+
+def suggest(kind, prefix, limit=MAX_SUGGESTIONS):
+    """
+    The most used names of a kind starting with prefix as (id, name, routes)
+    """
+    return current_app.extensions["routetracker_autocomplete"].index(kind).lookup(prefix, limit)
+
+
+@on_routes_changed
+def _count_changes(user, changes):
+    autocomplete = current_app.extensions.get("routetracker_autocomplete")
+    if autocomplete is None or autocomplete.indexes is None:
+        return
+    created = [change["route"] for change in changes if change.get("op") == "create" and "route" in change]
+    if len(created) < len(changes):
+        # the old names of updated and deleted routes are not known
+        autocomplete.invalidate()
+        return
+    rows = db.session.query(
+                Location.id, Location.name, Discipline.id, Discipline.name, Grade.id, Grade.name
+                ).select_from(Route).join(Route.location).join(Route.discipline).join(Route.grade).filter(
+                Route.id.in_(created)
+                ).all()
+    for row in rows:
+        for position, kind in enumerate(("locations", "disciplines", "grades")):
+            autocomplete.indexes[kind].add(row[2 * position], row[2 * position + 1])
+
+
+def init_app(app):
+    """
+    Create the autocompletion of the app, built on the first lookup
+    """
+    app.config.setdefault("AUTOCOMPLETE_MAX_AGE", 60)
+    autocomplete = Autocomplete(app.config["AUTOCOMPLETE_MAX_AGE"])
+    app.extensions["routetracker_autocomplete"] = autocomplete
+    return autocomplete
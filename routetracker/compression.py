@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from flask import Response, abort, current_app, request
+from routetracker.encoding import ENCODERS
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+"""
+Response compression. Dynamic API responses above a size threshold are
+compressed with brotli or gzip, depending on what the client accepts. Static
+files are served from memory under fingerprinted URLs with long-lived cache
+headers, each encoding compressed on its first request and kept.
+"""
+
+# static files with these extensions are worth compressing
+COMPRESSIBLE_EXTENSIONS = (".js", ".css", ".html", ".json", ".svg", ".txt")
+# fingerprinted assets never change, so they can be cached for a year
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def _encodings():
+    """
+    content encodings supported by the server, preferred first
+    """
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def compress(data, encoding, level):
+    """
+    Compress bytes with the given content encoding ("br" or "gzip").
+    : param int level: gzip compression level (1-9), also used as the
+    brotli quality
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_response(response):
+    """
+    after_request hook compressing Mason (and other API) responses that are
+    large enough for compression to pay off.
+    """
+    if not 200 <= response.status_code < 300 or response.direct_passthrough:
+        return response
+    if "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype not in ENCODERS and response.mimetype != "application/json":
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    # compression depends on the request headers, caches need to know that
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(_encodings())
+    if encoding is None:
+        return response
+
+    response.set_data(compress(data, encoding, current_app.config["COMPRESS_LEVEL"]))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class StaticAssets(object):
+    """
+    In-memory store of the static files of the app, named with a content
+    fingerprint. Only fingerprinting happens at startup, the compressed
+    variants are made when they are first requested.
+    """
+
+    def __init__(self, static_folder, level=9):
+        self.level = level
+        # fingerprinted name -> {encoding: bytes, or None if compressing
+        # does not save anything}
+        self.files = {}
+        # fingerprinted names of the files worth compressing
+        self.compressible = set()
+        self._lock = threading.Lock()
+        # original name -> fingerprinted name
+        self.names = {}
+        # original name -> fingerprinted name of the rewritten document
+        self.pages = {}
+        if static_folder is None or not os.path.isdir(static_folder):
+            return
+
+        for root, dirs, files in os.walk(static_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, static_folder).replace(os.sep, "/")
+                with open(path, "rb") as handle:
+                    self.add(filename, handle.read())
+
+    def add(self, filename, data):
+        """
+        Add a file to the store, returns its fingerprinted name.
+        """
+        fingerprint = hashlib.sha1(data).hexdigest()[:12]
+        base, ext = os.path.splitext(filename)
+        fingerprinted = "{}.{}{}".format(base, fingerprint, ext)
+
+        self.files[fingerprinted] = {"identity": data}
+        if ext in COMPRESSIBLE_EXTENSIONS:
+            self.compressible.add(fingerprinted)
+        self.names[filename] = fingerprinted
+        return fingerprinted
+
+    def variant(self, fingerprinted, encoding):
+        """
+        A stored file compressed with an encoding, compressed on first use.
+        Returns None if the file is not compressed or that does not make it
+        smaller.
+        """
+        variants = self.files[fingerprinted]
+        if encoding in variants:
+            return variants[encoding]
+        if fingerprinted not in self.compressible:
+            return None
+        with self._lock:
+            if encoding not in variants:
+                data = variants["identity"]
+                compressed = compress(data, encoding, self.level)
+                # keep only the variants that actually save something
+                variants[encoding] = compressed if len(compressed) < len(data) else None
+            return variants[encoding]
+
+    def url(self, filename):
+        """
+        Fingerprinted URL of a static file, or the plain static URL if the
+        file is not in the store.
+        """
+        if filename in self.names:
+            return "/assets/" + self.names[filename]
+        return "/static/" + filename
+
+    def rewrite(self, text):
+        """
+        Replace the plain static URLs in a document with fingerprinted ones.
+        """
+        for filename in sorted(self.names, key=len, reverse=True):
+            text = text.replace('"/static/{}"'.format(filename), '"{}"'.format(self.url(filename)))
+        return text
+
+    def add_page(self, filename):
+        """
+        Store a version of an HTML page that links to the fingerprinted
+        assets. The page itself is served without long caching, so that new
+        fingerprints are picked up right away.
+        """
+        data = self.files[self.names[filename]]["identity"].decode("utf-8")
+        base, ext = os.path.splitext(filename)
+        page = self.add(base + ".page" + ext, self.rewrite(data).encode("utf-8"))
+        self.pages[filename] = page
+        return page
+
+    def page_response(self, filename):
+        """
+        Serve a page stored with add_page
+        """
+        if filename not in self.pages:
+            abort(404)
+        return self.response(self.pages[filename], max_age=None)
+
+    def response(self, fingerprinted, max_age=ASSET_MAX_AGE):
+        """
+        Serve a stored file with the best encoding the client accepts.
+        """
+        if fingerprinted not in self.files:
+            abort(404)
+
+        data = self.files[fingerprinted]["identity"]
+        candidates = _encodings()
+        encoding = request.accept_encodings.best_match(candidates)
+        while encoding is not None:
+            compressed = self.variant(fingerprinted, encoding)
+            if compressed is not None:
+                data = compressed
+                break
+            candidates.remove(encoding)
+            encoding = request.accept_encodings.best_match(candidates)
+        mimetype = mimetypes.guess_type(fingerprinted)[0] or "application/octet-stream"
+        response = Response(data, 200, mimetype=mimetype)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        if max_age:
+            response.headers["Cache-Control"] = "public, max-age={}, immutable".format(max_age)
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+def init_app(app):
+    """
+    Fingerprint the static files and register the compression hook and the
+    fingerprinted asset route. Returns the asset store.
+    """
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+
+    assets = StaticAssets(app.static_folder)
+    app.extensions["routetracker_assets"] = assets
+    app.after_request(compress_response)
+
+    @app.route("/assets/<path:filename>")
+    def send_asset(filename):
+        return assets.response(filename)
+
+    return assets
@@ -4,3 +4,9 @@ LINK_RELATIONS_URL = "/routetracker/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 USER_PROFILE = "/profiles/user/"
 ROUTE_PROFILE = "/profiles/route/"
+MSGPACK = "application/msgpack"
+MASON_MSGPACK = "application/vnd.mason+msgpack"
+JOB_PROFILE = "/profiles/job/"
+BATCH_PROFILE = "/profiles/batch/"
+ANALYTICS_PROFILE = "/profiles/analytics/"
+LEADERBOARD_PROFILE = "/profiles/leaderboard/"
@@ -0,0 +1,97 @@
+import json
+from flask import Request, request
+from werkzeug.exceptions import BadRequest
+from routetracker.constants import *
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+"""
+Content negotiation for the API. Response bodies are encoded with the encoder
+registered for the best matching Accept mimetype, and request bodies sent with
+a registered mimetype are decoded before the resources read request.json.
+"""
+
+
+class Encoder(object):
+    """
+    Pair of functions used to serialize a Mason document to bytes and back.
+    : param callable dumps: document -> str or bytes
+    : param callable loads: str or bytes -> document
+    """
+
+    def __init__(self, dumps, loads):
+        self.dumps = dumps
+        self.loads = loads
+
+
+# mimetype -> Encoder, the first registered one is the default for */*
+ENCODERS = {}
+
+
+def register_encoder(mimetype, dumps, loads):
+    """
+    Register an encoder for a mimetype. Registering an already existing
+    mimetype replaces the previous encoder.
+    """
+    ENCODERS[mimetype] = Encoder(dumps, loads)
+
+
+def negotiate_mimetype():
+    """
+    Pick the response mimetype based on the Accept header of the current
+    request. Falls back to Mason JSON when nothing registered is acceptable.
+    """
+    mimetype = request.accept_mimetypes.best_match(list(ENCODERS))
+    if mimetype is None:
+        return MASON
+    return mimetype
+
+
+def encode_body(body):
+    """
+    Encode a document for the current request, returns (data, mimetype)
+    """
+    mimetype = negotiate_mimetype()
+    return ENCODERS[mimetype].dumps(body), mimetype
+
+
+class MasonRequest(Request):
+    """
+    Request class that also decodes bodies of the registered non-JSON
+    mimetypes, so that request.json works the same way for all of them.
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        encoder = ENCODERS.get(self.mimetype)
+        if encoder is None or self.mimetype == MASON:
+            return super(MasonRequest, self).get_json(force=force, silent=silent, cache=cache)
+
+        if cache and getattr(self, "_decoded_body", None) is not None:
+            return self._decoded_body
+        try:
+            data = encoder.loads(self.get_data(cache=cache))
+        except Exception as err:
+            if silent:
+                return None
+            raise BadRequest("Failed to decode {} body: {}".format(self.mimetype, err))
+        if cache:
+            self._decoded_body = data
+        return data
+
+
+register_encoder(MASON, json.dumps, json.loads)
+
+# msgpack is optional, the mimetypes are only offered when it is installed
+if msgpack is not None:
+    def _msgpack_dumps(body):
+        return msgpack.packb(body, use_bin_type=True)
+
+    def _msgpack_loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+    register_encoder(MASON_MSGPACK, _msgpack_dumps, _msgpack_loads)
+    register_encoder(MSGPACK, _msgpack_dumps, _msgpack_loads)
@@ -0,0 +1,66 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+
+"""
+Notifications about written routes. Everything that keeps derived state about
+the routes of a user (in-process caches, feeds etc.) registers a listener
+here, and the resources call routes_changed once per committed write, however
+many rows it touched. The call can describe the change with compact dicts
+such as {"op": "update", "route": 12, "seq": 40}, where seq is the change
+sequence value of the write.
+"""
+
+logger = logging.getLogger("routetracker.events")
+
+# functions called with the id of the user whose routes changed and the list
+# of changes
+ROUTE_LISTENERS = []
+
+# changes collected by deferred_changes blocks of each thread
+_deferred = threading.local()
+
+
+def on_routes_changed(func):
+    """
+    Decorator registering a listener for route changes
+    """
+    ROUTE_LISTENERS.append(func)
+    return func
+
+
+def routes_changed(user, *changes):
+    """
+    Tell the listeners that the routes of a user have changed. Must be
+    called after the change has been committed. A failing listener is logged
+    and does not fail the request.
+    """
+    # the resources get the id from the URL as a string
+    user = int(user)
+    pending = getattr(_deferred, "changes", None)
+    if pending is not None:
+        pending.setdefault(user, []).extend(changes)
+        return
+    for listener in ROUTE_LISTENERS:
+        try:
+            listener(user, list(changes))
+        except Exception:
+            logger.exception("route listener %s failed", getattr(listener, "__name__", listener))
+
+
+@contextmanager
+def deferred_changes():
+    """
+    Collect the changes of the block and tell the listeners once per user at
+    the end, for writes that are committed together. Yields the collected
+    {user: changes} dict, which can be cleared when the writes are rolled
+    back.
+    """
+    pending = _deferred.changes = {}
+    try:
+        yield pending
+    finally:
+        _deferred.changes = None
+    for user in sorted(pending):
+        routes_changed(user, *pending[user])
@@ -0,0 +1,168 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import urlsplit
+from flask import Response, current_app, request
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from routetracker import db
+from routetracker.metrics import cache_hit, cache_miss
+from routetracker.models import IdempotencyKey
+from routetracker.utils import create_error_response
+
+
+"""
+Idempotency keys for the create requests. A client that retries a POST sends
+the same Idempotency-Key header, and the answer of the first successful
+request is given again from the idempotency_key table, without validating
+and inserting the document a second time.
+
+A new key is inserted before the request is run, in the same transaction as
+the write of the request, and its response is stored after it. On SQLite a
+concurrent request with the same key blocks on the database write lock
+until the first one commits, then finds the key taken by the unique
+constraint and gets 409 while the first one is still running. A key whose
+response was never stored, e.g. because the process died between the two
+commits, is taken over by a retry after IDEMPOTENCY_LEASE seconds (default
+60) instead of answering 409 until it expires.
+
+The table is bounded: keys expire after IDEMPOTENCY_TTL seconds (default one
+day), and at most IDEMPOTENCY_MAX_KEYS (default 10000) of the newest keys are
+kept. Both are enforced with one DELETE whenever a key is reserved.
+"""
+
+HEADER = "Idempotency-Key"
+
+
+def idempotent(func):
+    """
+    Decorator for the post methods of resources that answer 201 with a
+    Location header. Only successful responses are stored, so that a request
+    that failed can be fixed and sent again with the same key.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return func(*args, **kwargs)
+        if not key or len(key) > 250:
+            return create_error_response(
+                        400, "Invalid idempotency key",
+                        "{} must be 1-250 characters long".format(HEADER)
+                        )
+
+        scope = request.path
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        stored = _lookup(key, scope)
+        if stored is None:
+            cache_miss("idempotency")
+            if _reserve(key, scope, fingerprint):
+                return _run(func, args, kwargs, key, scope)
+            # a concurrent request with the same key reserved it first
+            stored = _lookup(key, scope)
+            if stored is None:
+                return _in_progress()
+        if stored.fingerprint != fingerprint:
+            return create_error_response(
+                        422, "Idempotency key reused",
+                        "The key was already used for a different request"
+                        )
+        if stored.status is None:
+            return _in_progress()
+        cache_hit("idempotency")
+        return _replay(stored)
+    return wrapper
+
+
+def _lookup(key, scope):
+    return IdempotencyKey.query.filter(
+                IdempotencyKey.key == key,
+                IdempotencyKey.scope == scope,
+                ~_expired()
+                ).first()
+
+
+def _in_progress():
+    return create_error_response(
+                409, "Request in progress",
+                "A request with the same idempotency key is still running, retry it later"
+                )
+
+
+def _replay(stored):
+    headers = {"Idempotent-Replayed": "true"}
+    if stored.location is not None:
+        headers["Location"] = stored.location
+    return Response(status=stored.status, headers=headers)
+
+
+def _expired():
+    """
+    Criterion of the keys that are dropped: expired keys and abandoned
+    reservations
+    """
+    now = datetime.utcnow()
+    ttl = current_app.config.get("IDEMPOTENCY_TTL", 24 * 60 * 60)
+    lease = current_app.config.get("IDEMPOTENCY_LEASE", 60)
+    return (
+        (IdempotencyKey.createdAt <= now - timedelta(seconds=ttl))
+        | (IdempotencyKey.status.is_(None) & (IdempotencyKey.createdAt <= now - timedelta(seconds=lease)))
+        )
+
+
+def _reserve(key, scope, fingerprint):
+    """
+    Insert the key without a response in the transaction of the request,
+    before running it, dropping expired keys, abandoned reservations and the
+    oldest keys over the limit. The handler commits the key together with
+    its write, the DELETE makes a concurrent request wait for that on the
+    write lock. Returns False if another request has the key.
+    """
+    table = IdempotencyKey.__table__
+    limit = current_app.config.get("IDEMPOTENCY_MAX_KEYS", 10000)
+    newest = select(func.max(table.c.id)).scalar_subquery()
+    # the new key is added after the delete, it takes the last place
+    db.session.execute(table.delete().where(_expired() | (table.c.id <= newest - limit + 1)))
+    db.session.add(IdempotencyKey(key=key, scope=scope, fingerprint=fingerprint))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+def _owner(location):
+    """
+    Id of the user a created resource belongs to, from the user variable of
+    its URL, None for other resources
+    """
+    if location is None:
+        return None
+    try:
+        endpoint, values = current_app.url_map.bind("localhost").match(urlsplit(location).path)
+        return int(values["user"])
+    except (HTTPException, KeyError, ValueError):
+        return None
+
+
+def _run(func, args, kwargs, key, scope):
+    """
+    Run the request of a reserved key and store its response, or release the
+    key if the request failed so that it can be fixed and sent again
+    """
+    response = func(*args, **kwargs)
+    stored = IdempotencyKey.query.filter(IdempotencyKey.key == key, IdempotencyKey.scope == scope)
+    if 200 <= response.status_code < 300:
+        location = response.headers.get("Location")
+        stored.update(
+            {"status": response.status_code, "location": location, "userId": _owner(location)},
+            synchronize_session=False
+            )
+    else:
+        db.session.rollback()
+        # the request may have committed the key before failing
+        stored.filter(IdempotencyKey.status.is_(None)).delete(synchronize_session=False)
+    db.session.commit()
+    return response
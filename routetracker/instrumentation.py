@@ -0,0 +1,539 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import Response, current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+from routetracker import db, metrics
+from routetracker.metrics import Histogram
+
+
+"""
+Opt-in request instrumentation. While SERVER_TIMING is set in the config, each
+API request is split into the time spent in SQL, building the hypermedia
+document and encoding it. The phases are reported in a Server-Timing header
+and collected into per-endpoint latency histograms that can be queried with
+get_histograms().
+
+Independent of that, the SQL statements, rows and time of every request are
+attributed to the resource method handling it (get_query_stats()), and tests
+can declare query budgets with query_budget().
+
+Unless METRICS is disabled in the config, requests and queries are also
+recorded to the metrics served from /metrics in Prometheus text format.
+
+Statements slower than SLOW_QUERY_THRESHOLD seconds are logged to the
+"routetracker.slow_queries" logger with their parameters, the resource method
+that issued them and the SQLite query plan.
+"""
+
+PHASES = ("sql", "build", "encode", "total")
+
+REQUESTS = metrics.counter(
+    "routetracker_requests_total",
+    "Handled requests by resource method and status code",
+    ["resource", "status"]
+    )
+REQUEST_DURATION = metrics.histogram(
+    "routetracker_request_duration_seconds",
+    "Request latency by resource method",
+    ["resource"]
+    )
+RESPONSE_SIZE = metrics.histogram(
+    "routetracker_response_size_bytes",
+    "Response body size by resource method, after compression",
+    ["resource"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+    )
+DB_QUERIES = metrics.counter(
+    "routetracker_db_queries_total",
+    "SQL statements by the resource method that issued them",
+    ["resource"]
+    )
+DB_QUERY_DURATION = metrics.histogram(
+    "routetracker_db_query_duration_seconds",
+    "SQL statement execution time by the resource method that issued them",
+    ["resource"]
+    )
+DB_CONNECTION_OPEN = metrics.histogram(
+    "routetracker_db_connection_open_seconds",
+    "Time opening a new connection for the pool"
+    )
+DB_CONNECTION_HOLD = metrics.histogram(
+    "routetracker_db_connection_hold_seconds",
+    "Time from checking a connection out of the pool until it is returned"
+    )
+
+DB_SLOW_QUERIES = metrics.counter(
+    "routetracker_db_slow_queries_total",
+    "SQL statements slower than SLOW_QUERY_THRESHOLD by resource method",
+    ["resource"]
+    )
+
+slow_query_logger = logging.getLogger("routetracker.slow_queries")
+
+
+# (endpoint, method, phase) -> Histogram
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def _histogram(endpoint, method, phase):
+    key = (endpoint, method, phase)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    return histogram
+
+
+def get_histograms(endpoint=None):
+    """
+    Snapshots of the latency histograms, keyed by (endpoint, method, phase).
+    : param str endpoint: only return the histograms of this endpoint,
+    e.g. "api.routecollection"
+    """
+    with _histograms_lock:
+        items = list(_histograms.items())
+    return dict(
+        (key, histogram.snapshot()) for key, histogram in items
+        if endpoint is None or key[0] == endpoint
+        )
+
+
+def get_histogram(endpoint, method, phase="total"):
+    """
+    The live histogram of one endpoint, method and phase, or None
+    """
+    return _histograms.get((endpoint, method, phase))
+
+
+def reset_histograms():
+    """
+    forget all collected latencies
+    """
+    with _histograms_lock:
+        _histograms.clear()
+
+
+class RequestTiming(object):
+    """
+    Accumulated phase durations of one request
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = dict.fromkeys(("sql", "handler", "encode"), 0.0)
+        self.queries = 0
+
+    def add(self, phase, duration):
+        self.durations[phase] += duration
+
+    def phases(self):
+        """
+        Durations of all reported phases. The build phase is the part of the
+        resource handler not spent in SQL or encoding, which is where the
+        RouteBuilder documents are put together.
+        """
+        durations = self.durations
+        return {
+            "sql": durations["sql"],
+            "build": max(durations["handler"] - durations["sql"] - durations["encode"], 0.0),
+            "encode": durations["encode"],
+            "total": time.perf_counter() - self.start,
+        }
+
+
+def current_timing():
+    """
+    RequestTiming of the current request, or None if timing is not enabled
+    or we are outside a request.
+    """
+    if not has_request_context():
+        return None
+    return g.get("timing")
+
+
+@contextmanager
+def timed(phase):
+    """
+    Context manager adding the duration of the block to a phase of the
+    current request. Does nothing when timing is not enabled.
+    """
+    timing = current_timing()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(phase, time.perf_counter() - start)
+
+
+@contextmanager
+def nested_request():
+    """
+    Context manager for a request run inside the handler of another one,
+    e.g. a sub-request of a batch. Both share g, so the resource method
+    name is saved and restored around the block, and the statements in it
+    are attributed to the inner resource. The timing stays with the outer
+    request, which already times the whole handler.
+    """
+    saved = g.pop("resource_name", None)
+    try:
+        yield
+    finally:
+        g.pop("resource_name", None)
+        if saved is not None:
+            g.resource_name = saved
+
+
+def timed_resource(view):
+    """
+    Decorator for the Flask-RESTful resource views, times the whole handler.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # the sub-requests of a batch run inside the handler of the batch
+        if g.get("in_handler"):
+            return view(*args, **kwargs)
+        g.in_handler = True
+        try:
+            with timed("handler"):
+                return view(*args, **kwargs)
+        finally:
+            g.in_handler = False
+    return wrapper
+
+
+class QueryStats(object):
+    """
+    Number of statements, rows and time spent in SQL. Rows are the rows
+    affected by DML statements plus the ORM objects loaded by queries.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.rows = 0
+        self.time = 0.0
+
+    def as_dict(self):
+        return {"requests": self.requests, "statements": self.statements, "rows": self.rows, "time": self.time}
+
+
+# "Resource.method" -> QueryStats, accumulated over all requests
+_query_totals = {}
+_query_totals_lock = threading.Lock()
+# recorders active in recorded_queries blocks
+_recorders = []
+
+
+def resource_name():
+    """
+    Name of the resource and method handling the current request in the
+    form "RouteCollection.get". Falls back to the endpoint name for views
+    that are not Flask-RESTful resources, and to "background" outside
+    requests.
+    """
+    if not has_request_context():
+        return "background"
+    name = g.get("resource_name")
+    if name is None:
+        view = current_app.view_functions.get(request.endpoint)
+        name = getattr(getattr(view, "view_class", None), "__name__", request.endpoint or "unmatched")
+        name = g.resource_name = "{}.{}".format(name, request.method.lower())
+    return name
+
+
+def current_query_stats():
+    """
+    QueryStats of the current request, or None outside a request
+    """
+    if not has_request_context():
+        return None
+    stats = g.get("query_stats")
+    if stats is None:
+        stats = g.query_stats = QueryStats()
+    return stats
+
+
+def get_query_stats(resource=None):
+    """
+    Accumulated query statistics per resource method as dicts.
+    : param str resource: only return this one, e.g. "RouteCollection.get"
+    """
+    with _query_totals_lock:
+        return dict(
+            (name, stats.as_dict()) for name, stats in _query_totals.items()
+            if resource is None or name == resource
+            )
+
+
+def reset_query_stats():
+    """
+    forget the accumulated query statistics
+    """
+    with _query_totals_lock:
+        _query_totals.clear()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a query_budget block issues more statements than allowed
+    """
+
+
+class QueryRecorder(object):
+    """
+    Statements and their parameters executed while a recorded_queries block
+    is active
+    """
+
+    def __init__(self, resource=None):
+        self.resource = resource
+        self.statements = []
+        self.parameters = []
+
+    def record(self, statement, parameters):
+        if self.resource is None or (has_request_context() and resource_name() == self.resource):
+            self.statements.append(statement)
+            self.parameters.append(parameters)
+
+
+@contextmanager
+def recorded_queries(resource=None):
+    """
+    Context manager recording the statements executed inside the block.
+    : param str resource: only record statements issued by this resource
+    method, e.g. "RouteCollection.get"
+    """
+    recorder = QueryRecorder(resource)
+    _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorders.remove(recorder)
+
+
+@contextmanager
+def query_budget(max_queries, resource=None):
+    """
+    Context manager for tests, fails with QueryBudgetExceeded if more than
+    max_queries statements are executed inside the block.
+    : param str resource: only count statements issued by this resource
+    method, e.g. "RouteCollection.get"
+    """
+    with recorded_queries(resource) as recorder:
+        yield recorder
+    if len(recorder.statements) > max_queries:
+        raise QueryBudgetExceeded(
+            "{} issued {} queries, budget is {}:\n{}".format(
+                resource or "block", len(recorder.statements), max_queries,
+                "\n".join(recorder.statements)
+                )
+            )
+
+
+def explain_query_plan(dbapi_connection, statement, parameters):
+    """
+    SQLite EXPLAIN QUERY PLAN of a statement as a list of the plan details,
+    e.g. ["SEARCH route USING INDEX ix_route_user_date (userId=?)"]
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _metrics_enabled():
+    # the SQLAlchemy hooks are global, the metrics are on per app
+    return has_app_context() and current_app.extensions.get("routetracker_metrics", False)
+
+
+def _log_slow_query(conn, cursor, statement, parameters, duration, executemany):
+    name = resource_name()
+    if _metrics_enabled():
+        DB_SLOW_QUERIES.labels(name).inc()
+
+    plan = []
+    if conn.dialect.name == "sqlite" and not executemany:
+        try:
+            plan = explain_query_plan(cursor.connection, statement, parameters)
+        except Exception as err:
+            plan = ["EXPLAIN QUERY PLAN failed: {}".format(err)]
+    slow_query_logger.warning(
+        "slow query (%.1f ms) in %s\n%s\nparameters: %r\nplan:\n%s",
+        duration * 1000, name, statement, parameters,
+        "\n".join("  " + detail for detail in plan)
+        )
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _recorders or has_app_context():
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not conn.info.get("query_start"):
+        return
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+
+    for recorder in list(_recorders):
+        recorder.record(statement, parameters)
+
+    if has_app_context():
+        threshold = current_app.config.get("SLOW_QUERY_THRESHOLD")
+        if threshold is not None and duration > threshold:
+            _log_slow_query(conn, cursor, statement, parameters, duration, executemany)
+
+    if _metrics_enabled():
+        name = resource_name()
+        DB_QUERIES.labels(name).inc()
+        DB_QUERY_DURATION.labels(name).observe(duration)
+
+    stats = current_query_stats()
+    if stats is not None:
+        stats.statements += 1
+        stats.time += duration
+        if cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+    timing = current_timing()
+    if timing is not None:
+        timing.add("sql", duration)
+        timing.queries += 1
+
+
+def _before_connect(dialect, connection_record, cargs, cparams):
+    connection_record.info["connect_start"] = time.perf_counter()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    start = connection_record.info.pop("connect_start", None)
+    if start is not None:
+        DB_CONNECTION_OPEN.labels().observe(time.perf_counter() - start)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["checkout_start"] = time.perf_counter()
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    start = connection_record.info.pop("checkout_start", None)
+    if start is not None:
+        DB_CONNECTION_HOLD.labels().observe(time.perf_counter() - start)
+
+
+def _time_connections(engine):
+    """
+    Record how long the connections of the engine take to open and how long
+    they are held. The pool listeners are carried over to the new pool of
+    engine.dispose().
+    """
+    if event.contains(engine, "do_connect", _before_connect):
+        return
+    event.listen(engine, "do_connect", _before_connect)
+    event.listen(engine.pool, "connect", _on_connect)
+    event.listen(engine.pool, "checkout", _on_checkout)
+    event.listen(engine.pool, "checkin", _on_checkin)
+
+
+@event.listens_for(Mapper, "load")
+def _on_load(target, context):
+    stats = current_query_stats()
+    if stats is not None:
+        stats.rows += 1
+
+
+def _collect_query_stats(response):
+    stats = g.get("query_stats")
+    if stats is None or request.endpoint is None:
+        return response
+    name = resource_name()
+    with _query_totals_lock:
+        totals = _query_totals.setdefault(name, QueryStats())
+        totals.requests += 1
+        totals.statements += stats.statements
+        totals.rows += stats.rows
+        totals.time += stats.time
+    return response
+
+
+def _start_timing():
+    if current_app.config["SERVER_TIMING"]:
+        g.timing = RequestTiming()
+
+
+def _report_timing(response):
+    timing = current_timing()
+    if timing is None or request.endpoint is None:
+        return response
+
+    phases = timing.phases()
+    metrics = []
+    for phase in PHASES:
+        _histogram(request.endpoint, request.method, phase).observe(phases[phase])
+        if phase == "sql":
+            metrics.append('sql;dur={:.3f};desc="{} queries"'.format(phases[phase] * 1000, timing.queries))
+        else:
+            metrics.append("{};dur={:.3f}".format(phase, phases[phase] * 1000))
+    response.headers["Server-Timing"] = ", ".join(metrics)
+    return response
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+
+
+def _record_request(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+    name = resource_name()
+    REQUESTS.labels(name, str(response.status_code)).inc()
+    REQUEST_DURATION.labels(name).observe(time.perf_counter() - start)
+    size = response.content_length
+    if size is None and not response.is_streamed:
+        size = len(response.get_data())
+    if size is not None:
+        RESPONSE_SIZE.labels(name).observe(size)
+    return response
+
+
+def send_metrics():
+    """
+    view serving all metrics in Prometheus text format
+    """
+    return Response(metrics.render(), 200, mimetype="text/plain", headers={"Cache-Control": "no-store"})
+
+
+def init_app(app):
+    """
+    Register the timing hooks, they only do something while SERVER_TIMING
+    is enabled in the config, the hook collecting query statistics and,
+    unless METRICS is disabled, the metrics hooks and the /metrics view.
+    """
+    app.config.setdefault("SERVER_TIMING", False)
+    app.config.setdefault("METRICS", True)
+    app.config.setdefault("SLOW_QUERY_THRESHOLD", None)
+    app.before_request(_start_timing)
+    app.after_request(_report_timing)
+    app.after_request(_collect_query_stats)
+
+    app.extensions["routetracker_metrics"] = app.config["METRICS"]
+    if app.config["METRICS"]:
+        app.before_request(_start_request)
+        app.after_request(_record_request)
+        app.add_url_rule("/metrics", "metrics", send_metrics)
+        with app.app_context():
+            for engine in db.engines.values():
+                _time_connections(engine)
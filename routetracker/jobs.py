@@ -0,0 +1,236 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from routetracker import db
+from routetracker.models import Job
+
+
+"""
+In-process background jobs. Heavy operations are registered as job kinds and
+submitted from the resources, which answer 202 with the URL of the job. The
+jobs are stored in the job table and run on a thread pool of JOB_WORKERS
+threads, each inside its own app context, reporting their progress to the
+table as they go.
+"""
+
+logger = logging.getLogger("routetracker.jobs")
+
+# kind -> function(job_context, **params)
+JOB_KINDS = {}
+
+# ids of the jobs submitted in deferred_jobs blocks of each thread
+_deferred = threading.local()
+
+
+def job_kind(kind):
+    """
+    Decorator registering a function as a job kind. The function gets a
+    JobContext and the keyword arguments given to submit_job.
+    """
+    def decorator(func):
+        JOB_KINDS[kind] = func
+        return func
+    return decorator
+
+
+class JobContext(object):
+    """
+    Handle given to the running job for reporting its progress
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, done, total):
+        """
+        Store the progress of the job, committing it right away so that it
+        can be seen through the job resource.
+        """
+        fraction = min(float(done) / total, 1.0) if total else 0.0
+        Job.query.filter_by(id=self.job_id).update({"progress": fraction}, synchronize_session=False)
+        db.session.commit()
+
+
+class JobQueue(object):
+    """
+    Thread pool running the submitted jobs of one app
+    """
+
+    def __init__(self, app, workers=2):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._pending = set()
+        # names of the scheduled tasks that have not started yet, and a lock
+        # per name so that the runs of a task do not overlap
+        self._scheduled = set()
+        self._task_locks = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, kind, result=None, **params):
+        """
+        Store a new job and queue it, returns the Job
+        : param str result: URL where the result can be found once the job
+        is done
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError("Unknown job kind '{}'".format(kind))
+        job = Job(kind=kind, params=json.dumps(params), result=result)
+        db.session.add(job)
+        db.session.commit()
+        pending = getattr(_deferred, "jobs", None)
+        if pending is not None:
+            pending.append(job.id)
+        else:
+            self.enqueue(job.id)
+        return job
+
+    def enqueue(self, job_id):
+        """
+        queue a job that is already stored
+        """
+        with self._lock:
+            self._pending.add(job_id)
+        self.executor.submit(self._run, job_id)
+
+    def schedule(self, name, func):
+        """
+        Run a function in the background with an app context, without
+        storing a job, e.g. to update derived state after a write. A task
+        scheduled again before it has started runs only once.
+        """
+        token = object()
+        with self._lock:
+            if name in self._scheduled:
+                return
+            self._scheduled.add(name)
+            self._task_locks.setdefault(name, threading.Lock())
+            self._pending.add(token)
+        self.executor.submit(self._run_task, name, func, token)
+
+    def _run_task(self, name, func, token):
+        try:
+            with self._task_locks[name]:
+                with self._lock:
+                    self._scheduled.discard(name)
+                with self.app.app_context():
+                    func()
+        except Exception:
+            logger.exception("task %s failed", name)
+        finally:
+            with self._lock:
+                self._pending.discard(token)
+                self._idle.notify_all()
+
+    def _run(self, job_id):
+        try:
+            with self.app.app_context():
+                self._execute(job_id)
+        finally:
+            with self._lock:
+                self._pending.discard(job_id)
+                self._idle.notify_all()
+
+    def _execute(self, job_id):
+        job = Job.query.filter_by(id=job_id).first()
+        if job is None:
+            return
+        job.status = "running"
+        db.session.commit()
+        try:
+            JOB_KINDS[job.kind](JobContext(job_id), **json.loads(job.params))
+        except Exception as err:
+            logger.exception("job %s (%s) failed", job_id, job.kind)
+            db.session.rollback()
+            job = Job.query.filter_by(id=job_id).first()
+            job.status = "failed"
+            job.error = str(err)[:250]
+        else:
+            job = Job.query.filter_by(id=job_id).first()
+            job.status = "done"
+            job.progress = 1.0
+        db.session.commit()
+
+    def wait(self, timeout=None):
+        """
+        Block until all queued jobs and tasks have finished. Returns False on
+        timeout.
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+@contextmanager
+def deferred_jobs():
+    """
+    Queue the jobs submitted in the block only at its end, for jobs stored in
+    a transaction that is committed later: a worker can not run a job it can
+    not see. Yields the list of submitted job ids, which can be cleared when
+    the transaction is rolled back.
+    """
+    pending = _deferred.jobs = []
+    try:
+        yield pending
+    finally:
+        _deferred.jobs = None
+    queue = current_app.extensions["routetracker_jobs"]
+    for job_id in pending:
+        queue.enqueue(job_id)
+
+
+def submit_job(kind, result=None, **params):
+    """
+    submit a job to the queue of the current app
+    """
+    return current_app.extensions["routetracker_jobs"].submit(kind, result, **params)
+
+
+@click.group("jobs")
+def jobs_command():
+    """
+    Background jobs.
+    """
+
+
+@jobs_command.command("list")
+@with_appcontext
+def list_jobs_command():  # pragma: no cover
+    """
+    List the jobs, newest first.
+    """
+    for job in Job.query.order_by(Job.id.desc()):
+        print("{:6} {:15} {:8} {:4.0f}%  {}  {}".format(
+            job.id, job.kind, job.status, job.progress * 100, job.createdAt.isoformat(), job.error or ""
+            ))
+
+
+@jobs_command.command("resume")
+@with_appcontext
+def resume_jobs_command():  # pragma: no cover
+    """
+    Run the jobs left queued or running by a stopped server.
+    """
+    queue = current_app.extensions["routetracker_jobs"]
+    for job in Job.query.filter(Job.status.in_(["queued", "running"])):
+        print("resuming job {} ({})".format(job.id, job.kind))
+        queue.enqueue(job.id)
+    queue.wait()
+
+
+def init_app(app):
+    """
+    Create the job queue of the app and register the CLI commands.
+    """
+    app.config.setdefault("JOB_WORKERS", 2)
+    queue = JobQueue(app, app.config["JOB_WORKERS"])
+    app.extensions["routetracker_jobs"] = queue
+    app.cli.add_command(jobs_command)
+    return queue
@@ -0,0 +1,234 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, event, func, select, union
+from sqlalchemy.pool import NullPool
+from routetracker import db
+from routetracker.analytics import grade_rank
+from routetracker.events import on_routes_changed
+from routetracker.jobs import job_kind
+from routetracker.models import (
+    ChangeSequence, Grade, LeaderboardEntry, LeaderboardState, Route, Tombstone, User
+    )
+
+
+"""
+Leaderboards of the users in each discipline and location, by hardest grade
+and by number of routes. They are read from the precomputed
+leaderboard_entry table instead of aggregating all routes per request.
+
+A full recompute partitions the users in ranges of ids and aggregates the
+partitions on a pool of LEADERBOARD_WORKERS processes. After that, every
+route write schedules a refresh on the job threads: the users whose routes
+changed since the last refresh (found through the change sequence) are
+aggregated again, which also covers updated and deleted routes. Reading a
+leaderboard never writes. A leaderboard table created in an existing
+database is filled from its routes right away.
+"""
+
+# board -> Route column of the leaderboard items
+BOARDS = {
+    "discipline": Route.disciplineId,
+    "location": Route.locationId
+}
+# partitions per worker, so that uneven partitions even out
+PARTITIONS_PER_WORKER = 4
+# users aggregated per statement in an incremental refresh
+REFRESH_CHUNK_SIZE = 500
+
+
+def _aggregate(connection, criterion, grade_ranks):
+    """
+    Leaderboard rows (board, itemId, userId, routes, topGrade) of the users
+    matching a criterion on Route.userId. The routes are counted by grade in
+    SQL, and the hardest grade is picked here with the grade ranks.
+    """
+    rows = []
+    for board, column in BOARDS.items():
+        entries = {}
+        for user_id, item_id, grade_id, count in connection.execute(
+                select(Route.userId, column, Route.gradeId, func.count())
+                .where(criterion, column.isnot(None))
+                .group_by(Route.userId, column, Route.gradeId)):
+            key = (user_id, item_id)
+            routes, top = entries.get(key, (0, None))
+            rank = grade_ranks.get(grade_id)
+            if rank is not None and (top is None or rank > top):
+                top = rank
+            entries[key] = (routes + count, top)
+        rows.extend(
+            {"board": board, "itemId": item_id, "userId": user_id, "routes": routes, "topGrade": top}
+            for (user_id, item_id), (routes, top) in entries.items()
+            )
+    return rows
+
+
+def _aggregate_partition(database_uri, first_user, last_user, grade_ranks):
+    """
+    Aggregate the users with ids first_user-last_user in a worker process,
+    with a connection of its own
+    """
+    engine = create_engine(database_uri, poolclass=NullPool)
+    try:
+        with engine.connect() as connection:
+            return _aggregate(connection, Route.userId.between(first_user, last_user), grade_ranks)
+    finally:
+        engine.dispose()
+
+
+def _grade_ranks():
+    return dict(
+        (grade_id, grade_rank(name))
+        for grade_id, name in db.session.query(Grade.id, Grade.name)
+        )
+
+
+def _current_seq():
+    return db.session.query(ChangeSequence.value).filter_by(id=1).scalar()
+
+
+def _set_refreshed(seq):
+    LeaderboardState.query.filter_by(id=1).update({"refreshedSeq": seq}, synchronize_session=False)
+
+
+def recompute_leaderboards(workers=None, progress=None):
+    """
+    Build all leaderboards again, aggregating ranges of users on a process
+    pool. Returns the number of leaderboard rows.
+    : param callable progress: called with the number of partitions done
+    and the number of partitions
+    """
+    workers = current_app.config["LEADERBOARD_WORKERS"] if workers is None else workers
+    # the writes after this are applied incrementally, the users written
+    # during the recompute are simply aggregated again
+    seq = _current_seq()
+    grade_ranks = _grade_ranks()
+    user_ids = [user_id for user_id, in db.session.query(User.id).order_by(User.id)]
+    size = max(1, int(math.ceil(float(len(user_ids)) / (max(workers, 1) * PARTITIONS_PER_WORKER))))
+    partitions = [(user_ids[i], user_ids[min(i + size, len(user_ids)) - 1]) for i in range(0, len(user_ids), size)]
+
+    rows = []
+    if workers > 1 and len(partitions) > 1:
+        uri = current_app.config["SQLALCHEMY_DATABASE_URI"]
+        # forking a server process with running threads is not safe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [
+                executor.submit(_aggregate_partition, uri, first, last, grade_ranks)
+                for first, last in partitions
+                ]
+            for done, future in enumerate(futures, 1):
+                rows.extend(future.result())
+                if progress is not None:
+                    progress(done, len(partitions))
+    else:
+        for done, (first, last) in enumerate(partitions, 1):
+            # the progress is committed, which ends the connection of the session
+            rows.extend(_aggregate(db.session.connection(), Route.userId.between(first, last), grade_ranks))
+            if progress is not None:
+                progress(done, len(partitions))
+
+    db.session.query(LeaderboardEntry).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(LeaderboardEntry.__table__.insert(), rows)
+    _set_refreshed(seq)
+    db.session.commit()
+    return len(rows)
+
+
+def refresh_leaderboards():
+    """
+    Apply the writes since the last refresh to the leaderboards by
+    aggregating the users whose routes changed again. Costs one query when
+    nothing changed. Returns the number of aggregated users.
+    """
+    seq = select(ChangeSequence.value).where(ChangeSequence.id == 1).scalar_subquery()
+    refreshed, seq = db.session.query(LeaderboardState.refreshedSeq, seq).filter(LeaderboardState.id == 1).one()
+    if seq <= refreshed:
+        return 0
+
+    # found through the changeSeq indexes of the routes and tombstones
+    changed = union(
+        select(Route.userId).where(Route.changeSeq > refreshed),
+        select(Tombstone.userId).where(Tombstone.changeSeq > refreshed)
+        )
+    user_ids = [user_id for user_id, in db.session.execute(changed)]
+    grade_ranks = _grade_ranks() if user_ids else None
+    for i in range(0, len(user_ids), REFRESH_CHUNK_SIZE):
+        chunk = user_ids[i:i + REFRESH_CHUNK_SIZE]
+        rows = _aggregate(db.session.connection(), Route.userId.in_(chunk), grade_ranks)
+        db.session.query(LeaderboardEntry).filter(
+            LeaderboardEntry.userId.in_(chunk)
+            ).delete(synchronize_session=False)
+        if rows:
+            db.session.execute(LeaderboardEntry.__table__.insert(), rows)
+    _set_refreshed(seq)
+    db.session.commit()
+    return len(user_ids)
+
+
+@on_routes_changed
+def _schedule_refresh(user, changes):
+    # the writes of other processes are applied by the same refresh
+    queue = current_app.extensions.get("routetracker_jobs")
+    if queue is not None:
+        queue.schedule("refresh-leaderboards", refresh_leaderboards)
+
+
+@event.listens_for(db.metadata, "after_create")
+def _seed_leaderboards(metadata, connection, tables=(), **kwargs):
+    """
+    Fill a newly created leaderboard table from the routes there already
+    are, e.g. in flask init-db --upgrade, so that they do not wait for a
+    full recompute
+    """
+    if LeaderboardEntry.__table__ not in tables:
+        return
+    grade_ranks = dict(
+        (grade_id, grade_rank(name))
+        for grade_id, name in connection.execute(select(Grade.id, Grade.name))
+        )
+    rows = _aggregate(connection, Route.userId.isnot(None), grade_ranks)
+    if rows:
+        connection.execute(LeaderboardEntry.__table__.insert(), rows)
+    connection.execute(LeaderboardState.__table__.update().values(
+        refreshedSeq=select(ChangeSequence.value).where(ChangeSequence.id == 1).scalar_subquery()
+        ))
+
+
+@job_kind("recompute-leaderboards")
+def recompute_leaderboards_job(job):
+    """
+    Background job building the leaderboards again
+    """
+    recompute_leaderboards(progress=job.progress)
+
+
+@click.group("leaderboards")
+def leaderboards_command():
+    """
+    Precomputed leaderboards.
+    """
+
+
+@leaderboards_command.command("recompute")
+@click.option("--workers", type=int, default=None, help="number of worker processes")
+@with_appcontext
+def recompute_leaderboards_command(workers):  # pragma: no cover
+    """
+    Build all leaderboards again.
+    """
+    rows = recompute_leaderboards(workers)
+    print("{} leaderboard rows".format(rows))
+
+
+def init_app(app):
+    """
+    Register the CLI commands
+    """
+    app.config.setdefault("LEADERBOARD_WORKERS", os.cpu_count() or 1)
+    app.cli.add_command(leaderboards_command)
@@ -0,0 +1,229 @@
+import threading
+
+
+"""
+Minimal thread safe metrics registry rendered in the Prometheus text format.
+Metrics are grouped in families with a fixed set of label names, and each
+combination of label values gets its own child, e.g.
+
+    REQUESTS = counter("requests_total", "Handled requests", ["resource"])
+    REQUESTS.labels("RouteCollection.get").inc()
+"""
+
+
+class Counter(object):
+    """
+    monotonically increasing value
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    """
+    Thread safe histogram with fixed upper bounds (in seconds by default),
+    the last bucket counts everything above the largest bound.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """
+        add one observation
+        """
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """
+        Consistent copy of the histogram: counts per bucket (not cumulative),
+        number of observations and their sum.
+        """
+        with self._lock:
+            return {"buckets": self.buckets, "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+    def quantile(self, q):
+        """
+        Estimate a quantile (0-1) by linear interpolation inside the bucket it
+        falls in. Returns None when there are no observations.
+        """
+        snapshot = self.snapshot()
+        if snapshot["count"] == 0:
+            return None
+        rank = q * snapshot["count"]
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, snapshot["counts"]):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        # falls in the overflow bucket, the largest bound is the best we know
+        return self.buckets[-1]
+
+    def samples(self, name, labels):
+        snapshot = self.snapshot()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, snapshot["counts"]):
+            cumulative += count
+            samples.append((name + "_bucket", labels + (("le", _format_value(bound)),), cumulative))
+        samples.append((name + "_bucket", labels + (("le", "+Inf"),), snapshot["count"]))
+        samples.append((name + "_sum", labels, snapshot["sum"]))
+        samples.append((name + "_count", labels, snapshot["count"]))
+        return samples
+
+
+class MetricFamily(object):
+    """
+    All children of one metric name, keyed by their label values
+    """
+
+    def __init__(self, name, documentation, kind, labelnames=(), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        The child for the given label values, created on first use
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} expects labels {}".format(self.name, self.labelnames))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = _KINDS[self.kind](**self._kwargs)
+        return child
+
+    def clear(self):
+        """
+        remove all children
+        """
+        with self._lock:
+            self._children.clear()
+
+    def render(self):
+        """
+        the family in Prometheus text format
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, _escape(self.documentation, help_text=True)),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            labels = tuple(zip(self.labelnames, values))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append("{}{} {}".format(name, _format_labels(sample_labels), _format_value(value)))
+        return "\n".join(lines)
+
+
+_KINDS = {"counter": Counter, "histogram": Histogram}
+
+# name -> MetricFamily
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+
+def _register(family):
+    with _registry_lock:
+        if family.name in REGISTRY:
+            raise ValueError("metric {} already registered".format(family.name))
+        REGISTRY[family.name] = family
+    return family
+
+
+def counter(name, documentation, labelnames=()):
+    """
+    register a counter family
+    """
+    return _register(MetricFamily(name, documentation, "counter", labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=Histogram.BUCKETS):
+    """
+    register a histogram family
+    """
+    return _register(MetricFamily(name, documentation, "histogram", labelnames, buckets=buckets))
+
+
+def render():
+    """
+    all registered metrics in Prometheus text format
+    """
+    with _registry_lock:
+        families = sorted(REGISTRY.values(), key=lambda family: family.name)
+    return "\n".join(family.render() for family in families) + "\n"
+
+
+def _escape(value, help_text=False):
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    if not help_text:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape(str(value))) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# cache hits and misses of the in-process caches, the hit rate is
+# hits / (hits + misses)
+CACHE_REQUESTS = counter(
+    "routetracker_cache_requests_total",
+    "Lookups of in-process caches by result (hit or miss)",
+    ["cache", "result"]
+    )
+
+
+def cache_hit(cache):
+    """
+    record a hit of a named cache
+    """
+    CACHE_REQUESTS.labels(cache, "hit").inc()
+
+
+def cache_miss(cache):
+    """
+    record a miss of a named cache
+    """
+    CACHE_REQUESTS.labels(cache, "miss").inc()
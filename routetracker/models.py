@@ -1,6 +1,11 @@
 import click
+from datetime import datetime, timedelta
+from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, func, inspect, literal
+from sqlalchemy.orm import Session, aliased
 from routetracker import db
+from routetracker.events import routes_changed
 
 
 """
@@ -16,9 +21,12 @@ class User(db.Model):
     email = db.Column(db.String(100), nullable=False, unique=True)
     firstName = db.Column(db.String(64), nullable=True)
     lastName = db.Column(db.String(64), nullable=True)
+    # change sequence of the last write, see change_seq
+    changeSeq = db.Column(db.Integer, nullable=False, default=0)
 
-    # delete routes in case the parent table item (user) is deleted
-    routes = db.relationship("Route", cascade="delete", back_populates="user")
+    # delete routes in case the parent table item (user) is deleted. the routes
+    # are not loaded for that, the database deletes them with ON DELETE CASCADE
+    routes = db.relationship("Route", cascade="delete", back_populates="user", passive_deletes=True)
 
     @staticmethod
     def get_schema():
@@ -41,6 +49,30 @@ class User(db.Model):
         }
         return schema
 
+    @staticmethod
+    def get_patch_schema():
+        """
+        schema for JSON Merge Patch documents, all fields are optional and
+        the optional ones can be removed with null
+        """
+        schema = {
+            "type": "object"
+        }
+        props = schema["properties"] = {}
+        props["email"] = {
+            "description": "users unique email address",
+            "type": "string"
+        }
+        props["firstName"] = {
+            "description": "users first name",
+            "type": ["string", "null"]
+        }
+        props["lastName"] = {
+            "description": "users last name",
+            "type": ["string", "null"]
+        }
+        return schema
+
 
 # Table: routes
 class Route(db.Model):
@@ -54,12 +86,38 @@ class Route(db.Model):
     disciplineId = db.Column(db.Integer, db.ForeignKey("discipline.id", ondelete="SET NULL"))
     gradeId = db.Column(db.Integer, db.ForeignKey("grade.id", ondelete="SET NULL"))
     extraInfo = db.Column(db.String(250), nullable=True)
+    # change sequence of the last write, see change_seq
+    changeSeq = db.Column(db.Integer, nullable=False, default=0)
 
     user = db.relationship("User", back_populates="routes")
     location = db.relationship("Location", back_populates="routes")
     discipline = db.relationship("Discipline", back_populates="routes")
     grade = db.relationship("Grade", back_populates="routes")
 
+    # every index is kept up to date by each route write, so there is one per
+    # access path. check-query-plans shows the plans that use them.
+    __table_args__ = (
+        # all lookups of the routes of a user, including the per user
+        # location, discipline and grade listings and the bulk operations,
+        # and the covering index of the training load analytics
+        db.Index("ix_route_user_date", "userId", "date", "gradeId", "disciplineId"),
+        # the change feed of a user, userId = ? AND changeSeq > ?, and the
+        # change token of the analytics, max(changeSeq) of a user
+        db.Index("ix_route_user_change", "userId", "changeSeq"),
+        # the routes of all users written since the last leaderboard refresh
+        db.Index("ix_route_change", "changeSeq"),
+        # the routes of all users in a location, discipline or grade by date,
+        # also used by ON DELETE SET NULL of the lookups
+        db.Index("ix_route_location_date", "locationId", "date"),
+        db.Index("ix_route_discipline_date", "disciplineId", "date"),
+        db.Index("ix_route_grade_date", "gradeId", "date"),
+        # the newest routes of all users, for the recent activity, and the
+        # oldest ones for the archive
+        db.Index("ix_route_date", "date"),
+        # ids are never used again, they stay unique with the archived routes
+        {"sqlite_autoincrement": True},
+    )
+
     @staticmethod
     def get_schema():
         schema = {
@@ -85,6 +143,61 @@ class Route(db.Model):
         }
         return schema
 
+    @staticmethod
+    def get_patch_schema():
+        """
+        schema for JSON Merge Patch documents, all fields are optional and
+        extraInfo can be removed with null
+        """
+        schema = {
+            "type": "object"
+        }
+        props = schema["properties"] = {}
+        props["date"] = {
+            "description": "date when the route was climbed",
+            "type": "string"
+        }
+        props["location"] = {
+            "description": "location where the route was climbed",
+            "type": "string"
+        }
+        props["discipline"] = {
+            "description": "discipline of the route",
+            "type": "string"
+        }
+        props["grade"] = {
+            "description": "grade of the route",
+            "type": "string"
+        }
+        props["extraInfo"] = {
+            "description": "additional information",
+            "type": ["string", "null"]
+        }
+        return schema
+
+
+# Table: archived routes, old routes moved out of the route table by
+# archive.archive_routes. They keep their ids and are read with history=full.
+class ArchivedRoute(db.Model):
+    __tablename__ = "route_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    userId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    locationId = db.Column(db.Integer, db.ForeignKey("location.id", ondelete="SET NULL"))
+    disciplineId = db.Column(db.Integer, db.ForeignKey("discipline.id", ondelete="SET NULL"))
+    gradeId = db.Column(db.Integer, db.ForeignKey("grade.id", ondelete="SET NULL"))
+    extraInfo = db.Column(db.String(250), nullable=True)
+    # change sequence of the last write before the route was archived
+    changeSeq = db.Column(db.Integer, nullable=False, default=0)
+
+    location = db.relationship("Location")
+    discipline = db.relationship("Discipline")
+    grade = db.relationship("Grade")
+
+    __table_args__ = (
+        db.Index("ix_route_archive_user", "userId", "date"),
+    )
+
 
 # Table: locations
 class Location(db.Model):
@@ -110,14 +223,326 @@ class Grade(db.Model):
     routes = db.relationship("Route", back_populates="grade")
 
 
+# Table: background jobs
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String(20), nullable=False, default="queued")
+    # fraction of the work done, 0-1
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    # keyword arguments of the job as JSON
+    params = db.Column(db.Text, nullable=False, default="{}")
+    # URL of the result, if any
+    result = db.Column(db.String(250), nullable=True)
+    error = db.Column(db.String(250), nullable=True)
+    createdAt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updatedAt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# Table: change sequence, one row holding the last used value
+class ChangeSequence(db.Model):
+    __tablename__ = "change_sequence"
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    # the newest pruned tombstone, changes since older values are not known
+    prunedSeq = db.Column(db.Integer, nullable=False, default=0)
+
+
+event.listen(
+    ChangeSequence.__table__, "after_create",
+    DDL("INSERT INTO change_sequence (id, value, \"prunedSeq\") VALUES (1, 0, 0)")
+    )
+
+
+# Table: deleted routes and users for the change feed
+class Tombstone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # "route" or "user" for deletes, "archive" for a chunk of routes moved to
+    # the archive, with the id of their user as entityId
+    entity = db.Column(db.String(10), nullable=False)
+    entityId = db.Column(db.Integer, nullable=False)
+    # owner of the deleted or archived routes, or the deleted user
+    userId = db.Column(db.Integer, nullable=False)
+    changeSeq = db.Column(db.Integer, nullable=False)
+    # tombstones are kept for TOMBSTONE_RETENTION_DAYS, see prune_tombstones
+    createdAt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_tombstone_user_change", "userId", "changeSeq"),
+        db.Index("ix_tombstone_change", "changeSeq"),
+    )
+
+
+# Table: precomputed leaderboards, one row per user in each discipline and
+# location leaderboard
+class LeaderboardEntry(db.Model):
+    __tablename__ = "leaderboard_entry"
+    id = db.Column(db.Integer, primary_key=True)
+    # "discipline" or "location"
+    board = db.Column(db.String(10), nullable=False)
+    itemId = db.Column(db.Integer, nullable=False)
+    userId = db.Column(db.Integer, nullable=False)
+    routes = db.Column(db.Integer, nullable=False)
+    # rank of the hardest grade, see analytics.grade_rank
+    topGrade = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint("userId", "board", "itemId", name="uq_leaderboard_user"),
+        db.Index("ix_leaderboard_grade", "board", "itemId", "topGrade", "routes"),
+        db.Index("ix_leaderboard_volume", "board", "itemId", "routes", "topGrade"),
+    )
+
+
+# Table: leaderboard state, one row holding the change sequence value the
+# leaderboards are up to date with
+class LeaderboardState(db.Model):
+    __tablename__ = "leaderboard_state"
+    id = db.Column(db.Integer, primary_key=True)
+    refreshedSeq = db.Column(db.Integer, nullable=False, default=0)
+
+
+event.listen(
+    LeaderboardState.__table__, "after_create",
+    DDL("INSERT INTO leaderboard_state (id, \"refreshedSeq\") VALUES (1, 0)")
+    )
+
+
+# Table: responses of create requests by their Idempotency-Key header
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_key"
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(250), nullable=False)
+    # path of the request, the same key can be used with different resources
+    scope = db.Column(db.String(250), nullable=False)
+    # hash of the request body, a key must not be reused for another request
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # response of the request, None while it is running
+    status = db.Column(db.Integer, nullable=True)
+    location = db.Column(db.String(250), nullable=True)
+    # user of the created resource, the keys are deleted with the user
+    userId = db.Column(db.Integer, nullable=True)
+    createdAt = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("key", "scope", name="uq_idempotency_key_scope"),
+        db.Index("ix_idempotency_key_created", "createdAt"),
+    )
+
+
+def change_seq(session=None):
+    """
+    Value of the change sequence for the writes of the current transaction,
+    taken from the sequence on first use. Values grow in commit order, as
+    the UPDATE of the sequence holds the SQLite write lock until the commit.
+    """
+    session = session or db.session()
+    seq = session.info.get("change_seq")
+    if seq is None:
+        table = ChangeSequence.__table__
+        # an autoflush here would take a value of its own for the pending rows
+        with session.no_autoflush:
+            session.execute(table.update().where(table.c.id == 1).values(value=table.c.value + 1))
+            seq = session.execute(table.select().where(table.c.id == 1)).fetchone().value
+        session.info["change_seq"] = seq
+    return seq
+
+
+def record_route_tombstones(query):
+    """
+    Write tombstones for the routes selected by a Route query before they are
+    deleted with a set based statement, in one INSERT ... SELECT. Returns the
+    change sequence value of the tombstones.
+    """
+    seq = change_seq()
+    select = query.with_entities(literal("route"), Route.id, Route.userId, literal(seq)).statement
+    db.session.execute(
+        Tombstone.__table__.insert().from_select(["entity", "entityId", "userId", "changeSeq"], select)
+        )
+    return seq
+
+
+def prune_tombstones(before):
+    """
+    Delete the tombstones written before a datetime, except the newest one of
+    each user, which the analytics compare to tell that routes were deleted.
+    The newest pruned change sequence value is stored, change feeds since an
+    older value have to be read again in full. Returns the number of deleted
+    tombstones.
+    """
+    newest = aliased(Tombstone)
+    pruned = db.session.query(Tombstone.id, Tombstone.changeSeq).filter(
+                Tombstone.createdAt < before,
+                Tombstone.changeSeq < db.session.query(func.max(newest.changeSeq)).filter(
+                    newest.userId == Tombstone.userId
+                    ).scalar_subquery()
+                )
+    seq = pruned.with_entities(func.max(Tombstone.changeSeq)).scalar()
+    if seq is None:
+        return 0
+    count = Tombstone.query.filter(Tombstone.id.in_(pruned.with_entities(Tombstone.id))).delete(
+                synchronize_session=False
+                )
+    ChangeSequence.query.filter(ChangeSequence.id == 1, ChangeSequence.prunedSeq < seq).update(
+        {"prunedSeq": seq}, synchronize_session=False
+        )
+    db.session.commit()
+    return count
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_changes(session, flush_context, instances):
+    """
+    Give the routes and users written through the ORM the change sequence
+    value of this transaction. Set based statements must set it themselves.
+    """
+    changed = [obj for obj in session.new if isinstance(obj, (Route, User))]
+    changed += [
+        obj for obj in session.dirty
+        if isinstance(obj, (Route, User)) and session.is_modified(obj, include_collections=False)
+        ]
+    if not changed:
+        return
+    seq = change_seq(session)
+    for obj in changed:
+        obj.changeSeq = seq
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _forget_change_seq(session):
+    session.info.pop("change_seq", None)
+
+
+def delete_user(user_id, chunk_size=1000, progress=None):
+    """
+    Delete a user and all their routes with set based statements. The routes
+    are deleted in chunks, committing after each, so that the write lock is
+    released between them and other writers are not blocked for long. The
+    leaderboard entries and idempotency keys of the user go with the user.
+    Returns the number of deleted routes.
+    : param callable progress: called with the number of routes deleted so
+    far after each chunk
+    """
+    deleted = 0
+    for model in (Route, ArchivedRoute):
+        while True:
+            chunk = db.session.query(model.id).filter(model.userId == user_id).limit(chunk_size)
+            count = model.query.filter(model.id.in_(chunk)).delete(synchronize_session=False)
+            db.session.commit()
+            if count == 0:
+                break
+            deleted += count
+            if progress is not None:
+                progress(deleted)
+
+    # one tombstone for the user stands for all of their routes
+    seq = change_seq()
+    db.session.add(Tombstone(entity="user", entityId=user_id, userId=user_id, changeSeq=seq))
+    for model in (LeaderboardEntry, IdempotencyKey):
+        model.query.filter_by(userId=user_id).delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+    routes_changed(user_id, {"op": "delete-user", "seq": seq})
+    return deleted
+
+
+# indexes of earlier versions that other indexes replace
+DROPPED_INDEXES = ("ix_route_user_location", "ix_route_user_discipline", "ix_route_user_grade")
+# tables of short lived data, created again instead of altered when their
+# columns have changed
+RECREATED_TABLES = ("idempotency_key",)
+
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    # datetimes are stored as text like this by the SQLite dialect
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def upgrade_db():
+    """
+    Bring a database created by an earlier version up to the models: missing
+    columns are added to the existing tables, with their default filled in
+    for the existing rows (changeSeq 0, written before the first change),
+    missing tables and indexes are created and replaced indexes dropped.
+    Returns the list of the changes made.
+    """
+    done = []
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        existing = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = dict((column["name"], column) for column in inspector.get_columns(table.name))
+            if table.name in RECREATED_TABLES and any(
+                    column.name not in columns or columns[column.name]["nullable"] != column.nullable
+                    for column in table.columns):
+                table.drop(connection)
+                done.append("dropped table {}".format(table.name))
+                continue
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                    connection.dialect.identifier_preparer.format_table(table),
+                    connection.dialect.identifier_preparer.format_column(column),
+                    column.type.compile(connection.dialect)
+                    )
+                if column.default is not None and column.default.is_scalar:
+                    ddl += " NOT NULL DEFAULT " + _sql_literal(column.default.arg)
+                elif column.default is not None and column.default.is_callable:
+                    # the value at the upgrade for the existing rows
+                    ddl += " NOT NULL DEFAULT " + _sql_literal(column.default.arg(None))
+                elif not column.nullable:
+                    raise ValueError("No default for the new column {}.{}".format(table.name, column.name))
+                connection.exec_driver_sql(ddl)
+                done.append("added column {}.{}".format(table.name, column.name))
+            indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+            for name in DROPPED_INDEXES:
+                if name in indexes:
+                    connection.exec_driver_sql("DROP INDEX {}".format(name))
+                    done.append("dropped index {}".format(name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    done.append("created index {}".format(index.name))
+    created = set(db.metadata.tables) - set(inspect(db.engine).get_table_names())
+    db.create_all()
+    done.extend("created table {}".format(name) for name in sorted(created))
+    return done
+
+
 # to initialize the database
 @click.command("init-db")
+@click.option("--upgrade", is_flag=True, help="upgrade a database created by an earlier version")
 @with_appcontext
 # we exclude this section from testing, since they are only used to populate the DB
-def init_db_command():  # pragma: no cover
+def init_db_command(upgrade):  # pragma: no cover
+    if upgrade:
+        for change in upgrade_db():
+            print(change)
+        print("Database upgraded.")
+        return
     db.create_all()
     print("Database initialized.")
 
+
+@click.command("prune-tombstones")
+@click.option("--days", type=int, default=None, help="keep the tombstones of this many days")
+@with_appcontext
+def prune_tombstones_command(days):  # pragma: no cover
+    """
+    Delete the tombstones older than the retention window.
+    """
+    days = current_app.config["TOMBSTONE_RETENTION_DAYS"] if days is None else days
+    count = prune_tombstones(datetime.utcnow() - timedelta(days=days))
+    print("{} tombstones pruned".format(count))
+
 # to populate the database for testing with users that have several climbs etc.
 # NOTE:
 # modified from the models.py of the pwp-course-sensorhub-api-example
@@ -0,0 +1,433 @@
+import atexit
+import cProfile
+import glob
+import hashlib
+import hmac
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from functools import wraps
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import with_appcontext
+from routetracker.instrumentation import resource_name
+
+
+"""
+On-demand profiling of single API requests. A request carrying a valid
+X-Profile-Request header runs its resource method under cProfile, and the
+pstats output is saved to PROFILE_DIR together with a JSON file describing
+the request. The header value is an expiry time and an HMAC of the request
+path and the expiry signed with the SECRET_KEY of the app, see "flask
+profiles sign". It is only honored when PROFILE_REQUESTS is enabled in the
+config, and never with the default "dev" SECRET_KEY.
+
+"flask profiles list" lists the captured profiles and "flask profiles
+callgrind" converts one to the callgrind format.
+
+For always-on profiling, SAMPLING_PROFILER starts a background thread that
+periodically samples the stacks of the threads serving requests. The samples
+are aggregated per resource method and flushed to SAMPLING_DIR, from where
+"flask profiles flamegraph" exports them as collapsed stacks for flamegraph
+tools.
+"""
+
+PROFILE_HEADER = "X-Profile-Request"
+# the SECRET_KEY of create_app, anyone can sign tokens with it
+DEFAULT_SECRET_KEY = "dev"
+
+
+def sign_path(path, secret_key, expires):
+    """
+    Token that allows profiling requests to the given path until the expires
+    unix timestamp
+    """
+    message = "{}\n{}".format(path, int(expires))
+    digest = hmac.new(secret_key.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+    return "{}.{}".format(int(expires), digest)
+
+
+def profile_dir(app):
+    """
+    directory where the captured profiles are saved
+    """
+    return app.config.get("PROFILE_DIR") or os.path.join(app.instance_path, "profiles")
+
+
+def _profiling_requested():
+    if not has_request_context() or not current_app.config.get("PROFILE_REQUESTS"):
+        return False
+    secret_key = current_app.config["SECRET_KEY"]
+    if secret_key == DEFAULT_SECRET_KEY:
+        return False
+    token = request.headers.get(PROFILE_HEADER)
+    if not token:
+        return False
+    try:
+        expires = int(token.split(".", 1)[0])
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(token, sign_path(request.path, secret_key, expires))
+
+
+def _save_profile(profiler, duration):
+    """
+    Save the stats and the description of the current request, returns the
+    name of the profile.
+    """
+    directory = profile_dir(current_app)
+    os.makedirs(directory, exist_ok=True)
+    name = "{}-{}-{}".format(
+                datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f"),
+                request.endpoint,
+                request.method.lower()
+                )
+    profiler.dump_stats(os.path.join(directory, name + ".prof"))
+    with open(os.path.join(directory, name + ".json"), "w") as handle:
+        json.dump({
+            "endpoint": request.endpoint,
+            "method": request.method,
+            "path": request.path,
+            "view_args": request.view_args,
+            "args": request.args.to_dict(flat=False),
+            "duration": duration,
+            "time": datetime.now(timezone.utc).isoformat(),
+        }, handle, indent=2)
+    return name
+
+
+def profiled_resource(view):
+    """
+    Decorator for the Flask-RESTful resource views, runs the view under
+    cProfile when the request asks for it with a valid signed header.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _profiling_requested():
+            return view(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            profiler.disable()
+            g.profile_name = _save_profile(profiler, time.perf_counter() - start)
+    return wrapper
+
+
+def _add_profile_header(response):
+    name = g.get("profile_name")
+    if name is not None:
+        response.headers["X-Profile-Id"] = name
+    return response
+
+
+def list_profiles(app):
+    """
+    Descriptions of the captured profiles, newest first. Each is the saved
+    JSON description with the name and path of the stats file added.
+    """
+    directory = profile_dir(app)
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if not filename.endswith(".json"):
+            continue
+        name = filename[:-len(".json")]
+        with open(os.path.join(directory, filename)) as handle:
+            profile = json.load(handle)
+        profile["name"] = name
+        profile["stats"] = os.path.join(directory, name + ".prof")
+        profiles.append(profile)
+    return profiles
+
+
+def _callgrind_name(func):
+    filename, line, name = func
+    return "{}:{}".format(name, line), filename
+
+
+def write_callgrind(stats_file, out):
+    """
+    Convert a saved pstats file to the callgrind format read by e.g.
+    KCachegrind. Costs are in microseconds.
+    : param file out: open text file to write to
+    """
+    stats = pstats.Stats(stats_file).stats
+    # pstats only knows the callers of each function, callgrind wants callees
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((func, caller_stats))
+
+    out.write("events: Microseconds\n")
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        name, filename = _callgrind_name(func)
+        out.write("\nfl={}\nfn={}\n".format(filename, name))
+        out.write("{} {}\n".format(func[1], int(tt * 1e6)))
+        for callee, (c_cc, c_nc, c_tt, c_ct) in callees.get(func, []):
+            callee_name, callee_file = _callgrind_name(callee)
+            out.write("cfl={}\ncfn={}\n".format(callee_file, callee_name))
+            out.write("calls={} {}\n".format(c_nc, callee[1]))
+            out.write("{} {}\n".format(func[1], int(c_ct * 1e6)))
+
+
+def _frame_label(frame):
+    """
+    "function (path/to/file.py)" with the path shortened to start from the
+    site-packages or the routetracker package directory
+    """
+    filename = frame.f_code.co_filename
+    index = filename.rfind("site-packages" + os.sep)
+    if index >= 0:
+        filename = filename[index + len("site-packages") + 1:]
+    else:
+        index = filename.rfind(os.sep + "routetracker" + os.sep)
+        if index >= 0:
+            filename = filename[index + 1:]
+    return "{} ({})".format(frame.f_code.co_name, filename)
+
+
+def collapse_stack(frame):
+    """
+    A stack in collapsed format, outermost frame first and separated by ";"
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class SamplingProfiler(object):
+    """
+    Background thread sampling the stacks of the threads that are serving
+    requests. Sample counts are kept per resource method and collapsed stack.
+    : param float interval: seconds between samples
+    : param str directory: where the samples are flushed
+    : param float flush_interval: seconds between flushes
+    """
+
+    def __init__(self, interval=0.01, directory=None, flush_interval=60.0):
+        self.interval = interval
+        self.directory = directory
+        self.flush_interval = flush_interval
+        # thread ident -> resource method being served
+        self.active = {}
+        # resource method -> Counter of collapsed stacks
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enter(self, resource):
+        """
+        mark the calling thread as serving a request
+        """
+        self.active[threading.get_ident()] = resource
+
+    def leave(self):
+        """
+        the calling thread is done with its request
+        """
+        self.active.pop(threading.get_ident(), None)
+
+    def sample(self):
+        """
+        take one sample of all active request threads
+        """
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, resource in list(self.active.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                self.samples.setdefault(resource, Counter())[collapse_stack(frame)] += 1
+
+    def flush(self):
+        """
+        Write the samples collected so far to the directory, one file per
+        process so that several workers can share it.
+        """
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            data = dict((resource, dict(stacks)) for resource, stacks in self.samples.items())
+        path = os.path.join(self.directory, "samples-{}.json".format(os.getpid()))
+        with open(path + ".tmp", "w") as handle:
+            json.dump(data, handle)
+        os.replace(path + ".tmp", path)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+        self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+def load_samples(directory):
+    """
+    Samples flushed by all processes to the directory, merged to
+    {resource method: Counter of collapsed stacks}
+    """
+    merged = {}
+    for path in glob.glob(os.path.join(directory, "samples-*.json")):
+        with open(path) as handle:
+            for resource, stacks in json.load(handle).items():
+                merged.setdefault(resource, Counter()).update(stacks)
+    return merged
+
+
+def write_collapsed(stacks, out):
+    """
+    Write a Counter of collapsed stacks in the format read by flamegraph.pl,
+    speedscope and similar tools.
+    """
+    for stack, count in sorted(stacks.items()):
+        out.write("{} {}\n".format(stack, count))
+
+
+def sampling_dir(app):
+    """
+    directory where the sampling profiler flushes its samples
+    """
+    return app.config.get("SAMPLING_DIR") or os.path.join(app.instance_path, "samples")
+
+
+@click.group("profiles")
+def profiles_command():
+    """
+    Captured request profiles.
+    """
+
+
+@profiles_command.command("list")
+@with_appcontext
+def list_profiles_command():  # pragma: no cover
+    """
+    List the captured profiles, newest first.
+    """
+    for profile in list_profiles(current_app):
+        print("{}  {:.1f} ms  {} {}  {}".format(
+            profile["name"], profile["duration"] * 1000, profile["method"], profile["path"],
+            json.dumps(profile["args"]) if profile["args"] else ""
+            ))
+        print("    " + profile["stats"])
+
+
+@profiles_command.command("callgrind")
+@click.argument("name")
+@with_appcontext
+def callgrind_command(name):  # pragma: no cover
+    """
+    Convert a captured profile to callgrind format.
+    """
+    stats_file = os.path.join(profile_dir(current_app), name + ".prof")
+    output = os.path.join(profile_dir(current_app), "callgrind.out." + name)
+    with open(output, "w") as handle:
+        write_callgrind(stats_file, handle)
+    print(output)
+
+
+@profiles_command.command("flamegraph")
+@click.option("--resource", help="only export this resource method, e.g. RouteCollection.get")
+@click.option("--output", default=".", help="directory for the .folded files")
+@with_appcontext
+def flamegraph_command(resource, output):  # pragma: no cover
+    """
+    Export the sampled stacks as collapsed stack files, one per resource
+    method, and one for all of them together.
+    """
+    samples = load_samples(sampling_dir(current_app))
+    everything = Counter()
+    for name, stacks in samples.items():
+        # prefix with the resource so that the combined graph splits by it
+        everything.update(dict((name + ";" + stack, count) for stack, count in stacks.items()))
+        if resource is not None and name != resource:
+            continue
+        path = os.path.join(output, name + ".folded")
+        with open(path, "w") as handle:
+            write_collapsed(stacks, handle)
+        print(path)
+    if resource is None:
+        path = os.path.join(output, "all.folded")
+        with open(path, "w") as handle:
+            write_collapsed(everything, handle)
+        print(path)
+
+
+@profiles_command.command("sign")
+@click.argument("path")
+@click.option("--minutes", type=int, default=60, help="minutes the header is valid for")
+@with_appcontext
+def sign_command(path, minutes):  # pragma: no cover
+    """
+    Print the header that allows profiling requests to PATH.
+    """
+    if current_app.config["SECRET_KEY"] == DEFAULT_SECRET_KEY:
+        raise click.ClickException("Set a SECRET_KEY in the instance config.py first.")
+    expires = time.time() + minutes * 60
+    print("{}: {}".format(PROFILE_HEADER, sign_path(path, current_app.config["SECRET_KEY"], expires)))
+
+
+def init_app(app):
+    """
+    Register the profile response header and the CLI commands, and start
+    the sampling profiler if SAMPLING_PROFILER is enabled. Returns the
+    sampling profiler or None.
+    """
+    app.config.setdefault("PROFILE_REQUESTS", False)
+    app.config.setdefault("SAMPLING_PROFILER", False)
+    app.config.setdefault("SAMPLING_INTERVAL", 0.01)
+    app.config.setdefault("SAMPLING_FLUSH_INTERVAL", 60.0)
+    if app.config["PROFILE_REQUESTS"] and app.config["SECRET_KEY"] == DEFAULT_SECRET_KEY:
+        raise ValueError("PROFILE_REQUESTS can not be enabled with the default SECRET_KEY")
+    app.after_request(_add_profile_header)
+    app.cli.add_command(profiles_command)
+
+    if not app.config["SAMPLING_PROFILER"]:
+        return None
+
+    profiler = SamplingProfiler(
+                    app.config["SAMPLING_INTERVAL"],
+                    sampling_dir(app),
+                    app.config["SAMPLING_FLUSH_INTERVAL"]
+                    )
+    app.extensions["routetracker_sampler"] = profiler
+
+    @app.before_request
+    def _enter_sampling():
+        profiler.enter(resource_name())
+
+    @app.teardown_request
+    def _leave_sampling(exc):
+        profiler.leave()
+
+    profiler.start()
+    return profiler
@@ -0,0 +1,107 @@
+import re
+import sys
+import click
+from flask import current_app, url_for
+from flask.cli import with_appcontext
+from routetracker import db
+from routetracker.instrumentation import explain_query_plan, recorded_queries
+from routetracker.models import Route
+
+
+"""
+Check of the query plans of the API. Every GET resource of the API is
+requested against a seeded database, and each statement they issue is run
+through SQLite's EXPLAIN QUERY PLAN to find full table scans, which point to
+missing indexes.
+"""
+
+
+# endpoints that are not requested, event streams never finish
+SKIPPED_ENDPOINTS = ("api.routestream",)
+
+
+def is_full_scan(detail, table):
+    """
+    True if a query plan detail is a full scan of the table (or an alias of
+    it). Scans of an index are not counted.
+    """
+    pattern = r"^SCAN (TABLE )?{}(_\d+)?( AS \w+)?$".format(re.escape(table))
+    return re.match(pattern, detail) is not None
+
+
+def _example_urls(app):
+    """
+    URLs of all GET resources of the API, filled in with the ids of the
+    first route in the database
+    """
+    route = Route.query.first()
+    if route is None:
+        raise ValueError("The database has no routes, populate it first (e.g. flask testgen).")
+    values = {
+        "user": route.userId,
+        "route": route.id,
+        "location": route.locationId,
+        "discipline": route.disciplineId,
+        "grade": route.gradeId,
+        "board": "disciplines",
+        "item": route.disciplineId,
+        "kind": "locations",
+    }
+
+    urls = []
+    with app.test_request_context():
+        for rule in app.url_map.iter_rules():
+            if not rule.endpoint.startswith("api.") or "GET" not in rule.methods:
+                continue
+            if rule.endpoint in SKIPPED_ENDPOINTS:
+                continue
+            if not rule.arguments <= set(values):
+                continue
+            urls.append(url_for(rule.endpoint, **dict((arg, values[arg]) for arg in rule.arguments)))
+    return sorted(urls)
+
+
+def check_query_plans(app, table="route"):
+    """
+    Request every GET resource and collect the statements that scan the
+    whole table. Must be called inside an app context.
+    Returns a list of dicts with the url, statement and query plan.
+    """
+    client = app.test_client()
+    findings = []
+    for url in _example_urls(app):
+        with recorded_queries() as recorder:
+            client.get(url)
+
+        connection = db.engine.raw_connection()
+        try:
+            for statement, parameters in zip(recorder.statements, recorder.parameters):
+                # executemany statements have a list of parameter sets, they
+                # all have the same plan
+                if isinstance(parameters, list):
+                    parameters = parameters[0]
+                plan = explain_query_plan(connection, statement, parameters)
+                if any(is_full_scan(detail, table) for detail in plan):
+                    findings.append({"url": url, "statement": statement, "plan": plan})
+        finally:
+            connection.close()
+    return findings
+
+
+@click.command("check-query-plans")
+@click.option("--table", default="route", help="table that must not be scanned")
+@with_appcontext
+def check_query_plans_command(table):  # pragma: no cover
+    """
+    Flag full table scans in the queries of the API resources.
+    """
+    findings = check_query_plans(current_app, table)
+    for finding in findings:
+        print("GET {}".format(finding["url"]))
+        print(finding["statement"])
+        for detail in finding["plan"]:
+            print("  " + detail)
+        print()
+    print("{} statements scan the {} table".format(len(findings), table))
+    if findings:
+        sys.exit(1)
@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+from routetracker import db
+from routetracker.events import on_routes_changed
+from routetracker.metrics import cache_hit, cache_miss
+from routetracker.models import Route
+
+
+"""
+The latest routes of all users, kept in a fixed-size ring buffer so that the
+recent activity resource does not query the route table on every request.
+The buffer is warmed with one ORDER BY date DESC, id DESC LIMIT query at
+startup, new routes are added to it when they are written, and any other
+write to the routes makes it stale so that it is warmed again on the next
+read.
+
+The buffer only sees the writes of its own process, with several server
+processes the others are seen when it is warmed again.
+"""
+
+
+def _sort_key(entry):
+    return entry["date"], entry["route"]
+
+
+class RouteRingBuffer(object):
+    """
+    Ring buffer of the newest routes by date and id, newest first
+    : param int size: routes kept
+    """
+
+    def __init__(self, size=50):
+        self.size = size
+        self._entries = deque(maxlen=size)
+        self._stale = True
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self):
+        return self._stale
+
+    def entries(self):
+        """
+        copy of the routes, or None if the buffer has to be warmed first
+        """
+        with self._lock:
+            if self._stale:
+                return None
+            return list(self._entries)
+
+    def warm(self, entries):
+        """
+        replace the routes with the newest ones read from the database
+        """
+        with self._lock:
+            self._entries.clear()
+            self._entries.extend(sorted(entries, key=_sort_key, reverse=True)[:self.size])
+            self._stale = False
+
+    def add(self, entries):
+        """
+        add new routes, in order of date, dropping the oldest ones
+        """
+        with self._lock:
+            for entry in entries:
+                key = _sort_key(entry)
+                if len(self._entries) == self.size:
+                    if key <= _sort_key(self._entries[-1]):
+                        continue
+                    self._entries.pop()
+                position = 0
+                while position < len(self._entries) and _sort_key(self._entries[position]) > key:
+                    position += 1
+                self._entries.insert(position, entry)
+
+    def invalidate(self):
+        with self._lock:
+            self._stale = True
+
+
+def _entry(db_route):
+    return {
+        "route": db_route.id,
+        "user": db_route.userId,
+        "date": db_route.date.isoformat(),
+        "location": db_route.location.name,
+        "discipline": db_route.discipline.name,
+        "grade": db_route.grade.name
+    }
+
+
+def _load(*criteria, **kwargs):
+    """
+    newest routes matching the criteria with their location, discipline and
+    grade, read in order from the date index
+    """
+    query = Route.query.filter(*criteria).options(
+                joinedload(Route.location),
+                joinedload(Route.discipline),
+                joinedload(Route.grade)
+                ).order_by(Route.date.desc(), Route.id.desc())
+    if "limit" in kwargs:
+        query = query.limit(kwargs["limit"])
+    return [_entry(db_route) for db_route in query]
+
+
+def recent_routes():
+    """
+    The newest routes of all users from the buffer of the current app,
+    warming it first if needed
+    """
+    buffer = current_app.extensions["routetracker_recent"]
+    entries = buffer.entries()
+    if entries is not None:
+        cache_hit("recent_routes")
+        return entries
+    cache_miss("recent_routes")
+    buffer.warm(_load(limit=buffer.size))
+    return buffer.entries()
+
+
+@on_routes_changed
+def _record_changes(user, changes):
+    buffer = current_app.extensions.get("routetracker_recent")
+    if buffer is None or buffer.stale:
+        return
+    created = [change["route"] for change in changes if change.get("op") == "create" and "route" in change]
+    if len(created) < len(changes):
+        # updates and deletes may touch any route in the buffer
+        buffer.invalidate()
+        return
+    buffer.add(_load(Route.id.in_(created)))
+
+
+def init_app(app):
+    """
+    Create the buffer of the app and warm it if the database exists
+    """
+    app.config.setdefault("RECENT_ROUTES_SIZE", 50)
+    buffer = RouteRingBuffer(app.config["RECENT_ROUTES_SIZE"])
+    app.extensions["routetracker_recent"] = buffer
+    with app.app_context():
+        if inspect(db.engine).has_table(Route.__tablename__):
+            buffer.warm(_load(limit=buffer.size))
+    return buffer
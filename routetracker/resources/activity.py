@@ -0,0 +1,336 @@
+from datetime import datetime
+from flask import request, url_for
+from flask_restful import Resource
+from sqlalchemy import and_, func, or_, tuple_
+from sqlalchemy.orm import joinedload
+from routetracker.models import Route, Location, Discipline, Grade
+from routetracker import db
+from routetracker.recent import recent_routes
+from routetracker.resources.route import route_filters
+from routetracker.utils import RouteBuilder, create_response, create_error_response, parse_id
+from routetracker.constants import *
+
+
+"""
+This file includes the resources listing the routes of a location,
+discipline or grade across all users, e.g. everything climbed in a gym this
+week. Each request is answered with one query served by the (locationId,
+date), (disciplineId, date) and (gradeId, date) indexes of the routes. The
+latest routes of all users are served from the ring buffer of recent.py.
+"""
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# user and route ids in one multi-get
+MAX_IDS = 100
+
+
+def _parse_cursor(value):
+    """
+    (date, route id) of an after cursor, the position of the last route of
+    the previous page
+    """
+    date, route_id = value.split("_")
+    return datetime.strptime(date, "%Y-%m-%d").date(), parse_id(route_id)
+
+
+def _parse_limit():
+    """
+    The page size of the limit query parameter, raises ValueError for values
+    that are not numbers from 1 to MAX_PAGE_SIZE
+    """
+    limit = int(request.args.get("limit", PAGE_SIZE))
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(limit)
+    return limit
+
+
+def _link_args(*skipped):
+    """
+    Query parameters of the request for the links of the response, without
+    the ones named like the URL variables
+    """
+    skipped = ("item",) + skipped
+    return dict((key, value) for key, value in request.args.items() if key not in skipped)
+
+
+def _parse_ids(name):
+    """
+    Unique ids of the comma separated query parameter, raises ValueError
+    for values that are not ids
+    """
+    values = [value for value in request.args.get(name, "").split(",") if value]
+    return sorted(set(parse_id(value) for value in values))
+
+
+class ItemRoutes(Resource):
+    """
+    Base of the route listings of a location, discipline or grade: GET
+    """
+
+    # the model of the item, the name of its column in Route and its
+    # namespace
+    model = None
+    column = None
+    namespace = None
+
+    def get(self, item):
+        """
+        Get the routes of all users in the item, newest first. The routes can
+        be filtered with from and to dates and the ids of the other lookups,
+        and are paged with limit and the after cursor of the next control.
+        """
+        criteria = route_filters(required=False)
+        if not isinstance(criteria, list):
+            return criteria
+        try:
+            limit = _parse_limit()
+        except ValueError:
+            return create_error_response(
+                        400, "Invalid limit",
+                        "limit must be a number from 1 to {}".format(MAX_PAGE_SIZE)
+                        )
+        if "after" in request.args:
+            try:
+                criteria.append(tuple_(Route.date, Route.id) < _parse_cursor(request.args["after"]))
+            except ValueError:
+                return create_error_response(400, "Invalid cursor", "after must be a value of the next control.")
+
+        # the item and a page of its routes in one query, one more route is
+        # read to tell if there is a next page
+        rows = db.session.query(self.model.name, Route).outerjoin(
+                    Route, and_(getattr(Route, self.column) == self.model.id, *criteria)
+                    ).filter(self.model.id == item).options(
+                    joinedload(Route.location),
+                    joinedload(Route.discipline),
+                    joinedload(Route.grade)
+                    ).order_by(Route.date.desc(), Route.id.desc()).limit(limit + 1).all()
+        if not rows:
+            return create_error_response(
+                        404, "Not found",
+                        "No {} was found with the id {}".format(self.namespace[:-1], item)
+                        )
+        db_routes = [db_route for name, db_route in rows if db_route is not None]
+
+        args = _link_args("after")
+        body = RouteBuilder(name=rows[0][0])
+        body.add_namespace(self.namespace, LINK_RELATIONS_URL)
+        body.add_control("self", url_for(request.endpoint, item=item, **_link_args()))
+        body.add_control("profile", ROUTE_PROFILE)
+        body["items"] = []
+        for db_route in db_routes[:limit]:
+            route = RouteBuilder(
+                        date=db_route.date.isoformat(),
+                        location=db_route.location.name,
+                        discipline=db_route.discipline.name,
+                        grade=db_route.grade.name
+                        )
+            route.add_control("self", url_for("api.routeitem", user=db_route.userId, route=db_route.id))
+            route.add_control_climbed_by(db_route.userId)
+            route.add_control("profile", ROUTE_PROFILE)
+            body["items"].append(route)
+        if len(db_routes) > limit:
+            last = db_routes[limit - 1]
+            after = "{}_{}".format(last.date.isoformat(), last.id)
+            body.add_control(
+                "next",
+                href=url_for(request.endpoint, item=item, after=after, **args),
+                method="GET",
+                title="Get the next page of routes"
+                )
+        return create_response(body)
+
+
+class ItemActivity(Resource):
+    """
+    Base of the daily activity of a location, discipline or grade: GET
+    """
+
+    model = None
+    column = None
+    namespace = None
+    # endpoint of the routes of the item
+    routes_view = None
+
+    def get(self, item):
+        """
+        Get the number of routes and climbers of each day in the item, over
+        all users. The days can be limited with the from and to dates, and
+        the routes with the ids of the other lookups.
+        """
+        criteria = route_filters(required=False)
+        if not isinstance(criteria, list):
+            return criteria
+
+        # the item and the counts of each day in one query
+        rows = db.session.query(
+                    self.model.name, Route.date, func.count(Route.id), func.count(Route.userId.distinct())
+                    ).outerjoin(
+                    Route, and_(getattr(Route, self.column) == self.model.id, *criteria)
+                    ).filter(self.model.id == item).group_by(Route.date).order_by(Route.date).all()
+        if not rows:
+            return create_error_response(
+                        404, "Not found",
+                        "No {} was found with the id {}".format(self.namespace[:-1], item)
+                        )
+
+        body = RouteBuilder(name=rows[0][0])
+        body.add_namespace(self.namespace, LINK_RELATIONS_URL)
+        body.add_control("self", url_for(request.endpoint, item=item, **_link_args()))
+        body.add_control("up", url_for(self.routes_view, item=item), method="GET", title="Get the routes")
+        body["items"] = [
+            {"date": date.isoformat(), "routes": routes, "climbers": climbers}
+            for name, date, routes, climbers in rows if date is not None
+            ]
+        return create_response(body)
+
+
+class LocationRoutes(ItemRoutes):
+    model = Location
+    column = "locationId"
+    namespace = "locations"
+
+
+class DisciplineRoutes(ItemRoutes):
+    model = Discipline
+    column = "disciplineId"
+    namespace = "disciplines"
+
+
+class GradeRoutes(ItemRoutes):
+    model = Grade
+    column = "gradeId"
+    namespace = "grades"
+
+
+class LocationActivity(ItemActivity):
+    model = Location
+    column = "locationId"
+    namespace = "locations"
+    routes_view = "api.locationroutes"
+
+
+class DisciplineActivity(ItemActivity):
+    model = Discipline
+    column = "disciplineId"
+    namespace = "disciplines"
+    routes_view = "api.disciplineroutes"
+
+
+class GradeActivity(ItemActivity):
+    model = Grade
+    column = "gradeId"
+    namespace = "grades"
+    routes_view = "api.graderoutes"
+
+
+class RecentRoutes(Resource):
+    """
+    The latest routes of all users: GET
+    """
+
+    def get(self):
+        """
+        Get the newest routes logged by any user, newest first. Served from
+        memory, without querying the routes.
+        """
+        body = RouteBuilder()
+        body.add_namespace("routes", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.recentroutes"))
+        body.add_control("profile", ROUTE_PROFILE)
+        body["items"] = []
+        for entry in recent_routes():
+            route = RouteBuilder(
+                        date=entry["date"],
+                        location=entry["location"],
+                        discipline=entry["discipline"],
+                        grade=entry["grade"]
+                        )
+            route.add_control("self", url_for("api.routeitem", user=entry["user"], route=entry["route"]))
+            route.add_control_climbed_by(entry["user"])
+            route.add_control("profile", ROUTE_PROFILE)
+            body["items"].append(route)
+        return create_response(body)
+
+
+class RouteSelection(Resource):
+    """
+    Routes of several users and routes at once: GET
+    """
+
+    def get(self):
+        """
+        Get the routes of the users and the routes with the comma separated
+        ids of the users and routes query parameters, e.g. the athletes of a
+        coach with ?users=1,2,3. The routes can be filtered like the routes
+        of a location, and are answered with one query. They are ordered by
+        user and paged with limit and the after cursor of the next control.
+        """
+        try:
+            users = _parse_ids("users")
+            routes = _parse_ids("routes")
+        except ValueError:
+            return create_error_response(400, "Invalid ids", "users and routes must be comma separated ids.")
+        if not users and not routes:
+            return create_error_response(400, "Ids required", "Give the ids of users and/or routes.")
+        if len(users) + len(routes) > MAX_IDS:
+            return create_error_response(
+                        400, "Too many ids",
+                        "At most {} users and routes can be requested at once".format(MAX_IDS)
+                        )
+        criteria = route_filters(required=False)
+        if not isinstance(criteria, list):
+            return criteria
+        try:
+            limit = _parse_limit()
+        except ValueError:
+            return create_error_response(
+                        400, "Invalid limit",
+                        "limit must be a number from 1 to {}".format(MAX_PAGE_SIZE)
+                        )
+        if "after" in request.args:
+            try:
+                user_id, route_id = request.args["after"].split("_")
+                criteria.append(tuple_(Route.userId, Route.id) > (parse_id(user_id), parse_id(route_id)))
+            except ValueError:
+                return create_error_response(400, "Invalid cursor", "after must be a value of the next control.")
+
+        selected = []
+        if users:
+            selected.append(Route.userId.in_(users))
+        if routes:
+            selected.append(Route.id.in_(routes))
+        db_routes = Route.query.filter(or_(*selected), *criteria).options(
+                    joinedload(Route.location),
+                    joinedload(Route.discipline),
+                    joinedload(Route.grade)
+                    ).order_by(Route.userId, Route.id).limit(limit + 1).all()
+
+        body = RouteBuilder()
+        body.add_namespace("routes", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.routeselection", **_link_args()))
+        body.add_control("profile", ROUTE_PROFILE)
+        body["items"] = []
+        for db_route in db_routes[:limit]:
+            route = RouteBuilder(
+                        date=db_route.date.isoformat(),
+                        location=db_route.location.name,
+                        discipline=db_route.discipline.name,
+                        grade=db_route.grade.name,
+                        extraInfo=db_route.extraInfo
+                        )
+            route.add_control("self", url_for("api.routeitem", user=db_route.userId, route=db_route.id))
+            route.add_control_climbed_by(db_route.userId)
+            route.add_control("profile", ROUTE_PROFILE)
+            body["items"].append(route)
+        if len(db_routes) > limit:
+            last = db_routes[limit - 1]
+            body.add_control(
+                "next",
+                href=url_for(
+                    "api.routeselection", after="{}_{}".format(last.userId, last.id), **_link_args("after")
+                    ),
+                method="GET",
+                title="Get the next page of routes"
+                )
+        return create_response(body)
@@ -0,0 +1,45 @@
+from flask import url_for
+from flask_restful import Resource
+from routetracker import analytics
+from routetracker.utils import RouteBuilder, create_response, create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the training load analytics resource of the API
+"""
+
+class TrainingLoad(Resource):
+    """
+    Training load resource: GET
+    """
+
+    def get(self, user):
+        """
+        Get the weekly volume, intensity, load and acute:chronic workload
+        ratio of the routes of user, and the progression of their highest
+        grade by discipline
+        """
+        if not analytics.available():
+            return create_error_response(
+                        501, "Not implemented",
+                        "Analytics need the numpy package"
+                        )
+
+        result = analytics.user_training_load(user)
+        if result is None:
+            return create_error_response(
+                        404, "Not found",
+                        "User not found"
+                        )
+
+        body = RouteBuilder(
+                    weeks=result["weeks"],
+                    progression=result["progression"]
+                    )
+        body.add_namespace("routes", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.trainingload", user=user))
+        body.add_control("profile", ANALYTICS_PROFILE)
+        body.add_control_climbed_by(user)
+        body.add_control_routes_all(user)
+        return create_response(body)
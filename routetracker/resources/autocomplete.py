@@ -0,0 +1,49 @@
+from flask import request, url_for
+from flask_restful import Resource
+from routetracker.autocomplete import KINDS, MAX_SUGGESTIONS, suggest
+from routetracker.utils import RouteBuilder, create_response, create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the autocompletion resource of location, discipline and
+grade names
+"""
+
+
+class NameSuggestions(Resource):
+    """
+    Name suggestions of locations, disciplines or grades: GET
+    """
+
+    def get(self, kind):
+        """
+        Get the most used names starting with the prefix query parameter,
+        at most limit of them. Served from memory.
+        """
+        if kind not in KINDS:
+            return create_error_response(
+                        404, "Not found",
+                        "Names can be suggested for: {}".format(", ".join(sorted(KINDS)))
+                        )
+        try:
+            limit = int(request.args.get("limit", MAX_SUGGESTIONS))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= MAX_SUGGESTIONS:
+            return create_error_response(
+                        400, "Invalid limit",
+                        "limit must be a number from 1 to {}".format(MAX_SUGGESTIONS)
+                        )
+
+        body = RouteBuilder()
+        body.add_namespace(kind, LINK_RELATIONS_URL)
+        # only the parameters of the resource, kind is a URL variable
+        args = dict((key, request.args[key]) for key in ("prefix", "limit") if key in request.args)
+        body.add_control("self", url_for("api.namesuggestions", kind=kind, **args))
+        body["items"] = []
+        for item_id, name, routes in suggest(kind, request.args.get("prefix", ""), limit):
+            item = RouteBuilder(name=name, routes=routes)
+            item.add_control("self", url_for("api.{}routes".format(kind[:-1]), item=item_id))
+            body["items"].append(item)
+        return create_response(body)
@@ -0,0 +1,195 @@
+import json
+import logging
+from jsonschema import validate, ValidationError
+from flask import current_app, request, url_for
+from flask_restful import Resource
+from sqlalchemy.orm import Session
+from werkzeug.exceptions import HTTPException
+from routetracker import db
+from routetracker.events import deferred_changes
+from routetracker.instrumentation import nested_request
+from routetracker.jobs import deferred_jobs
+from routetracker.utils import RouteBuilder, create_response, create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the batch resource of the API, which runs several API
+requests in one HTTP request
+"""
+
+logger = logging.getLogger("routetracker.batch")
+
+# response headers that only make sense for the sub-request itself
+SKIPPED_HEADERS = ("Content-Type", "Content-Length")
+# API resources that can not be part of a batch: batches do not nest, and
+# event streams never end
+EXCLUDED_ENDPOINTS = ("api.batch", "api.routestream")
+
+
+class Batch(Resource):
+    """
+    Batch resource: POST
+    """
+
+    @staticmethod
+    def get_schema():
+        """
+        schema for batch documents, a list of requests to run in order
+        """
+        schema = {
+            "type": "object",
+            "required": ["requests"]
+        }
+        props = schema["properties"] = {}
+        props["requests"] = {
+            "description": "requests to run in order",
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["method", "href"],
+                "properties": {
+                    "method": {
+                        "description": "HTTP method of the request",
+                        "type": "string",
+                        "enum": ["GET", "POST", "PUT", "PATCH", "DELETE"]
+                    },
+                    "href": {
+                        "description": "URL of an API resource, may include a query string",
+                        "type": "string"
+                    },
+                    "headers": {
+                        "description": "additional request headers",
+                        "type": "object",
+                        "additionalProperties": {"type": "string"}
+                    },
+                    "body": {
+                        "description": "JSON body of the request"
+                    }
+                }
+            }
+        }
+        return schema
+
+    def post(self):
+        """
+        Run the requests of the batch in this process, each in a SAVEPOINT
+        of one transaction. All writes are committed together at the end. The
+        first request that fails rolls back the batch, and the requests after
+        it are not run. Listeners and background jobs only hear of the writes
+        once they are committed.
+        """
+        # request.json itself answers 415 to bodies that are not JSON
+        if not isinstance(request.json, dict):
+            return create_error_response(
+                        400, "Invalid JSON document",
+                        "Requests must be JSON objects"
+                        )
+        try:
+            validate(request.json, self.get_schema())
+        except ValidationError as err:
+            return create_error_response(400, "Invalid JSON document", str(err))
+
+        sub_requests = request.json["requests"]
+        limit = current_app.config.get("BATCH_MAX_REQUESTS", 20)
+        if len(sub_requests) > limit:
+            return create_error_response(
+                        400, "Batch too large",
+                        "A batch can have at most {} requests".format(limit)
+                        )
+
+        writes = any(sub["method"] != "GET" for sub in sub_requests)
+        responses = []
+        with deferred_changes() as changed, deferred_jobs() as submitted:
+            with db.engine.connect() as connection:
+                transaction = connection.begin()
+                if connection.dialect.name == "sqlite":
+                    # pysqlite does not begin a transaction before a
+                    # SAVEPOINT, releasing the first one would commit
+                    connection.exec_driver_sql("BEGIN")
+                # the session of the sub-requests joins the transaction of the
+                # batch, the commits and rollbacks of the resources only
+                # release or roll back a SAVEPOINT of their own
+                session = Session(bind=connection, join_transaction_mode="create_savepoint")
+                previous = db.session.registry() if db.session.registry.has() else None
+                db.session.registry.set(session)
+                try:
+                    failed = False
+                    for sub in sub_requests:
+                        if failed:
+                            responses.append(_sub_response(create_error_response(
+                                424, "Failed dependency",
+                                "Not run, an earlier request of the batch failed"
+                                )))
+                            continue
+                        response = _run(sub)
+                        if response["status"] >= 400:
+                            session.rollback()
+                            failed = True
+                        else:
+                            session.commit()
+                        responses.append(response)
+                    if writes and not failed:
+                        transaction.commit()
+                    else:
+                        transaction.rollback()
+                        # nothing happened for the listeners and job workers
+                        changed.clear()
+                        del submitted[:]
+                finally:
+                    session.close()
+                    if previous is not None:
+                        db.session.registry.set(previous)
+                    else:
+                        db.session.registry.clear()
+
+        body = RouteBuilder(
+                    committed=writes and not failed,
+                    responses=responses
+                    )
+        body.add_control("self", url_for("api.batch"))
+        body.add_control("profile", BATCH_PROFILE)
+        return create_response(body)
+
+
+def _run(sub):
+    """
+    Run one request of the batch in its own request context, and return its
+    status, headers and decoded body
+    """
+    headers = dict(sub.get("headers", {}))
+    # the bodies are embedded in the batch document, so they are always JSON
+    headers["Accept"] = MASON
+    kwargs = {"method": sub["method"], "headers": headers}
+    if "body" in sub:
+        kwargs["json"] = sub["body"]
+
+    with current_app.test_request_context(sub["href"], **kwargs), nested_request():
+        try:
+            if request.url_rule is not None and (
+                    not request.url_rule.endpoint.startswith("api.")
+                    or request.url_rule.endpoint in EXCLUDED_ENDPOINTS):
+                response = create_error_response(
+                                400, "Not allowed in batch",
+                                "Only API resources other than batches and event streams can be requested in a batch"
+                                )
+            else:
+                response = current_app.make_response(current_app.dispatch_request())
+        except HTTPException as err:
+            response = create_error_response(err.code, err.name, err.description)
+        except Exception:
+            # the whole batch is rolled back, like a failed request
+            logger.exception("batch request %s %s failed", sub["method"], sub["href"])
+            response = create_error_response(500, "Internal server error", "The request failed.")
+    return _sub_response(response)
+
+
+def _sub_response(response):
+    """
+    status, headers and decoded body of a response for the batch document
+    """
+    return {
+        "status": response.status_code,
+        "headers": dict((key, value) for key, value in response.headers.items() if key not in SKIPPED_HEADERS),
+        "body": json.loads(response.get_data()) if response.is_json else None
+    }
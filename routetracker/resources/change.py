@@ -0,0 +1,128 @@
+from flask import request, url_for
+from flask_restful import Resource
+from sqlalchemy.orm import joinedload
+from routetracker import db
+from routetracker.models import ChangeSequence, Route, User, Tombstone
+from routetracker.utils import RouteBuilder, create_response, create_error_response, parse_id
+from routetracker.constants import *
+
+
+"""
+This file includes the change feed resource of the API, which lets clients
+synchronize the routes of a user incrementally
+"""
+
+class ChangeFeed(Resource):
+    """
+    Change feed resource: GET
+    """
+
+    def get(self, user):
+        """
+        Get the routes and user information written since the sequence value
+        given in the since query parameter, and the routes deleted since then.
+        Without since, the current state of all routes is returned. The next
+        value of since is given in "next". The deletes are only kept for
+        TOMBSTONE_RETENTION_DAYS, a since older than that is answered with
+        410 and the client has to start again without since.
+        """
+        since = request.args.get("since")
+        if since is not None:
+            try:
+                since = parse_id(since, minimum=0)
+            except ValueError:
+                return create_error_response(400, "Invalid token", "since must be a value of next.")
+        # read before the changes, anything written after is in them or later
+        current, pruned = db.session.query(ChangeSequence.value, ChangeSequence.prunedSeq).filter_by(id=1).one()
+        if since is not None and since < pruned:
+            return create_error_response(
+                        410, "Resync required",
+                        "The changes since {} are no longer kept, get all changes without since.".format(since)
+                        )
+
+        changes = []
+        db_user = User.query.filter_by(id=user).first()
+        if db_user is None:
+            # a deleted user is the last change of their feed
+            tombstone = None
+            if since is not None:
+                tombstone = Tombstone.query.filter(
+                                Tombstone.entity == "user",
+                                Tombstone.userId == user,
+                                Tombstone.changeSeq > since
+                                ).first()
+            if tombstone is None:
+                return create_error_response(
+                            404, "Not found",
+                            "User not found"
+                            )
+            changes.append(_deleted_item("user", tombstone))
+            return create_response(_feed_body(user, since, changes, tombstone.changeSeq))
+
+        if since is None or db_user.changeSeq > since:
+            item = RouteBuilder(
+                        type="user",
+                        op="upsert",
+                        id=db_user.id,
+                        changeSeq=db_user.changeSeq,
+                        email=db_user.email,
+                        firstName=db_user.firstName,
+                        lastName=db_user.lastName
+                        )
+            item.add_control("self", url_for("api.useritem", user=user))
+            changes.append(item)
+
+        # both queries are served by the (userId, changeSeq) indexes
+        db_routes = Route.query.filter(Route.userId == db_user.id).options(
+                    joinedload(Route.location),
+                    joinedload(Route.discipline),
+                    joinedload(Route.grade)
+                    )
+        if since is not None:
+            db_routes = db_routes.filter(Route.changeSeq > since)
+            # only route deletes, the "archive" tombstones are left out on
+            # purpose: archived routes still exist and clients keep them
+            for tombstone in Tombstone.query.filter(
+                        Tombstone.entity == "route",
+                        Tombstone.userId == db_user.id,
+                        Tombstone.changeSeq > since):
+                changes.append(_deleted_item("route", tombstone))
+
+        for db_route in db_routes:
+            item = RouteBuilder(
+                        type="route",
+                        op="upsert",
+                        id=db_route.id,
+                        changeSeq=db_route.changeSeq,
+                        date=db_route.date.isoformat(),
+                        location=db_route.location.name,
+                        discipline=db_route.discipline.name,
+                        grade=db_route.grade.name,
+                        extraInfo=db_route.extraInfo
+                        )
+            item.add_control("self", url_for("api.routeitem", user=user, route=db_route.id))
+            changes.append(item)
+
+        # in the order they happened, a deleted id may have been used again
+        changes.sort(key=lambda item: (item["changeSeq"], item["op"] == "upsert", item["id"]))
+        # the full state covers everything written before it was read
+        latest = max([item["changeSeq"] for item in changes] + [current if since is None else since])
+        return create_response(_feed_body(user, since, changes, latest))
+
+
+def _deleted_item(entity, tombstone):
+    return RouteBuilder(
+                type=entity,
+                op="delete",
+                id=tombstone.entityId,
+                changeSeq=tombstone.changeSeq
+                )
+
+
+def _feed_body(user, since, changes, latest):
+    body = RouteBuilder(changes=changes, next=latest)
+    body.add_namespace("routes", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.changefeed", user=user, since=since))
+    body.add_control_changes(user, latest)
+    body.add_control_routes_all(user)
+    return body
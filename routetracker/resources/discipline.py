@@ -6,7 +6,9 @@ from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 from routetracker.models import Route, User, Location, Discipline, Grade
 from routetracker import db
-from routetracker.utils import RouteBuilder, create_error_response
+from routetracker.utils import (
+    RouteBuilder, build_lookup_collection, create_response, create_error_response, query_user_routes
+    )
 from routetracker.constants import *
 
 
@@ -31,25 +33,11 @@ class DisciplineCollection(Resource):
                         "User not found"
                         )
 
-        # response body with proper controls
-        body = RouteBuilder()
-        body.add_namespace("disciplines", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.disciplinecollection", user=user))
-        body.add_control_climbed_by(user)
-        body.add_control_routes_all(user)
-        body["items"] = []
-
         # get the disciplines, and only return unique values
-        for db_route in Route.query.filter_by(user=db_user).group_by(Route.disciplineId):
-            item = RouteBuilder(
-                        discipline=db_route.discipline.name
-                        )
-            item.add_control("self", url_for("api.disciplineitem", user=user, discipline=db_route.disciplineId))
-            item.add_control_discipline_routes(user, db_route.disciplineId)
-            item.add_control("profile", ROUTE_PROFILE)
-            body["items"].append(item)
+        db_disciplines = Discipline.query.join(Route).filter(Route.userId==db_user.id).distinct().order_by(Discipline.id)
+        body = build_lookup_collection(user, "discipline", db_disciplines)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
 class DisciplineItem(Resource):
     """
@@ -60,16 +48,15 @@ class DisciplineItem(Resource):
         """
         Get all routes in specific discipline for user.
         """
-        # find the approriate user with the id
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        # find the user and the routes of the user in the discipline with one query
+        db_routes = query_user_routes(user, Route.disciplineId == discipline)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
         # test if discipline is found for user
-        db_discipline = Route.query.filter(Route.user==db_user).filter(Route.disciplineId==discipline).first()
-        if db_discipline is None:
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No discipline was found with the id {}".format(discipline)
@@ -82,10 +69,11 @@ class DisciplineItem(Resource):
         body.add_control_climbed_by(user)
         body.add_control_routes_all(user)
         body.add_control_disciplines_all(user)
+        body.add_control_everyones_routes("disciplines", discipline)
         body["items"] = []
 
         # get the routes with specific discipline
-        for db_route in Route.query.filter(Route.user==db_user).filter(Route.disciplineId==discipline).all():
+        for db_route in db_routes:
             item = RouteBuilder(
                         date=db_route.date.isoformat(),
                         location=db_route.location.name,
@@ -101,4 +89,4 @@ class DisciplineItem(Resource):
             item.add_control("profile", ROUTE_PROFILE)
             body["items"].append(item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
@@ -6,7 +6,9 @@ from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 from routetracker.models import Route, User, Location, Discipline, Grade
 from routetracker import db
-from routetracker.utils import RouteBuilder, create_error_response
+from routetracker.utils import (
+    RouteBuilder, build_lookup_collection, create_response, create_error_response, query_user_routes
+    )
 from routetracker.constants import *
 
 
@@ -31,25 +33,11 @@ class GradeCollection(Resource):
                         "User not found"
                         )
 
-        # response body with proper controls
-        body = RouteBuilder()
-        body.add_namespace("grades", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.gradecollection", user=user))
-        body.add_control_climbed_by(user)
-        body.add_control_routes_all(user)
-        body["items"] = []
-
         # get the grades, and only return unique values
-        for db_route in Route.query.filter_by(user=db_user).group_by(Route.gradeId):
-            item = RouteBuilder(
-                        grade=db_route.grade.name
-                        )
-            item.add_control("self", url_for("api.gradeitem", user=user, grade=db_route.gradeId))
-            item.add_control_grade_routes(user, db_route.gradeId)
-            item.add_control("profile", ROUTE_PROFILE)
-            body["items"].append(item)
+        db_grades = Grade.query.join(Route).filter(Route.userId==db_user.id).distinct().order_by(Grade.id)
+        body = build_lookup_collection(user, "grade", db_grades)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
 
 class GradeItem(Resource):
@@ -61,16 +49,15 @@ class GradeItem(Resource):
         """
         Get all routes in specific grade for user.
         """
-        # find the approriate user with the id
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        # find the user and the routes of the user in the grade with one query
+        db_routes = query_user_routes(user, Route.gradeId == grade)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
         # test if grade is found for user
-        db_grade = Route.query.filter(Route.user==db_user).filter(Route.gradeId==grade).first()
-        if db_grade is None:
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No grade was found with the id {}".format(grade)
@@ -83,10 +70,11 @@ class GradeItem(Resource):
         body.add_control_climbed_by(user)
         body.add_control_routes_all(user)
         body.add_control_grades_all(user)
+        body.add_control_everyones_routes("grades", grade)
         body["items"] = []
 
         # get the routes with specific grade
-        for db_route in Route.query.filter(Route.user==db_user).filter(Route.gradeId==grade).all():
+        for db_route in db_routes:
             item = RouteBuilder(
                         date=db_route.date.isoformat(),
                         location=db_route.location.name,
@@ -102,4 +90,4 @@ class GradeItem(Resource):
             item.add_control("profile", ROUTE_PROFILE)
             body["items"].append(item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
@@ -0,0 +1,54 @@
+import json
+from flask import Response, request, url_for
+from flask_restful import Resource
+from routetracker.models import Job
+from routetracker import db
+from routetracker.utils import RouteBuilder, create_response, create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the classes for the background job resources of the API
+"""
+
+class JobItem(Resource):
+    """
+    Job item resource: GET
+    """
+
+    def get(self, job):
+        """
+        Get the status and progress of a background job
+        """
+        db_job = Job.query.filter_by(id=job).first()
+        if db_job is None:
+            return create_error_response(
+                        404, "Not found",
+                        "No job was found with the id {}".format(job)
+                        )
+
+        # response body with proper controls
+        body = RouteBuilder(
+                    kind=db_job.kind,
+                    status=db_job.status,
+                    progress=db_job.progress,
+                    error=db_job.error,
+                    createdAt=db_job.createdAt.isoformat(),
+                    updatedAt=db_job.updatedAt.isoformat()
+                    )
+        body.add_namespace("jobs", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.jobitem", job=job))
+        body.add_control("profile", JOB_PROFILE)
+        # the result can be followed once the job is done
+        if db_job.status == "done" and db_job.result:
+            body.add_control(
+                "jobs:result",
+                db_job.result,
+                method="GET",
+                title="Get the result of the job"
+                )
+
+        response = create_response(body)
+        if db_job.status in ("queued", "running"):
+            response.headers["Retry-After"] = "1"
+        return response
@@ -0,0 +1,126 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+from routetracker.analytics import rank_name
+from routetracker.jobs import submit_job
+from routetracker.models import User, Location, Discipline, LeaderboardEntry
+from routetracker import db
+from routetracker.utils import RouteBuilder, create_response, create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the classes for the leaderboard resources of the API
+"""
+
+# board in the URL -> (board in the leaderboard table, model of the items)
+BOARDS = {
+    "disciplines": ("discipline", Discipline),
+    "locations": ("location", Location)
+}
+# leaderboard order -> columns to order by
+ORDERS = {
+    "grade": (LeaderboardEntry.topGrade, LeaderboardEntry.routes),
+    "volume": (LeaderboardEntry.routes, LeaderboardEntry.topGrade)
+}
+MAX_LIMIT = 100
+
+
+class LeaderboardCollection(Resource):
+    """
+    Leaderboard collection resource: GET, POST
+    """
+
+    def get(self):
+        """
+        Get the leaderboards of all disciplines and locations
+        """
+        body = RouteBuilder()
+        body.add_namespace("leaderboards", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.leaderboardcollection"))
+        body.add_control_recompute_leaderboards()
+        body["items"] = []
+        for board, (entity, model) in sorted(BOARDS.items()):
+            for db_item in model.query.order_by(model.id):
+                item = RouteBuilder(board=entity, name=db_item.name)
+                item.add_control("self", url_for("api.leaderboard", board=board, item=db_item.id))
+                item.add_control("profile", LEADERBOARD_PROFILE)
+                item.add_control_leaderboard(board, db_item.id, "volume")
+                body["items"].append(item)
+        return create_response(body)
+
+    def post(self):
+        """
+        Build all leaderboards again in a background job, answers with the
+        URL of the job
+        """
+        job = submit_job("recompute-leaderboards", result=url_for("api.leaderboardcollection"))
+        return Response(status=202, headers={"Location": url_for("api.jobitem", job=job.id)})
+
+
+class Leaderboard(Resource):
+    """
+    Leaderboard resource: GET
+    """
+
+    def get(self, board, item):
+        """
+        Get the top climbers of a discipline or location, by hardest grade
+        (by=grade, the default) or by number of routes (by=volume)
+        """
+        if board not in BOARDS:
+            return create_error_response(
+                        404, "Not found",
+                        "No leaderboards of {}".format(board)
+                        )
+        entity, model = BOARDS[board]
+
+        order = request.args.get("by", "grade")
+        if order not in ORDERS:
+            return create_error_response(400, "Invalid order", "by must be grade or volume")
+        try:
+            limit = int(request.args.get("limit", 10))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= MAX_LIMIT:
+            return create_error_response(
+                        400, "Invalid limit",
+                        "limit must be a number from 1 to {}".format(MAX_LIMIT)
+                        )
+
+        db_item = model.query.filter_by(id=item).first()
+        if db_item is None:
+            return create_error_response(
+                        404, "Not found",
+                        "No {} was found with the id {}".format(entity, item)
+                        )
+
+        # read in order from the leaderboard indexes
+        rows = db.session.query(LeaderboardEntry, User).join(
+                    User, User.id == LeaderboardEntry.userId
+                    ).filter(
+                    LeaderboardEntry.board == entity,
+                    LeaderboardEntry.itemId == db_item.id
+                    ).order_by(
+                    *[column.desc() for column in ORDERS[order]]
+                    ).limit(limit)
+
+        body = RouteBuilder(board=entity, name=db_item.name, by=order)
+        body.add_namespace("leaderboards", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.leaderboard", board=board, item=item, by=order, limit=limit))
+        body.add_control("profile", LEADERBOARD_PROFILE)
+        body.add_control_leaderboards_all()
+        for other in ORDERS:
+            body.add_control_leaderboard(board, item, other)
+        body["items"] = []
+        for position, (entry, db_user) in enumerate(rows, 1):
+            row = RouteBuilder(
+                        rank=position,
+                        firstName=db_user.firstName,
+                        lastName=db_user.lastName,
+                        routes=entry.routes,
+                        topGrade=rank_name(entry.topGrade) if entry.topGrade is not None else None
+                        )
+            row.add_control("self", url_for("api.useritem", user=db_user.id))
+            row.add_control("profile", USER_PROFILE)
+            body["items"].append(row)
+        return create_response(body)
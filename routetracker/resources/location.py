@@ -6,7 +6,9 @@ from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 from routetracker.models import Route, User, Location, Discipline, Grade
 from routetracker import db
-from routetracker.utils import RouteBuilder, create_error_response
+from routetracker.utils import (
+    RouteBuilder, build_lookup_collection, create_response, create_error_response, query_user_routes
+    )
 from routetracker.constants import *
 
 
@@ -31,25 +33,11 @@ class LocationCollection(Resource):
                         "User not found"
                         )
 
-        # response body with proper controls
-        body = RouteBuilder()
-        body.add_namespace("locations", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.locationcollection", user=user))
-        body.add_control_climbed_by(user)
-        body.add_control_routes_all(user)
-        body["items"] = []
-
         # get the locations, and only return unique values
-        for db_route in Route.query.filter_by(user=db_user).group_by(Route.locationId):
-            item = RouteBuilder(
-                        location=db_route.location.name
-                        )
-            item.add_control("self", url_for("api.locationitem", user=user, location=db_route.locationId))
-            item.add_control_location_routes(user, db_route.locationId)
-            item.add_control("profile", ROUTE_PROFILE)
-            body["items"].append(item)
+        db_locations = Location.query.join(Route).filter(Route.userId==db_user.id).distinct().order_by(Location.id)
+        body = build_lookup_collection(user, "location", db_locations)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
 class LocationItem(Resource):
     """
@@ -60,16 +48,15 @@ class LocationItem(Resource):
         """
         Get all routes in specific location for user.
         """
-        # find the approriate user with the id
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        # find the user and the routes of the user in the location with one query
+        db_routes = query_user_routes(user, Route.locationId == location)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
         # test if location is found for user
-        db_location = Route.query.filter(Route.user==db_user).filter(Route.locationId==location).first()
-        if db_location is None:
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No location was found with the id {}".format(location)
@@ -82,10 +69,11 @@ class LocationItem(Resource):
         body.add_control_climbed_by(user)
         body.add_control_routes_all(user)
         body.add_control_locations_all(user)
+        body.add_control_everyones_routes("locations", location)
         body["items"] = []
 
         # get the routes in the specific location
-        for db_route in Route.query.filter(Route.user==db_user).filter(Route.locationId==location).all():
+        for db_route in db_routes:
             item = RouteBuilder(
                         date=db_route.date.isoformat(),
                         location=db_route.location.name,
@@ -101,4 +89,4 @@ class LocationItem(Resource):
             item.add_control("profile", ROUTE_PROFILE)
             body["items"].append(item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
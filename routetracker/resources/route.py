@@ -4,9 +4,16 @@ from jsonschema import validate, ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
-from routetracker.models import Route, User, Location, Discipline, Grade
+from routetracker.models import (
+    ArchivedRoute, Route, User, Location, Discipline, Grade, Tombstone, change_seq, record_route_tombstones
+    )
 from routetracker import db
-from routetracker.utils import RouteBuilder, create_error_response
+from routetracker.events import routes_changed
+from routetracker.idempotency import idempotent
+from routetracker.utils import (
+    EMBEDDABLE, RouteBuilder, build_route_collection, create_response, create_error_response,
+    embed_collections, parse_embed, parse_history, parse_id, query_archived_routes, query_user_routes
+    )
 from routetracker.constants import *
 
 
@@ -14,55 +21,79 @@ from routetracker.constants import *
 This file includes the classes for the Route model resources of the API
 """
 
+# query parameters selecting routes for the bulk operations
+FILTER_PARAMS = ("from", "to", "location", "discipline", "grade")
+
+
+def route_filters(required=True):
+    """
+    Criteria for the routes selected by the query parameters of the request:
+    from and to (dates, inclusive) and the ids of location, discipline and
+    grade. Returns a list of criteria or an error response.
+    : param bool required: at least one filter must be given
+    """
+    criteria = []
+    for key, op in (("from", "__ge__"), ("to", "__le__")):
+        if key in request.args:
+            try:
+                date = datetime.strptime(request.args[key], '%Y-%m-%d').date()
+            except ValueError:
+                return create_error_response(400, "Wrong date format", "Date was not given in YYYY-MM-DD format.")
+            criteria.append(getattr(Route.date, op)(date))
+    for key, column in (("location", Route.locationId), ("discipline", Route.disciplineId), ("grade", Route.gradeId)):
+        if key in request.args:
+            try:
+                criteria.append(column == parse_id(request.args[key]))
+            except ValueError:
+                return create_error_response(400, "Invalid filter", "{} must be an id.".format(key.capitalize()))
+    if required and not criteria:
+        return create_error_response(
+                    400, "Filter required",
+                    "Give at least one of the query parameters: {}".format(", ".join(FILTER_PARAMS))
+                    )
+    return criteria
+
+
 class RouteCollection(Resource):
     """
-    Route collection resource: GET, POST
+    Route collection resource: GET, POST, PATCH, DELETE
     """
 
     def get(self, user):
         """
-        Get all routes for user.
+        Get all routes for user. The locations, disciplines and grades of the
+        routes can be included with e.g. ?embed=locations,grades, and the
+        archived routes with ?history=full
         """
-        # find the approriate user with the id
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        try:
+            embed = parse_embed(EMBEDDABLE[1:])
+        except ValueError as err:
+            return create_error_response(400, "Invalid embed", str(err))
+        try:
+            full_history = parse_history()
+        except ValueError as err:
+            return create_error_response(400, "Invalid history", str(err))
+
+        # find the user and the routes with their location, discipline and
+        # grade in one query. functions even if there are no routes.
+        db_routes = query_user_routes(user)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
 
+        if full_history:
+            # the archived routes are read with a second query
+            db_routes = sorted(db_routes + query_archived_routes(user), key=lambda db_route: db_route.id)
+
         # response body with proper controls
-        body = RouteBuilder()
-        body.add_namespace("routes", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.routecollection", user=user))
-        body.add_control_climbed_by(user)
-        body.add_control_routes_all(user)
-        body.add_control_add_route(user)
-        body.add_control_locations_all(user)
-        body.add_control_disciplines_all(user)
-        body.add_control_grades_all(user)
-        body["items"] = []
-
-        # use user id to get the routes, and add them to list
-        # functions even if there are no routes
-        for db_route in Route.query.filter_by(user=db_user):
-            item = RouteBuilder(
-                        date=db_route.date.isoformat(),  # convert date to isoformat
-                        location=db_route.location.name,
-                        discipline=db_route.discipline.name,
-                        grade=db_route.grade.name,
-                        extraInfo=db_route.extraInfo
-                        )
-            item.add_control("self", url_for("api.routeitem", user=user, route=db_route.id))
-            item.add_control_edit_route(user, db_route.id)
-            item.add_control_delete_route(user, db_route.id)
-            item.add_control_location_routes(user, db_route.location.id)
-            item.add_control_discipline_routes(user, db_route.discipline.id)
-            item.add_control_grade_routes(user, db_route.grade.id)
-            item.add_control("profile", ROUTE_PROFILE)
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body = build_route_collection(user, db_routes, "full" if full_history else None)
+        if embed:
+            embed_collections(body, user, db_routes, embed)
+        return create_response(body)
 
+    @idempotent
     def post(self, user):
         """
         Add a new route
@@ -133,39 +164,150 @@ class RouteCollection(Resource):
                         grade=grade
                     )
 
-        # commit to db
+        # commit to db, flushing first to get the ID of the route
         db.session.add(route)
+        db.session.flush()
+        change = {"op": "create", "route": route.id, "seq": route.changeSeq}
         db.session.commit()
+        routes_changed(user_db.id, change)
 
-        # get the ID of the just commited route
-        route = route.id
+        # the ID of the just commited route
+        route = change["route"]
         return Response(status=201, headers={"Location": url_for("api.routeitem", user=user, route=route)})
 
+    def patch(self, user):
+        """
+        Edit all routes matching the filter in the query parameters with one
+        UPDATE statement, e.g. to move a mis-logged session to another
+        location. The body is a merge patch like for a single route.
+        """
+        criteria = route_filters()
+        if not isinstance(criteria, list):
+            return criteria
+        patch = request.get_json(silent=True)
+        if patch is None:
+            return create_error_response(
+                        415, "Unsupported media type",
+                        "Requests must be JSON"
+                        )
+        if not isinstance(patch, dict):
+            return create_error_response(
+                        400, "Invalid JSON document",
+                        "Requests must be JSON objects"
+                        )
+        try:
+            validate(patch, Route.get_patch_schema())
+        except ValidationError as err:
+            return create_error_response(400, "Invalid JSON document", str(err))
+
+        values = {}
+        if "date" in patch:
+            try:
+                values[Route.date] = datetime.strptime(patch["date"], '%Y-%m-%d').date()
+            except ValueError:
+                return create_error_response(400, "Wrong date format", "Date was not given in YYYY-MM-DD format.")
+        for key, model, column in (
+                    ("location", Location, Route.locationId),
+                    ("discipline", Discipline, Route.disciplineId),
+                    ("grade", Grade, Route.gradeId)):
+            if key not in patch:
+                continue
+            if patch[key] == "":
+                return create_error_response(
+                            400, "Entry can not be empty.",
+                            "{} must contain characters.".format(key.capitalize())
+                            )
+            entry = db.session.query(model).filter_by(name=patch[key]).first()
+            if not entry:
+                entry = model(name=patch[key])
+                db.session.add(entry)
+                db.session.flush()
+            values[column] = entry.id
+        if "extraInfo" in patch:
+            values[Route.extraInfo] = patch["extraInfo"]
+
+        updated = 0
+        if values:
+            values[Route.changeSeq] = change_seq()
+            updated = Route.query.filter(Route.userId == user, *criteria).update(values, synchronize_session=False)
+        if updated == 0:
+            db.session.rollback()
+            if User.query.filter_by(id=user).first() is None:
+                return create_error_response(
+                            404, "Not found",
+                            "User not found"
+                            )
+        else:
+            change = {"op": "update", "count": updated, "seq": values[Route.changeSeq]}
+            db.session.commit()
+            routes_changed(user, change)
+
+        body = RouteBuilder(updated=updated)
+        body.add_namespace("routes", LINK_RELATIONS_URL)
+        body.add_control("self", request.full_path)
+        body.add_control_routes_all(user)
+        return create_response(body)
+
+    def delete(self, user):
+        """
+        Delete all routes matching the filter in the query parameters with one
+        DELETE statement
+        """
+        criteria = route_filters()
+        if not isinstance(criteria, list):
+            return criteria
+
+        routes = Route.query.filter(Route.userId == user, *criteria)
+        seq = record_route_tombstones(routes)
+        deleted = routes.delete(synchronize_session=False)
+        if deleted == 0:
+            db.session.rollback()
+            if User.query.filter_by(id=user).first() is None:
+                return create_error_response(
+                            404, "Not found",
+                            "User not found"
+                            )
+        else:
+            db.session.commit()
+            routes_changed(user, {"op": "delete", "count": deleted, "seq": seq})
+
+        body = RouteBuilder(deleted=deleted)
+        body.add_namespace("routes", LINK_RELATIONS_URL)
+        body.add_control("self", request.full_path)
+        body.add_control_routes_all(user)
+        return create_response(body)
+
 
 class RouteItem(Resource):
     """
-    Route item resource: GET, PUT, DELETE
+    Route item resource: GET, PUT, PATCH, DELETE
     """
 
     def get(self, user, route):
         """
-        get information of specific route
+        get information of specific route, archived routes are found with
+        history=full
         """
-        # test that user with the route exists
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        try:
+            full_history = parse_history()
+        except ValueError as err:
+            return create_error_response(400, "Invalid history", str(err))
+
+        # find the user and the route of the user with one query
+        db_routes = query_user_routes(user, Route.id == route)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
-
-        # test if route exists for this user
-        db_route = Route.query.filter(Route.user==db_user).filter(Route.id==route).first()
-        if db_route is None:
+        if not db_routes and full_history:
+            db_routes = query_archived_routes(user, ArchivedRoute.id == route)
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No route was found with the id {}".format(route)
                         )
+        db_route = db_routes[0]
 
         # response body with proper controls
         body = RouteBuilder(
@@ -175,38 +317,47 @@ class RouteItem(Resource):
                     grade=db_route.grade.name,
                     extraInfo=db_route.extraInfo
                     )
+        archived = isinstance(db_route, ArchivedRoute)
+        history = "full" if archived else None
         body.add_namespace("routes", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.routeitem", user=user, route=route))
+        body.add_control("self", url_for("api.routeitem", user=user, route=route, history=history))
         body.add_control("profile", ROUTE_PROFILE)
         body.add_control_routes_all(user)
         body.add_control_climbed_by(user)
-        body.add_control_edit_route(user, route)
-        body.add_control_delete_route(user, route)
+        if archived:
+            # archived routes can only be deleted
+            body["archived"] = True
+            body.add_control_delete_route(user, route, history)
+        else:
+            body.add_control_edit_route(user, route)
+            body.add_control_patch_route(user, route)
+            body.add_control_delete_route(user, route)
         body.add_control_location_routes(user, db_route.locationId)
         body.add_control_discipline_routes(user, db_route.disciplineId)
         body.add_control_grade_routes(user, db_route.gradeId)
+        for kind in ("locations", "disciplines", "grades"):
+            body.add_control_autocomplete(kind)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
 
     def put(self, user, route):
         """
         Edit route information
         """
-        # test if user exists
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        # find the user and the route of the user with one query
+        db_routes = query_user_routes(user, Route.id == route)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
-        # test if route exists for this user
-        db_route = Route.query.filter(Route.user==db_user).filter(Route.id==route).first()
-        if db_route is None:
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No route was found with the id {}".format(route)
                         )
+        db_route = db_routes[0]
         if not request.json:
             return create_error_response(
                         415, "Unsupported media type",
@@ -246,45 +397,123 @@ class RouteItem(Resource):
 
         # and test if extraInfo (optional) is given in the request and act accordingly
         if "extraInfo" in request.json:
-            db_route.user = db_user
             db_route.date = date
             db_route.location = location
             db_route.discipline = discipline
             db_route.grade = grade
             db_route.extraInfo = request.json["extraInfo"]
         else:
-            db_route.user = db_user
             db_route.date = date
             db_route.location = location
             db_route.discipline = discipline
             db_route.grade = grade
 
         # commit
+        change = {"op": "update", "route": db_route.id, "seq": change_seq()}
         db.session.commit()
+        routes_changed(user, change)
 
         return Response(status=204)
 
-    def delete(self, user, route):
+    def patch(self, user, route):
         """
-        Delete route
+        Edit some of the route information with a JSON Merge Patch document
+        (RFC 7396). Only the changed columns are updated, and nothing is
+        committed when the patch does not change anything.
         """
-        # test if user exists
-        db_user = User.query.filter_by(id=user).first()
-        if db_user is None:
+        # find the user and the route of the user with one query
+        db_routes = query_user_routes(user, Route.id == route)
+        if db_routes is None:
             return create_error_response(
                         404, "Not found",
                         "User not found"
                         )
-
-        # test if route exists for this user
-        db_route = Route.query.filter(Route.user==db_user).filter(Route.id==route).first()
-        if db_route is None:
+        if not db_routes:
             return create_error_response(
                         404, "Not found",
                         "No route was found with the id {}".format(route)
                         )
+        db_route = db_routes[0]
+        patch = request.get_json(silent=True)
+        if patch is None:
+            return create_error_response(
+                        415, "Unsupported media type",
+                        "Requests must be JSON"
+                        )
+        if not isinstance(patch, dict):
+            return create_error_response(
+                        400, "Invalid JSON document",
+                        "Requests must be JSON objects"
+                        )
+        try:
+            validate(patch, Route.get_patch_schema())
+        except ValidationError as err:
+            return create_error_response(400, "Invalid JSON document", str(err))
+
+        changed = False
+        if "date" in patch and patch["date"] != db_route.date.isoformat():
+            try:
+                db_route.date = datetime.strptime(patch["date"], '%Y-%m-%d').date()
+            except ValueError:
+                return create_error_response(400, "Wrong date format", "Date was not given in YYYY-MM-DD format.")
+            changed = True
+
+        # location, discipline and grade are only looked up when they change
+        for key, model in (("location", Location), ("discipline", Discipline), ("grade", Grade)):
+            if key not in patch or patch[key] == getattr(db_route, key).name:
+                continue
+            if patch[key] == "":
+                return create_error_response(
+                            400, "Entry can not be empty.",
+                            "{} must contain characters.".format(key.capitalize())
+                            )
+            entry = db.session.query(model).filter_by(name=patch[key]).first()
+            if not entry:
+                entry = model(name=patch[key])
+            setattr(db_route, key, entry)
+            changed = True
+
+        if "extraInfo" in patch and patch["extraInfo"] != db_route.extraInfo:
+            db_route.extraInfo = patch["extraInfo"]
+            changed = True
+
+        if changed:
+            change = {"op": "update", "route": db_route.id, "seq": change_seq()}
+            db.session.commit()
+            routes_changed(user, change)
+
+        return Response(status=204)
 
-        db.session.delete(db_route)
+    def delete(self, user, route):
+        """
+        Delete route, archived routes are deleted with history=full
+        """
+        try:
+            full_history = parse_history()
+        except ValueError as err:
+            return create_error_response(400, "Invalid history", str(err))
+
+        # delete the route of the user directly, the user is only looked up
+        # when nothing was deleted to tell which one was not found
+        deleted = Route.query.filter(Route.userId == user, Route.id == route).delete(synchronize_session=False)
+        if deleted == 0 and full_history:
+            deleted = ArchivedRoute.query.filter(
+                        ArchivedRoute.userId == user, ArchivedRoute.id == route
+                        ).delete(synchronize_session=False)
+        if deleted == 0:
+            db.session.rollback()
+            if User.query.filter_by(id=user).first() is None:
+                return create_error_response(
+                            404, "Not found",
+                            "User not found"
+                            )
+            return create_error_response(
+                        404, "Not found",
+                        "No route was found with the id {}".format(route)
+                        )
+        change = {"op": "delete", "route": int(route), "seq": change_seq()}
+        db.session.add(Tombstone(entity="route", entityId=change["route"], userId=int(user), changeSeq=change["seq"]))
         db.session.commit()
+        routes_changed(user, change)
 
         return Response(status=204)
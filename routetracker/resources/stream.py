@@ -0,0 +1,46 @@
+from flask import Response, current_app, request
+from flask_restful import Resource
+from routetracker.models import User
+from routetracker.streams import stream_events
+from routetracker.utils import create_error_response
+from routetracker.constants import *
+
+
+"""
+This file includes the Server-Sent Events resource of the API
+"""
+
+class RouteStream(Resource):
+    """
+    Route event stream resource: GET
+    """
+
+    def get(self, user):
+        """
+        Stream the changes to the routes of user as Server-Sent Events
+        """
+        db_user = User.query.filter_by(id=user).first()
+        if db_user is None:
+            return create_error_response(
+                        404, "Not found",
+                        "User not found"
+                        )
+
+        broker = current_app.extensions["routetracker_streams"]
+        subscription = broker.subscribe(db_user.id)
+        body = stream_events(
+                    broker,
+                    subscription,
+                    current_app.config["SSE_HEARTBEAT"],
+                    # a reconnecting client may have missed events
+                    resync="Last-Event-ID" in request.headers
+                    )
+        response = Response(
+                    body,
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                    )
+        # the generator only unsubscribes once it has started, the response
+        # is closed by the server even if the body is never read
+        response.call_on_close(lambda: broker.unsubscribe(subscription))
+        return response
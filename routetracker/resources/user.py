@@ -1,11 +1,16 @@
 import json
 from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import Response, current_app, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
-from routetracker.models import User
+from routetracker.models import ArchivedRoute, Route, User, delete_user
 from routetracker import db
-from routetracker.utils import RouteBuilder, create_error_response
+from routetracker.idempotency import idempotent
+from routetracker.jobs import job_kind, submit_job
+from routetracker.utils import (
+    EMBEDDABLE, RouteBuilder, create_response, create_error_response, embed_collections, parse_embed,
+    query_user_routes
+    )
 from routetracker.constants import *
 
 """
@@ -27,6 +32,8 @@ class UserCollection(Resource):
         body.add_control("self", url_for("api.usercollection"))
         body.add_control_all_users()
         body.add_control_add_user()
+        body.add_control_recent_routes()
+        body.add_control_routes_of_users()
         body["items"] = []
         # create list of all users
         for db_user in User.query.all():
@@ -38,8 +45,9 @@ class UserCollection(Resource):
             item.add_control("self", url_for("api.useritem", user=db_user.id))
             item.add_control("profile", USER_PROFILE)
             body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
+    @idempotent
     def post(self):
         """
         Add a new user
@@ -76,6 +84,7 @@ class UserCollection(Resource):
             db.session.add(user)
             db.session.commit()
         except IntegrityError:
+            db.session.rollback()
             return create_error_response(
                         409, "Already exists",
                         "Email '{}' is already taken.".format(request.json["email"])
@@ -86,13 +95,20 @@ class UserCollection(Resource):
 
 class UserItem(Resource):
     """
-    The user item resource: GET, PUT, DELETE
+    The user item resource: GET, PUT, PATCH, DELETE
     """
 
     def get(self, user):
         """
-        Get information of specific user
+        Get information of specific user. The routes of the user and their
+        locations, disciplines and grades can be included with e.g.
+        ?embed=routes,locations
         """
+        try:
+            embed = parse_embed(EMBEDDABLE)
+        except ValueError as err:
+            return create_error_response(400, "Invalid embed", str(err))
+
         # test if user exists
         db_user = User.query.filter_by(id=user).first()
         if db_user is None:
@@ -114,10 +130,16 @@ class UserItem(Resource):
         body.add_control_all_users()
         body.add_control_edit_user(user)
         body.add_control_edit_user(user)
+        body.add_control_patch_user(user)
         body.add_control_delete_user(user)
         body.add_control_routes_all(user)
+        body.add_control_training_load(user)
+
+        # all embedded collections are built from one query of the routes
+        if embed:
+            embed_collections(body, user, query_user_routes(user), embed)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return create_response(body)
 
     def put(self, user):
         """
@@ -157,12 +179,66 @@ class UserItem(Resource):
         try:
             db.session.commit()
         except IntegrityError:
+            db.session.rollback()
             return create_error_response(
                         409, "Already exists",
                         "Email '{}' is already taken.".format(request.json["email"])
                         )
         return Response(status=204)
 
+    def patch(self, user):
+        """
+        Edit some of the user information with a JSON Merge Patch document
+        (RFC 7396). Only the changed columns are updated, and nothing is
+        committed when the patch does not change anything.
+        """
+        # test if user exists
+        db_user = User.query.filter_by(id=user).first()
+        if db_user is None:
+            return create_error_response(
+                        404, "Not found",
+                        "User not found"
+                        )
+        patch = request.get_json(silent=True)
+        if patch is None:
+            return create_error_response(
+                        415, "Unsupported media type",
+                        "Requests must be JSON"
+                        )
+        if not isinstance(patch, dict):
+            return create_error_response(
+                        400, "Invalid JSON document",
+                        "Requests must be JSON objects"
+                        )
+        try:
+            validate(patch, User.get_patch_schema())
+        except ValidationError as err:
+            return create_error_response(400, "Invalid JSON document", str(err))
+
+        # check that email is not just empty string
+        if patch.get("email") == "":
+            return create_error_response(400, "Email can not be empty.", "Email must contain characters.")
+
+        # null removes the optional names
+        changed = False
+        for key in ("email", "firstName", "lastName"):
+            if key in patch and patch[key] != getattr(db_user, key):
+                setattr(db_user, key, patch[key])
+                changed = True
+        if not changed:
+            return Response(status=204)
+
+        # try to commit to db
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(
+                        409, "Already exists",
+                        "Email '{}' is already taken.".format(patch["email"])
+                        )
+        return Response(status=204)
+
     def delete(self, user):
         """
         Delete user
@@ -175,7 +251,31 @@ class UserItem(Resource):
                         "User not found"
                         )
 
-        db.session.delete(db_user)
-        db.session.commit()
+        # routes are deleted with set based statements in chunks instead of
+        # loading them all into the session
+        chunk_size = current_app.config.get("USER_DELETE_CHUNK_SIZE", 1000)
+
+        # large accounts are deleted in the background, the client gets the
+        # job to follow instead
+        threshold = current_app.config.get("ASYNC_DELETE_THRESHOLD", 10000)
+        if db.session.query(Route.id).filter(Route.userId == db_user.id).offset(threshold).first() is not None:
+            job = submit_job(
+                        "delete-user",
+                        result=url_for("api.usercollection"),
+                        user=db_user.id,
+                        chunk_size=chunk_size
+                        )
+            return Response(status=202, headers={"Location": url_for("api.jobitem", job=job.id)})
+
+        delete_user(db_user.id, chunk_size)
 
         return Response(status=204)
+
+
+@job_kind("delete-user")
+def delete_user_job(job, user, chunk_size):
+    """
+    Background job deleting a user with a large number of routes
+    """
+    total = Route.query.filter_by(userId=user).count() + ArchivedRoute.query.filter_by(userId=user).count()
+    delete_user(user, chunk_size, progress=lambda deleted: job.progress(deleted, total))
@@ -227,6 +227,9 @@ function renderUserForm(ctrl, msg) {
         $("input[name='" + property + "']").attr("required", true);
     });
     form.append("<br> <br> <input type='submit' name='submit' value='Submit'>");
+    ["location", "discipline", "grade"].forEach(function (name) {
+        suggestNames(form, name, controls["routes:autocomplete-" + name + "s"]);
+    });
     $("div.form").html(form);
 }
 
@@ -254,7 +257,26 @@ async function renderRouteDelete(body) {
 
 
 // function to show the items for adding a new route to the DB, or editing existing
-function renderRouteForm(ctrl, msg) {
+// suggest the existing names for a location, discipline or grade input as
+// the user types, using the autocomplete control of the resource
+function suggestNames(form, name, ctrl) {
+    if (ctrl === undefined) {
+        return;
+    }
+    let list = $("<datalist id='" + name + "-suggestions'>");
+    form.append(list);
+    form.find("input[name='" + name + "']").attr("list", name + "-suggestions").on("input", function () {
+        let href = ctrl.href.replace("{?prefix,limit}", "?prefix=" + encodeURIComponent($(this).val()));
+        getResource(href, function (body) {
+            list.empty();
+            body.items.forEach(function (item) {
+                list.append($("<option>").attr("value", item.name));
+            });
+        });
+    });
+}
+
+function renderRouteForm(ctrl, msg, controls) {
     let form = $("<form>");
     let date = ctrl.schema.properties.date;
     let location = ctrl.schema.properties.location;
@@ -302,7 +324,7 @@ function renderRouteEdit(body) {
 
     //Edit user information:
     $("div.form").empty();
-    renderRouteForm(body["@controls"]["routes:edit-route"], "<br> <br> <h2>Edit route information:</h2> <br>");
+    renderRouteForm(body["@controls"]["routes:edit-route"], "<br> <br> <h2>Edit route information:</h2> <br>", body["@controls"]);
     $("input[name='date']").val(body.date);
     $("input[name='location']").val(body.location);
     $("input[name='discipline']").val(body.discipline);
@@ -427,7 +449,7 @@ function renderAllRoutes(body) {
         tbody.append(routeRow(item));
     });
     $("div.form").empty();
-    renderRouteForm(body["@controls"]["routes:add-route"], "<br> <br> <h2>Add a new route:</h2> <br>");
+    renderRouteForm(body["@controls"]["routes:add-route"], "<br> <br> <h2>Add a new route:</h2> <br>", body["@controls"]);
 }
 
 
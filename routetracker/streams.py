@@ -0,0 +1,161 @@
+import json
+import threading
+from collections import deque
+from flask import current_app
+from routetracker.events import on_routes_changed
+
+
+"""
+In-process publish/subscribe of route changes for the Server-Sent Events
+streams. The changes given to routes_changed are fanned out to the
+subscribers of the user straight from memory, without a query per
+subscriber. Each subscriber has a bounded queue: when a slow client lets it
+fill up, the queued events are coalesced into one "resync" event telling the
+client to catch up from the change feed.
+
+The broker only knows the subscribers of its own process, so with several
+server processes a client only sees the writes handled by the process it is
+connected to.
+"""
+
+
+class Subscription(object):
+    """
+    Queue of the events of one subscriber
+    : param int size: events kept before they are coalesced
+    """
+
+    def __init__(self, user, size=100):
+        self.user = user
+        self.size = size
+        self.events = deque()
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        """
+        queue an event, coalescing the queue when it is full
+        """
+        with self._ready:
+            if len(self.events) >= self.size:
+                self.events.clear()
+                self.events.append(("resync", {"seq": event.get("seq")}))
+            elif self.events and self.events[-1][0] == "resync":
+                # already behind, the resync covers this event too
+                self.events[-1][1]["seq"] = event.get("seq")
+            else:
+                self.events.append(("route", event))
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """
+        Next (event type, data) tuple, or None if nothing arrived within the
+        timeout or the subscription was closed
+        """
+        with self._ready:
+            if not self.events and not self.closed:
+                self._ready.wait(timeout)
+            if self.events:
+                return self.events.popleft()
+            return None
+
+    def close(self):
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+
+
+class Broker(object):
+    """
+    Subscriptions of one app, by user
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user):
+        subscription = Subscription(user, self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(user, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user, None)
+
+    def subscribers(self, user):
+        with self._lock:
+            return len(self._subscriptions.get(user, ()))
+
+    def publish(self, user, event):
+        """
+        give an event to all subscribers of the user
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+
+def format_event(event_type, data, seq=None):
+    """
+    one event in the text/event-stream format
+    """
+    lines = []
+    if seq is not None:
+        lines.append("id: {}".format(seq))
+    lines.append("event: {}".format(event_type))
+    lines.append("data: {}".format(json.dumps(data, separators=(",", ":"))))
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_events(broker, subscription, heartbeat, resync=False):
+    """
+    Generator of the text/event-stream body of a subscription. Sends a
+    comment every heartbeat seconds to keep idle connections open, and
+    unsubscribes when the client goes away.
+    : param bool resync: start with a resync event, for reconnecting clients
+    that may have missed events
+    """
+    try:
+        # something is sent right away so that the headers go out and proxies
+        # see the stream
+        if resync:
+            yield format_event("resync", {"seq": None})
+        else:
+            yield ": subscribed\n\n"
+        while not subscription.closed:
+            item = subscription.get(heartbeat)
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event_type, data = item
+            yield format_event(event_type, data, data.get("seq"))
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@on_routes_changed
+def _publish_changes(user, changes):
+    broker = current_app.extensions.get("routetracker_streams")
+    if broker is None:
+        return
+    for change in changes:
+        broker.publish(user, change)
+
+
+def init_app(app):
+    """
+    Create the broker of the app
+    """
+    app.config.setdefault("SSE_QUEUE_SIZE", 100)
+    app.config.setdefault("SSE_HEARTBEAT", 15.0)
+    broker = Broker(app.config["SSE_QUEUE_SIZE"])
+    app.extensions["routetracker_streams"] = broker
+    return broker
@@ -1,7 +1,12 @@
 import json
 from flask import Response, request, url_for
+from sqlalchemy import and_
+from sqlalchemy.orm import joinedload
+from routetracker import db
 from routetracker.constants import *
 from routetracker.models import *
+from routetracker.encoding import encode_body
+from routetracker.instrumentation import timed
 
 
 class MasonBuilder(dict):
@@ -166,6 +171,19 @@ class RouteBuilder(MasonBuilder):
             schema=self._user_schema()
             )
 
+    def add_control_patch_user(self, user):
+        """
+        edit only some of the user information
+        """
+        self.add_control(
+            "users:patch-user",
+            href=url_for("api.useritem", user=user),
+            method="PATCH",
+            encoding="json",
+            title="Edit some of the user information",
+            schema=User.get_patch_schema()
+            )
+
     def add_control_delete_user(self, user):
         """
         delete user
@@ -225,17 +243,242 @@ class RouteBuilder(MasonBuilder):
             schema=self._route_schema()
             )
 
-    def add_control_delete_route(self, user, route):
+    def add_control_patch_route(self, user, route):
         """
-        delete route
+        edit only some of the route information
         """
         self.add_control(
-            "routes:delete",
+            "routes:patch-route",
             href=url_for("api.routeitem", user=user, route=route),
+            method="PATCH",
+            encoding="json",
+            title="Edit some of the route information",
+            schema=Route.get_patch_schema()
+            )
+
+    def add_control_delete_route(self, user, route, history=None):
+        """
+        delete route, archived routes are deleted with history="full"
+        """
+        self.add_control(
+            "routes:delete",
+            href=url_for("api.routeitem", user=user, route=route, history=history),
             method="DELETE",
             title="Delete route"
             )
 
+    @staticmethod
+    def _route_filter_schema():
+        """
+        schema of the query parameters selecting routes for bulk operations
+        """
+        schema = {
+            "type": "object"
+        }
+        props = schema["properties"] = {}
+        props["from"] = {
+            "description": "first date to include, YYYY-MM-DD",
+            "type": "string"
+        }
+        props["to"] = {
+            "description": "last date to include, YYYY-MM-DD",
+            "type": "string"
+        }
+        props["location"] = {
+            "description": "id of the location",
+            "type": "integer"
+        }
+        props["discipline"] = {
+            "description": "id of the discipline",
+            "type": "integer"
+        }
+        props["grade"] = {
+            "description": "id of the grade",
+            "type": "integer"
+        }
+        return schema
+
+    def add_control_bulk_edit_routes(self, user):
+        """
+        edit all routes of user matching a filter, the body is a merge patch
+        """
+        self.add_control(
+            "routes:bulk-edit",
+            href=url_for("api.routecollection", user=user) + "{?from,to,location,discipline,grade}",
+            isHrefTemplate=True,
+            method="PATCH",
+            encoding="json",
+            title="Edit all routes matching the filter",
+            schema=Route.get_patch_schema()
+            )
+
+    def add_control_bulk_delete_routes(self, user):
+        """
+        delete all routes of user matching a filter
+        """
+        self.add_control(
+            "routes:bulk-delete",
+            href=url_for("api.routecollection", user=user) + "{?from,to,location,discipline,grade}",
+            isHrefTemplate=True,
+            method="DELETE",
+            title="Delete all routes matching the filter",
+            schema=self._route_filter_schema()
+            )
+
+    def add_control_changes(self, user, since=None):
+        """
+        get the changes to the routes of user since a sequence value, or all
+        routes without one
+        """
+        self.add_control(
+            "routes:changes",
+            href=url_for("api.changefeed", user=user, since=since),
+            method="GET",
+            title="Get changes to the routes since the last synchronization"
+            )
+
+    def add_control_route_events(self, user):
+        """
+        stream the changes to the routes of user as Server-Sent Events
+        """
+        self.add_control(
+            "routes:events",
+            href=url_for("api.routestream", user=user),
+            method="GET",
+            title="Stream changes to the routes as Server-Sent Events"
+            )
+
+    def add_control_full_history(self, user):
+        """
+        get all routes of user including the archived ones
+        """
+        self.add_control(
+            "routes:full-history",
+            href=url_for("api.routecollection", user=user, history="full"),
+            method="GET",
+            title="Get all routes including the archived ones"
+            )
+
+    def add_control_training_load(self, user):
+        """
+        get the training load analytics of the routes of user
+        """
+        self.add_control(
+            "routes:training-load",
+            href=url_for("api.trainingload", user=user),
+            method="GET",
+            title="Get the weekly training load and grade progression"
+            )
+
+    def add_control_recent_routes(self):
+        """
+        get the latest routes logged by all users
+        """
+        self.add_control(
+            "routes:recent",
+            href=url_for("api.recentroutes"),
+            method="GET",
+            title="Get the latest routes of all users"
+            )
+
+    def add_control_routes_of_users(self):
+        """
+        get the routes of several users and routes at once
+        """
+        schema = self._route_filter_schema()
+        schema["properties"]["users"] = {
+            "description": "comma separated ids of users",
+            "type": "string"
+        }
+        schema["properties"]["routes"] = {
+            "description": "comma separated ids of routes",
+            "type": "string"
+        }
+        schema["properties"]["limit"] = {
+            "description": "routes in a page",
+            "type": "integer"
+        }
+        self.add_control(
+            "routes:routes-of-users",
+            href=url_for("api.routeselection") + "{?users,routes,from,to,location,discipline,grade,limit}",
+            isHrefTemplate=True,
+            method="GET",
+            title="Get the routes of several users and routes",
+            schema=schema
+            )
+
+    def add_control_autocomplete(self, kind):
+        """
+        get the most used location, discipline or grade names starting with
+        a prefix
+        : param str kind: locations, disciplines or grades
+        """
+        self.add_control(
+            "routes:autocomplete-{}".format(kind),
+            href=url_for("api.namesuggestions", kind=kind) + "{?prefix,limit}",
+            isHrefTemplate=True,
+            method="GET",
+            title="Get the {} starting with a prefix".format(kind)
+            )
+
+    def add_control_leaderboards_all(self):
+        """
+        get the list of discipline and location leaderboards
+        """
+        self.add_control(
+            "leaderboards:leaderboards-all",
+            href=url_for("api.leaderboardcollection"),
+            method="GET",
+            title="Get list of all leaderboards"
+            )
+
+    def add_control_recompute_leaderboards(self):
+        """
+        build all leaderboards again in a background job
+        """
+        self.add_control(
+            "leaderboards:recompute",
+            href=url_for("api.leaderboardcollection"),
+            method="POST",
+            title="Build all leaderboards again"
+            )
+
+    def add_control_leaderboard(self, board, item, by):
+        """
+        get the top climbers of a discipline or location leaderboard, by
+        hardest grade or by number of routes
+        """
+        titles = {
+            "grade": "Get the top climbers by hardest grade",
+            "volume": "Get the top climbers by number of routes"
+        }
+        self.add_control(
+            "leaderboards:by-{}".format(by),
+            href=url_for("api.leaderboard", board=board, item=item, by=by),
+            method="GET",
+            title=titles[by]
+            )
+
+    def add_control_everyones_routes(self, namespace, item):
+        """
+        get the routes of all users in a location, discipline or grade, and
+        their daily activity
+        : param str namespace: locations, disciplines or grades
+        """
+        kind = namespace[:-1]
+        self.add_control(
+            "{}:routes-everyone".format(namespace),
+            href=url_for("api.{}routes".format(kind), item=item),
+            method="GET",
+            title="Get the routes of all users in the {}".format(kind)
+            )
+        self.add_control(
+            "{}:activity".format(namespace),
+            href=url_for("api.{}activity".format(kind), item=item),
+            method="GET",
+            title="Get the number of routes and climbers of each day in the {}".format(kind)
+            )
+
     def add_control_locations_all(self, user):
         """
         get all locations where user has climbed a route
@@ -303,6 +546,179 @@ class RouteBuilder(MasonBuilder):
             )
 
 
+def query_user_routes(user, *criteria):
+    """
+    Find the routes of a user matching the criteria together with their
+    location, discipline and grade, and check that the user exists, all in
+    one query. Returns None if the user does not exist, otherwise the list of
+    matching routes (which may be empty).
+    """
+    rows = db.session.query(User.id, Route).outerjoin(
+                Route, and_(Route.userId == User.id, *criteria)
+                ).filter(User.id == user).options(
+                joinedload(Route.location),
+                joinedload(Route.discipline),
+                joinedload(Route.grade)
+                ).order_by(Route.id).all()
+    if not rows:
+        return None
+    return [db_route for user_id, db_route in rows if db_route is not None]
+
+
+def query_archived_routes(user, *criteria):
+    """
+    Find the archived routes of a user matching the criteria together with
+    their location, discipline and grade, in one query
+    """
+    return ArchivedRoute.query.filter(ArchivedRoute.userId == user, *criteria).options(
+                joinedload(ArchivedRoute.location),
+                joinedload(ArchivedRoute.discipline),
+                joinedload(ArchivedRoute.grade)
+                ).order_by(ArchivedRoute.id).all()
+
+
+# ids and change sequence values are 64-bit integers in the database
+MAX_ID = 2 ** 63 - 1
+
+
+def parse_id(value, minimum=1):
+    """
+    An id given in a query parameter. Raises ValueError for values that are
+    not numbers from minimum to MAX_ID, larger ones can not even be compared
+    with the columns.
+    """
+    number = int(value)
+    if not minimum <= number <= MAX_ID:
+        raise ValueError("{} is not a valid id".format(value))
+    return number
+
+
+def parse_history():
+    """
+    True if the archived routes were requested with history=full. Raises
+    ValueError for other values.
+    """
+    history = request.args.get("history")
+    if history not in (None, "full"):
+        raise ValueError("history can only be 'full'")
+    return history == "full"
+
+
+# related collections that can be inlined with the embed query parameter
+EMBEDDABLE = ("routes", "locations", "disciplines", "grades")
+
+
+def build_route_collection(user, db_routes, history=None):
+    """
+    Mason document of the routes of a user. The location, discipline and
+    grade of the routes should be loaded with them. Archived routes can only
+    be deleted.
+    """
+    body = RouteBuilder()
+    body.add_namespace("routes", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.routecollection", user=user, history=history))
+    body.add_control_climbed_by(user)
+    body.add_control_routes_all(user)
+    body.add_control_add_route(user)
+    body.add_control_bulk_edit_routes(user)
+    body.add_control_bulk_delete_routes(user)
+    body.add_control_changes(user)
+    body.add_control_route_events(user)
+    body.add_control_full_history(user)
+    body.add_control_training_load(user)
+    body.add_control_locations_all(user)
+    body.add_control_disciplines_all(user)
+    body.add_control_grades_all(user)
+    for kind in ("locations", "disciplines", "grades"):
+        body.add_control_autocomplete(kind)
+    body["items"] = []
+
+    for db_route in db_routes:
+        item = RouteBuilder(
+                    date=db_route.date.isoformat(),  # convert date to isoformat
+                    location=db_route.location.name,
+                    discipline=db_route.discipline.name,
+                    grade=db_route.grade.name,
+                    extraInfo=db_route.extraInfo
+                    )
+        if isinstance(db_route, ArchivedRoute):
+            item["archived"] = True
+            item.add_control("self", url_for("api.routeitem", user=user, route=db_route.id, history="full"))
+            item.add_control_delete_route(user, db_route.id, "full")
+        else:
+            item.add_control("self", url_for("api.routeitem", user=user, route=db_route.id))
+            item.add_control_edit_route(user, db_route.id)
+            item.add_control_delete_route(user, db_route.id)
+        item.add_control_location_routes(user, db_route.location.id)
+        item.add_control_discipline_routes(user, db_route.discipline.id)
+        item.add_control_grade_routes(user, db_route.grade.id)
+        item.add_control("profile", ROUTE_PROFILE)
+        body["items"].append(item)
+    return body
+
+
+def build_lookup_collection(user, kind, db_entries):
+    """
+    Mason document of the unique locations, disciplines or grades of a user
+    : param str kind: "location", "discipline" or "grade"
+    : param list db_entries: the Location, Discipline or Grade rows
+    """
+    body = RouteBuilder()
+    body.add_namespace(kind + "s", LINK_RELATIONS_URL)
+    body.add_control("self", url_for("api.{}collection".format(kind), user=user))
+    body.add_control_climbed_by(user)
+    body.add_control_routes_all(user)
+    body["items"] = []
+
+    for db_entry in db_entries:
+        item = RouteBuilder(**{kind: db_entry.name})
+        item.add_control("self", url_for("api.{}item".format(kind), user=user, **{kind: db_entry.id}))
+        getattr(item, "add_control_{}_routes".format(kind))(user, db_entry.id)
+        item.add_control("profile", ROUTE_PROFILE)
+        body["items"].append(item)
+    return body
+
+
+def parse_embed(allowed):
+    """
+    Names of the collections requested with the comma separated embed query
+    parameter. Raises ValueError for names that can not be embedded.
+    """
+    names = [name for name in request.args.get("embed", "").split(",") if name]
+    for name in names:
+        if name not in allowed:
+            raise ValueError(
+                "Can not embed '{}', choose from: {}".format(name, ", ".join(allowed))
+                )
+    return names
+
+
+def embed_collections(body, user, db_routes, names):
+    """
+    Inline the named collections of a user into body under "embedded". They
+    are all derived from the same routes, which must be loaded with their
+    location, discipline and grade, so no more queries are needed.
+    """
+    embedded = body["embedded"] = {}
+    for name in names:
+        if name == "routes":
+            embedded[name] = build_route_collection(user, db_routes)
+            continue
+        kind = name[:-1]
+        entries = dict((getattr(db_route, kind + "Id"), getattr(db_route, kind)) for db_route in db_routes)
+        embedded[name] = build_lookup_collection(user, kind, [entries[key] for key in sorted(entries)])
+
+
+def create_response(body, status_code=200):
+    """
+    Create a response with the body encoded according to the Accept header
+    of the request, Mason JSON by default.
+    """
+    with timed("encode"):
+        data, mimetype = encode_body(body)
+    return Response(data, status_code, mimetype=mimetype)
+
+
 def create_error_response(status_code, title, message=None):
     """
     Create error responses easily. Copied directly from course material.
@@ -311,4 +727,4 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href="")
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return create_response(body, status_code)
@@ -11,5 +11,10 @@ setup(
         "flask-restful",
         "flask-sqlalchemy",
         "SQLAlchemy",
-    ]
+    ],
+    extras_require={
+        "msgpack": ["msgpack"],
+        "brotli": ["brotli"],
+        "analytics": ["numpy"],
+    }
 )
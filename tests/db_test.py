@@ -37,6 +37,8 @@ def app():
 
     yield app
 
+    # the background refreshes of the last writes
+    app.extensions["routetracker_jobs"].shutdown()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -496,3 +498,51 @@ def test_delete_cascade(app):
         db.session.delete(grade)
         db.session.commit()
         assert route.gradeId is None
+
+
+def test_upgrade(app):
+    """
+    test upgrading a database created before the change feed
+    """
+    from sqlalchemy import inspect
+    from routetracker.models import Tombstone, delete_user, upgrade_db
+
+    with app.app_context():
+        # the tables and columns of the change feed did not exist yet
+        for table in ("change_sequence", "tombstone", "leaderboard_entry", "leaderboard_state", "idempotency_key"):
+            db.session.execute(db.text("DROP TABLE {}".format(table)))
+        for index in ("ix_route_user_change", "ix_route_change"):
+            db.session.execute(db.text("DROP INDEX {}".format(index)))
+        db.session.execute(db.text('ALTER TABLE route DROP COLUMN "changeSeq"'))
+        db.session.execute(db.text('ALTER TABLE user DROP COLUMN "changeSeq"'))
+        db.session.execute(db.text('CREATE INDEX ix_route_user_location ON route ("userId", "locationId")'))
+        db.session.execute(db.text(
+            "CREATE TABLE idempotency_key (id INTEGER PRIMARY KEY, key VARCHAR(250) NOT NULL, "
+            "scope VARCHAR(250) NOT NULL, fingerprint VARCHAR(64) NOT NULL, status INTEGER NOT NULL, "
+            'location VARCHAR(250), "createdAt" DATETIME NOT NULL)'
+            ))
+        db.session.execute(db.text("INSERT INTO user (id, email) VALUES (1, 'old@test.test')"))
+        db.session.execute(db.text('INSERT INTO route (id, "userId", date) VALUES (1, 1, \'2020-01-01\')'))
+        db.session.commit()
+
+        changes = upgrade_db()
+        assert "added column route.changeSeq" in changes
+        assert "dropped index ix_route_user_location" in changes
+        assert "created table tombstone" in changes
+        assert upgrade_db() == []
+
+        inspector = inspect(db.engine)
+        assert set(index["name"] for index in inspector.get_indexes("route")) == set(
+            index.name for index in Route.__table__.indexes
+            )
+        idempotency = dict((column["name"], column) for column in inspector.get_columns("idempotency_key"))
+        assert idempotency["status"]["nullable"]
+
+        # the existing rows were written before the first change
+        route = Route.query.first()
+        assert route.changeSeq == 0
+        route.extraInfo = "changed"
+        db.session.commit()
+        assert route.changeSeq == 1
+        delete_user(1)
+        assert Tombstone.query.count() == 1
@@ -1,10 +1,11 @@
+import gzip
 import json
 import os
 import pytest
 import tempfile
 import time
 import random
-from datetime import datetime
+from datetime import date, datetime
 from jsonschema import validate
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
@@ -47,6 +48,8 @@ def app():
 
     yield app.test_client()
 
+    # the background refreshes of the last writes
+    app.extensions["routetracker_jobs"].shutdown()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -107,6 +110,24 @@ def _user_template(user=1):
             "lastName": "testington"}
 
 
+def _recompute_leaderboards(app):
+    """
+    build the leaderboards of the populated routes, which are written
+    without the route change events
+    """
+    from routetracker.leaderboards import recompute_leaderboards
+
+    with app.application.app_context():
+        recompute_leaderboards(workers=1)
+
+
+def _wait_for_jobs(app):
+    """
+    wait for the background refreshes of the writes so far
+    """
+    assert app.application.extensions["routetracker_jobs"].wait(10)
+
+
 def _route_template(route=1):
     """
     create valid JSON for route for POST, PUT tests
@@ -226,6 +247,25 @@ def _check_control_put_method(ctrl, client, obj, collection):
     assert resp.status_code == 204
 
 
+def _check_control_patch_method(ctrl, client, obj):
+    """
+    Checks a PATCH type control from a JSON object. An empty merge patch must
+    be valid against the schema of the control and leave the resource as it
+    is with status code 204.
+    """
+
+    ctrl_obj = obj["@controls"][ctrl]
+    href = ctrl_obj["href"]
+    method = ctrl_obj["method"].lower()
+    encoding = ctrl_obj["encoding"].lower()
+    schema = ctrl_obj["schema"]
+    assert method == "patch"
+    assert encoding == "json"
+    validate({}, schema)
+    resp = client.patch(href, json={})
+    assert resp.status_code == 204
+
+
 class TestUserCollection(object):
     """
     Test the user collection resource: GET, POST
@@ -312,7 +352,7 @@ class TestUserCollection(object):
 
 class TestUserItem(object):
     """
-    Test the user item resource: GET, PUT, DELETE
+    Test the user item resource: GET, PUT, PATCH, DELETE
     """
 
     RESOURCE_URL = "/api/users/1/"
@@ -336,6 +376,7 @@ class TestUserItem(object):
         _check_control_get_method("users:users-all", app, body)
         _check_control_get_method("routes:routes-all", app, body)
         _check_control_put_method("users:edit-user", app, body, "users")
+        _check_control_patch_method("users:patch-user", app, body)
         _check_control_delete_method("users:delete", app, body)
 
         # and see also that we get 404 if we try to access invalid url
@@ -387,6 +428,48 @@ class TestUserItem(object):
         resp = app.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_patch(self, app):
+        """
+        Tests patch method to edit some of the information of an user
+        """
+        from routetracker.instrumentation import recorded_queries
+
+        # wrong Content
+        resp = app.patch(self.RESOURCE_URL, data=json.dumps({"firstName": "x"}))
+        assert resp.status_code == 415
+        resp = app.patch(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+
+        # for user not found
+        resp = app.patch(self.INVALID_URL, json={})
+        assert resp.status_code == 404
+
+        # email can not be removed or taken by someone else
+        resp = app.patch(self.RESOURCE_URL, json={"email": None})
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL, json={"email": ""})
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL, json={"email": "2email@url.com"})
+        assert resp.status_code == 409
+
+        # change the first name and remove the last name
+        resp = app.patch(
+                    self.RESOURCE_URL,
+                    data=json.dumps({"firstName": "changed", "lastName": None}),
+                    content_type="application/merge-patch+json"
+                    )
+        assert resp.status_code == 204
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert body["email"] == "1email@url.com"
+        assert body["firstName"] == "changed"
+        assert body["lastName"] is None
+
+        # patch without changes is not written
+        with recorded_queries("UserItem.patch") as recorder:
+            resp = app.patch(self.RESOURCE_URL, json={"firstName": "changed"})
+        assert resp.status_code == 204
+        assert not any(statement.startswith("UPDATE") for statement in recorder.statements)
+
     def test_delete(self, app):
         """
         test delete method
@@ -402,9 +485,311 @@ class TestUserItem(object):
         assert resp.status_code == 404
 
 
+class TestUserDelete(object):
+    """
+    Test that users are deleted with set based statements
+    """
+
+    RESOURCE_URL = "/api/users/1/"
+
+    def test_delete_many_routes(self, app):
+        """
+        test that deleting does not load the routes, and the statement count
+        only grows with the number of chunks
+        """
+        from routetracker.instrumentation import query_budget
+
+        _add_routes(app, 50)
+        app.application.config["USER_DELETE_CHUNK_SIZE"] = 20
+        # user lookup, size check, three route chunks plus the empty one, the
+        # empty chunk of archived routes, the change sequence (update and
+        # select), the user tombstone, the leaderboard entries, the
+        # idempotency keys and the user
+        with query_budget(13, "UserItem.delete") as used:
+            resp = app.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        # route rows are never loaded into the session
+        assert not any("route.date" in statement for statement in used.statements)
+
+        with app.application.app_context():
+            assert User.query.filter_by(id=1).first() is None
+            assert Route.query.filter_by(userId=1).count() == 0
+            # routes of other users are kept
+            assert Route.query.filter_by(userId=2).count() == 5
+
+
+class TestBatch(object):
+    """
+    Test the batch resource: POST
+    """
+
+    RESOURCE_URL = "/api/batch/"
+
+    def test_reads(self, app):
+        """
+        test getting the whole user view in one request
+        """
+        from routetracker.instrumentation import recorded_queries
+
+        urls = [
+            "/api/users/1/",
+            "/api/users/1/routes/",
+            "/api/users/1/routes/locations/",
+            "/api/users/1/routes/disciplines/",
+            "/api/users/1/routes/grades/",
+        ]
+        resp = app.post(self.RESOURCE_URL, json={"requests": [{"method": "GET", "href": url} for url in urls]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [sub["status"] for sub in body["responses"]] == [200] * 5
+        for url, sub in zip(urls, body["responses"]):
+            assert sub["body"] == json.loads(app.get(url).data)
+
+        # the statements are attributed to the resources of the sub-requests
+        with recorded_queries("RouteCollection.get") as direct:
+            app.get(urls[1])
+        with recorded_queries("RouteCollection.get") as batched:
+            app.post(self.RESOURCE_URL, json={"requests": [{"method": "GET", "href": url} for url in urls]})
+        assert set(direct.statements) <= set(batched.statements)
+
+        # unknown and non API URLs are reported per request, and the batch
+        # stops at the first failure
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "GET", "href": "/api/users/1/routes/?location=1"},
+                    {"method": "GET", "href": "/api/users/1/nothing/"},
+                    {"method": "GET", "href": "/login/"},
+                    {"method": "POST", "href": self.RESOURCE_URL, "body": {"requests": []}},
+                    ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [sub["status"] for sub in body["responses"]] == [200, 404, 424, 424]
+        assert body["responses"][1]["body"]["@error"]["@message"] == "Not Found"
+        resp = app.post(self.RESOURCE_URL, json={"requests": [{"method": "GET", "href": "/login/"}]})
+        assert json.loads(resp.data)["responses"][0]["status"] == 400
+
+    def test_invalid(self, app):
+        """
+        test invalid batch documents
+        """
+        resp = app.post(self.RESOURCE_URL, data=json.dumps({"requests": []}))
+        assert resp.status_code == 415
+        resp = app.post(self.RESOURCE_URL, json={"requests": [{"method": "GET"}]})
+        assert resp.status_code == 400
+        resp = app.post(self.RESOURCE_URL, json={})
+        assert resp.status_code == 400
+        resp = app.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+        app.application.config["BATCH_MAX_REQUESTS"] = 2
+        resp = app.post(self.RESOURCE_URL, json={"requests": [{"method": "GET", "href": "/api/users/"}] * 3})
+        assert resp.status_code == 400
+
+        # batches and event streams are not run inside a batch
+        app.application.config["BATCH_MAX_REQUESTS"] = 20
+        for sub in ({"method": "GET", "href": "/api/users/1/events/"},
+                    {"method": "POST", "href": self.RESOURCE_URL, "body": {"requests": []}}):
+            resp = app.post(self.RESOURCE_URL, json={"requests": [sub]})
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert [sub["status"] for sub in body["responses"]] == [400]
+        assert app.application.extensions["routetracker_streams"].subscribers(1) == 0
+
+    def test_writes(self, app):
+        """
+        test that the writes are committed together, or not at all
+        """
+        from routetracker.events import ROUTE_LISTENERS
+
+        changed = []
+
+        def listener(user, changes):
+            changed.append(user)
+
+        ROUTE_LISTENERS.append(listener)
+        try:
+            resp = app.post(self.RESOURCE_URL, json={"requests": [
+                        {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template()},
+                        {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template(2)},
+                        {"method": "PATCH", "href": "/api/users/1/", "body": {"firstName": "batched"}},
+                        ]})
+        finally:
+            ROUTE_LISTENERS.remove(listener)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert [sub["status"] for sub in body["responses"]] == [201, 201, 204]
+        location = body["responses"][0]["headers"]["Location"]
+        assert app.get(location).status_code == 200
+        assert json.loads(app.get("/api/users/1/").data)["firstName"] == "batched"
+        assert len(json.loads(app.get("/api/users/1/routes/").data)["items"]) == 7
+        # the listeners are told once, after the commit
+        assert changed == [1]
+
+        # a failing request rolls back the whole batch
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "DELETE", "href": "/api/users/1/routes/1/"},
+                    {"method": "PATCH", "href": "/api/users/1/", "body": {"email": "2email@url.com"}},
+                    ]})
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [sub["status"] for sub in body["responses"]] == [204, 409]
+        assert app.get("/api/users/1/routes/1/").status_code == 200
+        assert json.loads(app.get("/api/users/1/").data)["email"] == "1email@url.com"
+
+
+    def test_savepoints(self, app, monkeypatch):
+        """
+        test that the rollbacks of a request only undo its own writes, and
+        that errors roll back the whole batch
+        """
+        def count_routes():
+            return len(json.loads(app.get("/api/users/1/routes/").data)["items"])
+
+        # bulk operations matching nothing roll back their own statements
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template()},
+                    {"method": "PATCH", "href": "/api/users/1/routes/?location=999", "body": {"grade": "6A"}},
+                    {"method": "DELETE", "href": "/api/users/1/routes/?location=999"},
+                    ]})
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert [sub["status"] for sub in body["responses"]] == [201, 200, 200]
+        assert app.get(body["responses"][0]["headers"]["Location"]).status_code == 200
+        assert count_routes() == 6
+
+        # a missing route fails the batch
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template()},
+                    {"method": "DELETE", "href": "/api/users/1/routes/999/"},
+                    ]})
+        assert json.loads(resp.data)["committed"] is False
+        assert count_routes() == 6
+
+        # the requests after a conflict are not run
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "POST", "href": "/api/users/", "body": {"email": "1email@url.com"}},
+                    {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template()},
+                    ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [sub["status"] for sub in body["responses"]] == [409, 424]
+        assert body["responses"][1]["body"]["@error"]["@message"] == "Failed dependency"
+        assert count_routes() == 6
+
+        # an exception fails the request and rolls back the batch
+        def broken(*args):
+            raise RuntimeError("broken")
+
+        monkeypatch.setattr("routetracker.resources.route.query_user_routes", broken)
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "POST", "href": "/api/users/1/routes/", "body": _route_template()},
+                    {"method": "GET", "href": "/api/users/1/routes/1/"},
+                    ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["committed"] is False
+        assert [sub["status"] for sub in body["responses"]] == [201, 500]
+        monkeypatch.undo()
+        assert count_routes() == 6
+
+    def test_jobs(self, app):
+        """
+        test that the jobs of a batch are only run once it is committed
+        """
+        _add_routes(app, 10)
+        app.application.config["ASYNC_DELETE_THRESHOLD"] = 10
+        jobs = app.application.extensions["routetracker_jobs"]
+
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "DELETE", "href": "/api/users/1/"},
+                    {"method": "DELETE", "href": "/api/users/1/routes/999/"},
+                    ]})
+        body = json.loads(resp.data)
+        assert [sub["status"] for sub in body["responses"]] == [202, 404]
+        assert jobs.wait(10)
+        assert app.get(body["responses"][0]["headers"]["Location"]).status_code == 404
+        assert app.get("/api/users/1/").status_code == 200
+
+        resp = app.post(self.RESOURCE_URL, json={"requests": [
+                    {"method": "DELETE", "href": "/api/users/1/"},
+                    ]})
+        body = json.loads(resp.data)
+        assert body["committed"] is True
+        assert jobs.wait(10)
+        job = json.loads(app.get(body["responses"][0]["headers"]["Location"]).data)
+        assert job["status"] == "done"
+        assert app.get("/api/users/1/").status_code == 404
+
+
+class TestJobs(object):
+    """
+    Test the background jobs and the job resource
+    """
+
+    RESOURCE_URL = "/api/users/1/"
+
+    def test_async_delete(self, app):
+        """
+        test that deleting a large account is offloaded to a job
+        """
+        _add_routes(app, 10)
+        app.application.config["ASYNC_DELETE_THRESHOLD"] = 10
+        app.application.config["USER_DELETE_CHUNK_SIZE"] = 4
+        resp = app.delete(self.RESOURCE_URL)
+        assert resp.status_code == 202
+        job_url = resp.headers["Location"]
+        assert job_url.endswith("/api/jobs/1/")
+
+        assert app.application.extensions["routetracker_jobs"].wait(10)
+        resp = app.get(job_url)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "jobs")
+        assert body["kind"] == "delete-user"
+        assert body["status"] == "done"
+        assert body["progress"] == 1.0
+        assert "Retry-After" not in resp.headers
+        _check_control_get_method("self", app, body)
+        _check_control_get_method("jobs:result", app, body)
+
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
+        with app.application.app_context():
+            assert Route.query.filter_by(userId=1).count() == 0
+            assert Route.query.filter_by(userId=2).count() == 5
+
+        # small accounts are still deleted right away
+        resp = app.delete("/api/users/2/")
+        assert resp.status_code == 204
+
+        resp = app.get("/api/jobs/12345/")
+        assert resp.status_code == 404
+
+    def test_failed_job(self, app):
+        """
+        test that errors in jobs are stored
+        """
+        from routetracker.jobs import job_kind, submit_job
+
+        @job_kind("test-failure")
+        def failing_job(job, steps):
+            job.progress(1, steps)
+            raise RuntimeError("broken")
+
+        with app.application.test_request_context():
+            job = submit_job("test-failure", steps=4)
+        assert app.application.extensions["routetracker_jobs"].wait(10)
+        body = json.loads(app.get("/api/jobs/{}/".format(job.id)).data)
+        assert body["status"] == "failed"
+        assert body["error"] == "broken"
+        assert body["progress"] == 0.25
+        assert "jobs:result" not in body["@controls"]
+
+
 class TestRouteCollection(object):
     """
-    Test the route collection resource: GET, POST
+    Test the route collection resource: GET, POST, PATCH, DELETE
     """
 
     RESOURCE_URL = "/api/users/1/routes/"
@@ -511,150 +896,1344 @@ class TestRouteCollection(object):
         assert resp.status_code == 415
 
 
-class TestRouteItem(object):
+class TestIdempotency(object):
     """
-    Test the route item resource: GET, PUT, DELETE
+    Test the Idempotency-Key header of the create requests
     """
 
-    RESOURCE_URL = "/api/users/1/routes/1/"
-    INVALID_USER_URL = "/api/users/saddsa/routes/1/"
-    INVALID_ROUTE_URL = "/api/users/1/routes/122213/"
+    RESOURCE_URL = "/api/users/1/routes/"
 
-    def test_get(self, app):
+    def test_retry(self, app):
         """
-        test get method to return the information of first route of first user
+        test that a retry gives the original answer without a second route
         """
-        resp = app.get(self.RESOURCE_URL)
-        assert resp.status_code == 200
-        body = json.loads(resp.data)
-        _check_namespace(app, body, "routes")
-        # check content
-        assert body["date"] == datetime.today().strftime('%Y-%m-%d')
-        assert body["location"] == "Oulun Kiipeilykeskus"
-        assert body["discipline"] == "Bouldering"
-        assert body["grade"] == "6A"
-        _check_control_get_method("self", app, body)
-        _check_control_get_method("profile", app, body)
-        _check_control_get_method("routes:routes-all", app, body)
-        _check_control_get_method("users:climbed-by", app, body)
-        _check_control_get_method("locations:in-location", app, body)
-        _check_control_get_method("disciplines:in-discipline", app, body)
-        _check_control_get_method("grades:in-grade", app, body)
-        _check_control_put_method("routes:edit-route", app, body, "routes")
-        _check_control_delete_method("routes:delete", app, body)
-
-        # and see also that we get 404 if we try to access invalid user
-        resp = app.get(self.INVALID_USER_URL)
-        assert resp.status_code == 404
-        # and same for invalid route
-        resp = app.get(self.INVALID_ROUTE_URL)
-        assert resp.status_code == 404
+        from routetracker.instrumentation import query_budget
+        from routetracker.models import IdempotencyKey
 
-    def test_put_valid_request(self, app):
-        """
-        Tests put method to edit information of a route
-        """
+        headers = {"Idempotency-Key": "abc"}
         valid = _route_template()
+        resp = app.post(self.RESOURCE_URL, json=valid, headers=headers)
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        assert "Idempotent-Replayed" not in resp.headers
 
-        # wrong Content
-        resp = app.put(self.RESOURCE_URL, data=json.dumps(valid))
-        assert resp.status_code == 415
+        # only the stored key is looked up
+        with query_budget(1, "RouteCollection.post"):
+            resp = app.post(self.RESOURCE_URL, json=valid, headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Location"] == location
+        assert resp.headers["Idempotent-Replayed"] == "true"
+        with app.application.app_context():
+            assert Route.query.filter_by(userId=1).count() == 6
+
+        # same key with another body
+        valid["grade"] = "7A"
+        resp = app.post(self.RESOURCE_URL, json=valid, headers=headers)
+        assert resp.status_code == 422
+
+        # same key for another resource is a different key
+        resp = app.post("/api/users/2/routes/", json=valid, headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Location"] != location
 
-        # for user not found
-        resp = app.put(self.INVALID_USER_URL, json=valid)
-        assert resp.status_code == 404
+        # new users too
+        user = _user_template(3)
+        resp = app.post("/api/users/", json=user, headers=headers)
+        assert resp.status_code == 201
+        resp = app.post("/api/users/", json=user, headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Idempotent-Replayed"] == "true"
 
-        # for route not found
-        resp = app.put(self.INVALID_ROUTE_URL, json=valid)
-        assert resp.status_code == 404
+        # without a key the request is run again
+        resp = app.post("/api/users/", json=user)
+        assert resp.status_code == 409
 
-        # change only location
-        valid["location"] = "moon"
-        resp = app.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 204
+        # the keys are deleted with their user
+        with app.application.app_context():
+            assert sorted(row.userId for row in IdempotencyKey.query) == [1, 2, 3]
+        assert app.delete("/api/users/1/").status_code == 204
+        with app.application.app_context():
+            assert sorted(row.userId for row in IdempotencyKey.query) == [2, 3]
 
-        # try wrong date information
-        valid["date"] = "yesterday"
-        resp = app.put(self.RESOURCE_URL, json=valid)
+    def test_errors_not_stored(self, app):
+        """
+        test that a failed request can be sent again with the same key
+        """
+        headers = {"Idempotency-Key": "abc"}
+        invalid = _route_template()
+        invalid["date"] = "yesterday"
+        resp = app.post(self.RESOURCE_URL, json=invalid, headers=headers)
         assert resp.status_code == 400
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        assert resp.status_code == 201
+        assert "Idempotent-Replayed" not in resp.headers
 
-        # location, discipline, or grade can not be empty string
-        valid = _route_template()
-        valid["location"] = ""
-        resp = app.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 400
-        valid = _route_template()
-        valid["discipline"] = ""
-        resp = app.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 400
-        valid = _route_template()
-        valid["grade"] = ""
-        resp = app.put(self.RESOURCE_URL, json=valid)
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers={"Idempotency-Key": ""})
         assert resp.status_code == 400
 
-        # should be accepted without extraInfo
-        valid = _route_template()
-        valid.pop("extraInfo")
-        resp = app.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 204
-
-        # remove email to see that it is not accepted
-        valid = _route_template()
-        valid.pop("date")
-        resp = app.put(self.RESOURCE_URL, json=valid)
-        assert resp.status_code == 400
+    def test_concurrent(self, app, monkeypatch):
+        """
+        test that two overlapping requests with the same key create one route
+        """
+        import threading
+        import routetracker.resources.route
+
+        entered = threading.Event()
+        release = threading.Event()
+        validate = routetracker.resources.route.validate
+
+        def slow_validate(*args):
+            # the first request waits inside the handler, with its key reserved
+            if not entered.is_set():
+                entered.set()
+                release.wait(10)
+            return validate(*args)
+
+        monkeypatch.setattr(routetracker.resources.route, "validate", slow_validate)
+        headers = {"Idempotency-Key": "abc"}
+        responses = []
+
+        def post():
+            client = app.application.test_client()
+            responses.append(client.post(self.RESOURCE_URL, json=_route_template(), headers=headers))
+
+        first = threading.Thread(target=post)
+        first.start()
+        assert entered.wait(10)
+        second = threading.Thread(target=post)
+        second.start()
+        # the second request waits for the key of the first one
+        second.join(0.5)
+        assert second.is_alive()
+        release.set()
+        first.join(10)
+        second.join(10)
+
+        assert responses[0].status_code == 201
+        assert "Idempotent-Replayed" not in responses[0].headers
+        assert responses[1].status_code in (201, 409)
+        if responses[1].status_code == 201:
+            assert responses[1].headers["Location"] == responses[0].headers["Location"]
+        with app.application.app_context():
+            assert Route.query.filter_by(userId=1).count() == 6
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        assert resp.headers["Location"] == responses[0].headers["Location"]
+        assert resp.headers["Idempotent-Replayed"] == "true"
+
+    def test_bounded(self, app):
+        """
+        test that expired and the oldest keys are dropped
+        """
+        from routetracker.models import IdempotencyKey
+
+        app.application.config["IDEMPOTENCY_MAX_KEYS"] = 2
+        for key in ["a", "b", "c"]:
+            resp = app.post(self.RESOURCE_URL, json=_route_template(), headers={"Idempotency-Key": key})
+            assert resp.status_code == 201
+        with app.application.app_context():
+            assert [row.key for row in IdempotencyKey.query.order_by(IdempotencyKey.id)] == ["b", "c"]
+
+        # an expired key runs the request again
+        app.application.config["IDEMPOTENCY_TTL"] = 0
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers={"Idempotency-Key": "c"})
+        assert resp.status_code == 201
+        assert "Idempotent-Replayed" not in resp.headers
+        with app.application.app_context():
+            assert [row.key for row in IdempotencyKey.query] == ["c"]
 
-    def test_delete(self, app):
+    def test_abandoned(self, app):
         """
-        test delete method
+        test that a reservation without a response is taken over after the
+        lease, e.g. when the process died between the two commits
         """
-        # delete user
-        resp = app.delete(self.RESOURCE_URL)
-        assert resp.status_code == 204
-        # cannot delete it second time
-        resp = app.delete(self.RESOURCE_URL)
-        assert resp.status_code == 404
-        # cannot delete route for user that does not exist
-        resp = app.delete(self.INVALID_USER_URL)
-        assert resp.status_code == 404
-        # cannot delete route that does not exist
-        resp = app.delete(self.INVALID_ROUTE_URL)
-        assert resp.status_code == 404
+        from routetracker.models import IdempotencyKey
 
+        headers = {"Idempotency-Key": "abc"}
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        with app.application.app_context():
+            IdempotencyKey.query.update({"status": None, "location": None})
+            db.session.commit()
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        assert resp.status_code == 409
 
-class TestLocationCollection(object):
+        app.application.config["IDEMPOTENCY_LEASE"] = 0
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        assert resp.status_code == 201
+        assert "Idempotent-Replayed" not in resp.headers
+        resp = app.post(self.RESOURCE_URL, json=_route_template(), headers=headers)
+        assert resp.headers["Idempotent-Replayed"] == "true"
+
+
+class TestEmbed(object):
     """
-    Test the location collection resource: GET
+    Test inlining the related collections with the embed parameter
     """
 
-    RESOURCE_URL = "/api/users/1/routes/locations/"
-    INVALID_URL = "/api/users/saddsa/routes/locations/"
-
-    def test_get(self, app):
+    def test_route_collection(self, app):
         """
-        test get method to return the locations lists for user
+        test that the embedded collections match the collection resources
         """
-        # for user not found
-        resp = app.get(self.INVALID_URL)
+        resp = app.get("/api/users/1/routes/?embed=locations,disciplines,grades")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 5
+        for name in ["locations", "disciplines", "grades"]:
+            expected = json.loads(app.get("/api/users/1/routes/{}/".format(name)).data)
+            assert body["embedded"][name] == expected
+
+        # nothing is embedded by default, and routes are already the items
+        body = json.loads(app.get("/api/users/1/routes/").data)
+        assert "embedded" not in body
+        resp = app.get("/api/users/1/routes/?embed=routes")
+        assert resp.status_code == 400
+        resp = app.get("/api/users/saddsa/routes/?embed=grades")
         assert resp.status_code == 404
 
-        # test the list
-        resp = app.get(self.RESOURCE_URL)
+    def test_user_item(self, app):
+        """
+        test embedding the routes and their related collections to the user
+        """
+        resp = app.get("/api/users/1/?embed=routes,grades")
         assert resp.status_code == 200
         body = json.loads(resp.data)
-        _check_namespace(app, body, "locations")
-        _check_control_get_method("self", app, body)
-        _check_control_get_method("users:climbed-by", app, body)
-        _check_control_get_method("routes:routes-all", app, body)
-        assert len(body["items"]) == 4  # number of UNIQUE locations created above
-        for item in body["items"]:
-            assert "location" in item
-            _check_control_get_method("self", app, item)
-            _check_control_get_method("locations:in-location", app, item)
-            _check_control_get_method("profile", app, item)
+        assert body["email"] == "1email@url.com"
+        assert sorted(body["embedded"]) == ["grades", "routes"]
+        assert body["embedded"]["routes"] == json.loads(app.get("/api/users/1/routes/").data)
+        assert body["embedded"]["grades"] == json.loads(app.get("/api/users/1/routes/grades/").data)
 
+        # a user without routes gets empty collections
+        resp = app.post("/api/users/", json=_user_template())
+        body = json.loads(app.get(resp.headers["Location"] + "?embed=routes,locations").data)
+        assert body["embedded"]["routes"]["items"] == []
+        assert body["embedded"]["locations"]["items"] == []
 
-class TestLocationItem(object):
+        resp = app.get("/api/users/1/?embed=routes,users")
+        assert resp.status_code == 400
+
+
+class TestRouteBulk(object):
+    """
+    Test the bulk edit and delete of the routes matching a filter
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+    INVALID_URL = "/api/users/saddsa/routes/?location=1"
+
+    def test_filters(self, app):
+        """
+        test that the bulk operations need a valid filter
+        """
+        resp = app.delete(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL, json={"grade": "7A"})
+        assert resp.status_code == 400
+        resp = app.delete(self.RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+        resp = app.delete(self.RESOURCE_URL + "?location=moon")
+        assert resp.status_code == 400
+        resp = app.delete(self.RESOURCE_URL + "?location=99999999999999999999999")
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL + "?grade=0", json={"grade": "7A"})
+        assert resp.status_code == 400
+        resp = app.get("/api/locations/1/routes/?discipline=-1")
+        assert resp.status_code == 400
+        resp = app.delete(self.INVALID_URL)
+        assert resp.status_code == 404
+        resp = app.patch(self.INVALID_URL, json={"grade": "7A"})
+        assert resp.status_code == 404
+
+        # the routes are all still there
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 5
+
+    def test_patch(self, app):
+        """
+        test moving the routes of one location to another
+        """
+        from routetracker.events import ROUTE_LISTENERS
+        from routetracker.instrumentation import recorded_queries
+
+        resp = app.patch(self.RESOURCE_URL + "?location=1", data=json.dumps({"location": "Moved"}))
+        assert resp.status_code == 415
+        resp = app.patch(self.RESOURCE_URL + "?location=1", json=["Moved"])
+        assert resp.status_code == 400
+        assert json.loads(resp.data)["@error"]["@message"] == "Invalid JSON document"
+        resp = app.patch(self.RESOURCE_URL + "?location=1", json={"location": ""})
+        assert resp.status_code == 400
+
+        changed = []
+
+        def listener(user, changes):
+            changed.append(user)
+
+        ROUTE_LISTENERS.append(listener)
+        try:
+            with recorded_queries("RouteCollection.patch") as recorder:
+                resp = app.patch(self.RESOURCE_URL + "?location=1", json={"location": "Moved", "grade": "7A"})
+        finally:
+            ROUTE_LISTENERS.remove(listener)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["updated"] == 2
+        # one statement for all routes, and the listeners are told once
+        assert len([s for s in recorder.statements if s.startswith("UPDATE route")]) == 1
+        assert changed == [1]
+
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert [item["location"] for item in body["items"]].count("Moved") == 2
+        assert [item["grade"] for item in body["items"]].count("7A") == 2
+        # routes of other users are not touched
+        body = json.loads(app.get("/api/users/2/routes/").data)
+        assert "Moved" not in [item["location"] for item in body["items"]]
+
+    def test_delete(self, app):
+        """
+        test deleting the routes of a date range and a discipline
+        """
+        from routetracker.instrumentation import query_budget
+
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        _check_control_get_method("routes:routes-all", app, body)
+        assert body["@controls"]["routes:bulk-delete"]["method"] == "DELETE"
+        assert body["@controls"]["routes:bulk-edit"]["method"] == "PATCH"
+
+        today = datetime.today().strftime('%Y-%m-%d')
+        url = self.RESOURCE_URL + "?from={0}&to={0}&discipline=1".format(today)
+        # the change sequence (update and select), tombstones and the delete
+        with query_budget(4, "RouteCollection.delete"):
+            resp = app.delete(url)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["deleted"] == 2
+
+        # nothing left to delete
+        resp = app.delete(url)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["deleted"] == 0
+        resp = app.delete(self.RESOURCE_URL + "?to=2000-01-01")
+        assert json.loads(resp.data)["deleted"] == 0
+
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 3
+        body = json.loads(app.get("/api/users/2/routes/").data)
+        assert len(body["items"]) == 5
+
+
+class TestChangeFeed(object):
+    """
+    Test the change feed resource: GET
+    """
+
+    RESOURCE_URL = "/api/users/1/changes/"
+
+    def _changes(self, app, since=None):
+        url = self.RESOURCE_URL if since is None else self.RESOURCE_URL + "?since={}".format(since)
+        resp = app.get(url)
+        assert resp.status_code == 200
+        return json.loads(resp.data)
+
+    def test_get(self, app):
+        """
+        test synchronizing the routes incrementally
+        """
+        # the full state to begin with
+        body = self._changes(app)
+        assert [(item["type"], item["op"]) for item in body["changes"]] == [("user", "upsert")] + [("route", "upsert")] * 5
+        _check_control_get_method("routes:changes", app, body)
+        token = body["next"]
+        assert self._changes(app, token)["changes"] == []
+        assert self._changes(app, token)["next"] == token
+
+        # a patch without changes is not a change
+        app.patch("/api/users/1/routes/2/", json={"grade": "6A+"})
+        assert self._changes(app, token)["changes"] == []
+
+        resp = app.post("/api/users/1/routes/", json=_route_template())
+        new_id = int(resp.headers["Location"].rstrip("/").split("/")[-1])
+        app.patch("/api/users/1/routes/2/", json={"grade": "7A"})
+        app.delete("/api/users/1/routes/3/")
+        app.patch("/api/users/2/routes/7/", json={"grade": "7A"})
+        body = self._changes(app, token)
+        assert [(item["op"], item["id"]) for item in body["changes"]] == [("upsert", new_id), ("upsert", 2), ("delete", 3)]
+        assert body["changes"][1]["grade"] == "7A"
+        assert body["next"] > token
+        token = body["next"]
+
+        # set based writes are in the feed too
+        app.patch("/api/users/1/routes/?location=1", json={"extraInfo": "moved"})
+        app.delete("/api/users/1/routes/?grade=3")
+        body = self._changes(app, token)
+        changes = [(item["op"], item["id"]) for item in body["changes"]]
+        assert changes == [("upsert", 1), ("upsert", 2), ("delete", 4), ("delete", 5)]
+        token = body["next"]
+
+        app.patch("/api/users/1/", json={"firstName": "changed"})
+        body = self._changes(app, token)
+        assert [(item["type"], item["firstName"]) for item in body["changes"]] == [("user", "changed")]
+        token = body["next"]
+
+        # the deleted user is the last change
+        app.delete("/api/users/1/")
+        body = self._changes(app, token)
+        assert [(item["type"], item["op"]) for item in body["changes"]] == [("user", "delete")]
+        assert app.get(self.RESOURCE_URL + "?since={}".format(body["next"])).status_code == 404
+        assert app.get(self.RESOURCE_URL).status_code == 404
+
+    def test_prune(self, app):
+        """
+        test that old tombstones are pruned and old tokens need a resync
+        """
+        from datetime import timedelta
+        from routetracker.models import Tombstone, prune_tombstones
+
+        token = self._changes(app)["next"]
+        app.delete("/api/users/1/routes/1/")
+        app.delete("/api/users/1/routes/?grade=3")
+        app.delete("/api/users/2/routes/6/")
+        newer = self._changes(app, token)["next"]
+        app.delete("/api/users/1/routes/2/")
+
+        with app.application.app_context():
+            assert prune_tombstones(datetime.utcnow() - timedelta(days=1)) == 0
+            assert Tombstone.query.count() == 5
+            # the newest tombstone of each user is kept
+            assert prune_tombstones(datetime.utcnow() + timedelta(seconds=1)) == 3
+            assert sorted(tombstone.entityId for tombstone in Tombstone.query) == [2, 6]
+
+        resp = app.get(self.RESOURCE_URL + "?since={}".format(token))
+        assert resp.status_code == 410
+        body = self._changes(app, newer)
+        assert [(item["op"], item["id"]) for item in body["changes"]] == [("delete", 2)]
+        # starting again from the full state
+        body = self._changes(app)
+        assert self._changes(app, body["next"])["changes"] == []
+
+    def test_invalid(self, app):
+        """
+        test invalid tokens and users
+        """
+        resp = app.get(self.RESOURCE_URL + "?since=yesterday")
+        assert resp.status_code == 400
+        resp = app.get(self.RESOURCE_URL + "?since=99999999999999999999999")
+        assert resp.status_code == 400
+        resp = app.get(self.RESOURCE_URL + "?since=-1")
+        assert resp.status_code == 400
+        resp = app.get("/api/users/saddsa/changes/?since=0")
+        assert resp.status_code == 404
+
+
+class TestLeaderboards(object):
+    """
+    Test the leaderboard resources: GET, POST
+    """
+
+    RESOURCE_URL = "/api/leaderboards/"
+    TOPROPE_URL = "/api/leaderboards/disciplines/2/"
+
+    def _add_toprope_route(self, app, user, grade):
+        route = _route_template()
+        route["discipline"] = "Toprope"
+        route["grade"] = grade
+        resp = app.post("/api/users/{}/routes/".format(user), json=route)
+        assert resp.status_code == 201
+        return resp.headers["Location"]
+
+    def test_get(self, app):
+        """
+        test the leaderboards and that writes are applied to them
+        """
+        from routetracker.instrumentation import query_budget
+
+        _recompute_leaderboards(app)
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "leaderboards")
+        _check_control_get_method("self", app, body)
+        # three disciplines and four locations
+        assert len(body["items"]) == 7
+        for item in body["items"]:
+            _check_control_get_method("self", app, item)
+            _check_control_get_method("leaderboards:by-volume", app, item)
+
+        # both test users have climbed two toprope routes, 6a+ and 6b
+        self._add_toprope_route(app, 2, "7a")
+        location = self._add_toprope_route(app, 1, "6a")
+        _wait_for_jobs(app)
+        resp = app.get(self.TOPROPE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_control_get_method("leaderboards:leaderboards-all", app, body)
+        _check_control_get_method("leaderboards:by-grade", app, body)
+        _check_control_get_method("leaderboards:by-volume", app, body)
+        assert body["name"] == "Toprope"
+        assert [(item["rank"], item["firstName"], item["routes"], item["topGrade"]) for item in body["items"]] == [
+            (1, "First2", 3, "7a"),
+            (2, "First1", 3, "6b")
+        ]
+        _check_control_get_method("self", app, body["items"][0])
+
+        # reading never refreshes, only the discipline and the entries
+        with query_budget(2, "Leaderboard.get"):
+            resp = app.get(self.TOPROPE_URL + "?by=volume&limit=1")
+        body = json.loads(resp.data)
+        assert [(item["firstName"], item["routes"]) for item in body["items"]] == [("First2", 3)]
+
+        app.delete(location)
+        self._add_toprope_route(app, 1, "5")
+        _wait_for_jobs(app)
+        body = json.loads(app.get(self.TOPROPE_URL + "?by=volume").data)
+        assert [(item["firstName"], item["routes"]) for item in body["items"]] == [("First2", 3), ("First1", 3)]
+        self._add_toprope_route(app, 1, "unknown")
+        _wait_for_jobs(app)
+        body = json.loads(app.get(self.TOPROPE_URL + "?by=volume").data)
+        assert [(item["firstName"], item["routes"]) for item in body["items"]] == [("First1", 4), ("First2", 3)]
+
+        # deleted users leave the leaderboards with the user
+        app.delete("/api/users/2/")
+        body = json.loads(app.get(self.TOPROPE_URL).data)
+        assert [item["firstName"] for item in body["items"]] == ["First1"]
+
+        # locations, the first one has two routes of each user
+        body = json.loads(app.get("/api/leaderboards/locations/1/?by=volume").data)
+        assert [(item["firstName"], item["routes"], item["topGrade"]) for item in body["items"]] == [
+            ("First1", 2, "6a+")
+        ]
+
+        assert app.get("/api/leaderboards/grades/1/").status_code == 404
+        assert app.get("/api/leaderboards/disciplines/100/").status_code == 404
+        assert app.get(self.TOPROPE_URL + "?by=name").status_code == 400
+        assert app.get(self.TOPROPE_URL + "?limit=0").status_code == 400
+        assert app.get(self.TOPROPE_URL + "?limit=many").status_code == 400
+
+    def test_recompute(self, app):
+        """
+        test building the leaderboards again in a job, on a process pool and
+        when the table is created
+        """
+        from routetracker.leaderboards import recompute_leaderboards
+        from routetracker.models import LeaderboardEntry
+
+        def entries():
+            with app.application.app_context():
+                return sorted(
+                    (entry.board, entry.itemId, entry.userId, entry.routes, entry.topGrade)
+                    for entry in LeaderboardEntry.query
+                    )
+
+        _recompute_leaderboards(app)
+        expected = entries()
+        assert len(expected) == 14
+
+        resp = app.post(self.RESOURCE_URL)
+        assert resp.status_code == 202
+        assert app.application.extensions["routetracker_jobs"].wait(10)
+        body = json.loads(app.get(resp.headers["Location"]).data)
+        assert body["kind"] == "recompute-leaderboards"
+        assert body["status"] == "done"
+        _check_control_get_method("jobs:result", app, body)
+        assert entries() == expected
+
+        with app.application.app_context():
+            assert recompute_leaderboards(workers=2) == 14
+        assert entries() == expected
+
+        # a leaderboard table created in an existing database is filled
+        with app.application.app_context():
+            LeaderboardEntry.__table__.drop(db.engine)
+            db.create_all()
+        assert entries() == expected
+
+
+class TestEveryonesRoutes(object):
+    """
+    Test the routes and activity of locations, disciplines and grades over
+    all users: GET
+    """
+
+    RESOURCE_URL = "/api/locations/1/routes/"
+    ACTIVITY_URL = "/api/locations/1/activity/"
+
+    def test_get(self, app):
+        """
+        test listing the routes of a location page by page
+        """
+        from routetracker.instrumentation import query_budget
+
+        resp = app.get("/api/locations/100/routes/")
+        assert resp.status_code == 404
+
+        # both users have climbed two routes in the first location
+        with query_budget(1, "LocationRoutes.get"):
+            resp = app.get(self.RESOURCE_URL + "?limit=3")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "locations")
+        _check_control_get_method("self", app, body)
+        assert body["name"] == "Oulun Kiipeilykeskus"
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == [
+            "/api/users/2/routes/7/", "/api/users/2/routes/6/", "/api/users/1/routes/2/"
+        ]
+        for item in body["items"]:
+            assert item["location"] == "Oulun Kiipeilykeskus"
+            _check_control_get_method("self", app, item)
+            _check_control_get_method("users:climbed-by", app, item)
+
+        resp = app.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == ["/api/users/1/routes/1/"]
+        assert "next" not in body["@controls"]
+
+        # filters
+        body = json.loads(app.get("/api/disciplines/2/routes/").data)
+        assert len(body["items"]) == 4
+        assert set(item["discipline"] for item in body["items"]) == set(["Toprope"])
+        body = json.loads(app.get("/api/grades/2/routes/?location=2").data)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == [
+            "/api/users/2/routes/8/", "/api/users/1/routes/3/"
+        ]
+        body = json.loads(app.get(self.RESOURCE_URL + "?from=2100-01-01").data)
+        assert body["items"] == []
+
+        # a parameter named like the URL variable is not used in the links
+        resp = app.get(self.RESOURCE_URL + "?item=2&limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["@controls"]["self"]["href"] == self.RESOURCE_URL + "?limit=1"
+        assert app.get(body["@controls"]["next"]["href"]).status_code == 200
+
+        assert app.get(self.RESOURCE_URL + "?limit=1000").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?after=yesterday").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?after=2020-01-01_99999999999999999999999").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?to=today").status_code == 400
+
+    def test_activity(self, app):
+        """
+        test the daily numbers of routes and climbers of a location
+        """
+        from routetracker.instrumentation import query_budget
+
+        resp = app.get("/api/locations/100/activity/")
+        assert resp.status_code == 404
+
+        with query_budget(1, "LocationActivity.get"):
+            resp = app.get(self.ACTIVITY_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "locations")
+        _check_control_get_method("self", app, body)
+        _check_control_get_method("up", app, body)
+        assert body["items"] == [{"date": date.today().isoformat(), "routes": 4, "climbers": 2}]
+
+        assert app.get(self.ACTIVITY_URL + "?item=2").status_code == 200
+        body = json.loads(app.get(self.ACTIVITY_URL + "?from=2100-01-01").data)
+        assert body["items"] == []
+        body = json.loads(app.get("/api/grades/3/activity/?discipline=2").data)
+        assert body["items"][0]["routes"] == 2
+
+        # linked from the locations of a user
+        body = json.loads(app.get("/api/users/1/routes/locations/1/").data)
+        _check_control_get_method("locations:routes-everyone", app, body)
+        _check_control_get_method("locations:activity", app, body)
+
+
+class TestRecentRoutes(object):
+    """
+    Test the latest routes of all users: GET
+    """
+
+    RESOURCE_URL = "/api/routes/recent/"
+
+    def test_get(self, app):
+        """
+        test that the recent routes are served from memory and follow the
+        writes
+        """
+        from routetracker.instrumentation import query_budget
+
+        # the buffer is warmed on the first request, the tables did not
+        # exist when the app was created
+        with query_budget(1, "RecentRoutes.get"):
+            resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "routes")
+        _check_control_get_method("self", app, body)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]][:3] == [
+            "/api/users/2/routes/10/", "/api/users/2/routes/9/", "/api/users/2/routes/8/"
+        ]
+        assert len(body["items"]) == 10
+        for item in body["items"]:
+            _check_control_get_method("self", app, item)
+            _check_control_get_method("users:climbed-by", app, item)
+
+        with query_budget(0, "RecentRoutes.get"):
+            body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 10
+
+        # a new route is added to the buffer on write
+        resp = app.post("/api/users/1/routes/", json=_route_template())
+        assert resp.status_code == 201
+        with query_budget(0, "RecentRoutes.get"):
+            body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert body["items"][0]["@controls"]["self"]["href"] == resp.headers["Location"]
+        assert body["items"][0]["date"] == "2030-12-31"
+        assert body["items"][0]["grade"] == "9a"
+
+        # other writes warm the buffer again
+        app.delete(resp.headers["Location"])
+        with query_budget(1, "RecentRoutes.get"):
+            body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 10
+        assert body["items"][0]["@controls"]["self"]["href"] == "/api/users/2/routes/10/"
+
+        # linked from the users
+        body = json.loads(app.get("/api/users/").data)
+        _check_control_get_method("routes:recent", app, body)
+
+    def test_ring_buffer(self):
+        """
+        test that the buffer keeps the newest routes in order
+        """
+        from routetracker.recent import RouteRingBuffer
+
+        buffer = RouteRingBuffer(3)
+        assert buffer.entries() is None
+        entries = [{"route": route, "date": "2024-01-0{}".format(day)} for route, day in [(1, 2), (2, 1), (3, 3)]]
+        buffer.warm(entries)
+        assert [entry["route"] for entry in buffer.entries()] == [3, 1, 2]
+        buffer.add([
+            {"route": 4, "date": "2024-01-02"},
+            {"route": 5, "date": "2023-12-31"},
+            {"route": 6, "date": "2024-01-04"}
+        ])
+        assert [entry["route"] for entry in buffer.entries()] == [6, 3, 4]
+        buffer.invalidate()
+        assert buffer.entries() is None
+
+
+class TestRouteSelection(object):
+    """
+    Test getting the routes of several users and routes at once: GET
+    """
+
+    RESOURCE_URL = "/api/routes/"
+
+    def test_get(self, app):
+        """
+        test selecting routes by users and ids
+        """
+        from routetracker.instrumentation import query_budget
+
+        with query_budget(1, "RouteSelection.get"):
+            resp = app.get(self.RESOURCE_URL + "?users=1,2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "routes")
+        _check_control_get_method("self", app, body)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == [
+            "/api/users/{}/routes/{}/".format(1 if route <= 5 else 2, route) for route in range(1, 11)
+        ]
+        for item in body["items"]:
+            _check_control_get_method("self", app, item)
+            _check_control_get_method("users:climbed-by", app, item)
+
+        # users and routes are combined, routes of missing users are not found
+        body = json.loads(app.get(self.RESOURCE_URL + "?users=2,5&routes=1,3,8,100").data)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == [
+            "/api/users/1/routes/1/", "/api/users/1/routes/3/"
+        ] + ["/api/users/2/routes/{}/".format(route) for route in range(6, 11)]
+        body = json.loads(app.get(self.RESOURCE_URL + "?users=1,2&location=2").data)
+        assert set(item["location"] for item in body["items"]) == set(["Magic Woods"])
+
+        assert app.get(self.RESOURCE_URL).status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=1,a").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=1&from=today").status_code == 400
+        ids = ",".join(str(i) for i in range(1, 102))
+        assert app.get(self.RESOURCE_URL + "?routes=" + ids).status_code == 400
+        # ids out of the range of the database
+        assert app.get(self.RESOURCE_URL + "?users=99999999999999999999999").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?routes=0,1").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=-1").status_code == 400
+
+        # paged by user and id
+        hrefs = []
+        url = self.RESOURCE_URL + "?users=1,2&limit=4"
+        while url:
+            with query_budget(1, "RouteSelection.get"):
+                body = json.loads(app.get(url).data)
+            assert len(body["items"]) <= 4
+            hrefs.extend(item["@controls"]["self"]["href"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+        assert hrefs == ["/api/users/{}/routes/{}/".format(1 if route <= 5 else 2, route) for route in range(1, 11)]
+        assert app.get(self.RESOURCE_URL + "?users=1&limit=201").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=1&after=1").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=1&after=1_99999999999999999999999").status_code == 400
+        assert app.get(self.RESOURCE_URL + "?users=1&after=-1_1").status_code == 400
+
+        # linked from the users
+        body = json.loads(app.get("/api/users/").data)
+        assert body["@controls"]["routes:routes-of-users"]["isHrefTemplate"]
+
+
+class TestAutocomplete(object):
+    """
+    Test the suggestions of location, discipline and grade names: GET
+    """
+
+    RESOURCE_URL = "/api/autocomplete/locations/"
+
+    def test_get(self, app):
+        """
+        test that the names are suggested by prefix and usage, and follow
+        the writes
+        """
+        from routetracker.instrumentation import query_budget
+
+        resp = app.get(self.RESOURCE_URL + "?prefix=")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "locations")
+        _check_control_get_method("self", app, body)
+        assert len(body["items"]) == 4
+        for item in body["items"]:
+            _check_control_get_method("self", app, item)
+
+        with query_budget(0, "NameSuggestions.get"):
+            body = json.loads(app.get(self.RESOURCE_URL + "?prefix=oUL").data)
+        assert [(item["name"], item["routes"]) for item in body["items"]] == [("Oulun Kiipeilykeskus", 4)]
+        body = json.loads(app.get(self.RESOURCE_URL + "?prefix=x").data)
+        assert body["items"] == []
+
+        # new names and routes are counted on write
+        route = _route_template()
+        route["location"] = "Oulu outdoors"
+        for i in range(5):
+            app.post("/api/users/1/routes/", json=route)
+        with query_budget(0, "NameSuggestions.get"):
+            body = json.loads(app.get(self.RESOURCE_URL + "?prefix=oulu&limit=1").data)
+        assert [(item["name"], item["routes"]) for item in body["items"]] == [("Oulu outdoors", 5)]
+        body = json.loads(app.get("/api/autocomplete/grades/?prefix=9").data)
+        assert [(item["name"], item["routes"]) for item in body["items"]] == [("9a", 5)]
+
+        # deletes are applied when the index is read again
+        app.application.extensions["routetracker_autocomplete"].max_age = 0
+        app.delete("/api/users/1/routes/", query_string={"location": 5})
+        body = json.loads(app.get(self.RESOURCE_URL + "?prefix=oulu").data)
+        assert [(item["name"], item["routes"]) for item in body["items"]] == [
+            ("Oulun Kiipeilykeskus", 4), ("Oulu outdoors", 0)
+        ]
+
+        assert app.get("/api/autocomplete/users/").status_code == 404
+        resp = app.get(self.RESOURCE_URL + "?kind=grades&prefix=O&limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["@controls"]["self"]["href"] == self.RESOURCE_URL + "?prefix=O&limit=2"
+        assert app.get(self.RESOURCE_URL + "?limit=11").status_code == 400
+
+        # linked from the routes
+        body = json.loads(app.get("/api/users/1/routes/").data)
+        assert body["@controls"]["routes:autocomplete-grades"]["isHrefTemplate"]
+
+    def test_prefix_index(self):
+        """
+        test ranking the names of the prefix trie
+        """
+        from routetracker.autocomplete import PrefixIndex
+
+        index = PrefixIndex()
+        index.load([(1, "Lead", 3), (2, "Lead outdoors", 5), (3, "Bouldering", 1)])
+        assert index.lookup("le") == [(2, "Lead outdoors", 5), (1, "Lead", 3)]
+        assert index.lookup("lead ") == [(2, "Lead outdoors", 5)]
+        assert index.lookup("", 1) == [(2, "Lead outdoors", 5)]
+        index.add(1, "Lead", 3)
+        assert index.lookup("L") == [(1, "Lead", 6), (2, "Lead outdoors", 5)]
+        index.add(4, "Boulder", 0)
+        assert index.lookup("bould") == [(3, "Bouldering", 1), (4, "Boulder", 0)]
+        assert len(index) == 4
+
+
+class TestArchive(object):
+    """
+    Test archiving old routes and reading them with history=full
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+
+    def _archive(self, app):
+        """
+        add two old toprope routes and a new one to the first user and
+        archive the routes older than two years
+        """
+        from routetracker.archive import archive_cutoff, archive_routes
+
+        route = _route_template()
+        route["date"] = "2001-05-01"
+        route["discipline"] = "Toprope"
+        old = [app.post(self.RESOURCE_URL, json=route).headers["Location"] for i in range(2)]
+        app.post(self.RESOURCE_URL, json=_route_template())
+        with app.application.app_context():
+            assert archive_routes(archive_cutoff(2), chunk_size=1) == 2
+        return old
+
+    def test_history(self, app):
+        """
+        test that the archived routes are only read with history=full
+        """
+        old = self._archive(app)
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 6
+        assert not any(item.get("archived") for item in body["items"])
+        _check_control_get_method("routes:full-history", app, body)
+        assert app.get(old[0]).status_code == 404
+
+        resp = app.get(self.RESOURCE_URL + "?history=full&embed=disciplines")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 8
+        archived = [item for item in body["items"] if item.get("archived")]
+        assert [item["date"] for item in archived] == ["2001-05-01", "2001-05-01"]
+        assert body["embedded"]["disciplines"]["items"]
+        for item in archived:
+            _check_control_get_method("self", app, item)
+            assert "routes:edit" not in item["@controls"]
+
+        body = json.loads(app.get(old[0] + "?history=full").data)
+        assert body["archived"] is True
+        assert "routes:edit" not in body["@controls"]
+        _check_control_delete_method("routes:delete", app, body)
+        assert app.get(old[0] + "?history=full").status_code == 404
+        assert app.delete(old[1]).status_code == 404
+        assert app.delete(old[1] + "?history=full").status_code == 204
+        assert len(json.loads(app.get(self.RESOURCE_URL + "?history=full").data)["items"]) == 6
+
+        assert app.get(self.RESOURCE_URL + "?history=all").status_code == 400
+        assert app.get(self.RESOURCE_URL + "1/?history=all").status_code == 400
+
+    def test_derived_state(self, app):
+        """
+        test that the leaderboards and the change feed follow the archiving,
+        and that the archived routes are deleted with the user
+        """
+        from routetracker.archive import archive_cutoff
+        from routetracker.models import ArchivedRoute
+
+        _recompute_leaderboards(app)
+        leaderboard = json.loads(app.get("/api/leaderboards/disciplines/2/").data)
+        since = json.loads(app.get("/api/users/1/changes/").data)["next"]
+        old = self._archive(app)
+        _wait_for_jobs(app)
+        body = json.loads(app.get("/api/leaderboards/disciplines/2/").data)
+        assert [item["routes"] for item in body["items"]] == [item["routes"] for item in leaderboard["items"]]
+
+        # archived routes are not deleted for the clients of the change feed
+        body = json.loads(app.get("/api/users/1/changes/?since={}".format(since)).data)
+        assert [item["op"] for item in body["changes"]] == ["upsert"]
+        app.delete(old[0] + "?history=full")
+        body = json.loads(app.get("/api/users/1/changes/?since={}".format(body["next"])).data)
+        assert [(item["op"], item["id"]) for item in body["changes"]] == [("delete", int(old[0].split("/")[-2]))]
+
+        assert app.delete("/api/users/1/").status_code == 204
+        with app.application.app_context():
+            assert ArchivedRoute.query.count() == 0
+
+        assert archive_cutoff(1, date(2024, 2, 29)) == date(2023, 2, 28)
+
+
+class TestTrainingLoad(object):
+    """
+    Test the training load analytics resource: GET
+    """
+
+    RESOURCE_URL = "/api/users/1/analytics/"
+
+    def test_get(self, app):
+        """
+        test the analytics of the routes of the test user
+        """
+        from routetracker.instrumentation import query_budget
+
+        resp = app.get("/api/users/5/analytics/")
+        assert resp.status_code == 404
+
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "routes")
+        _check_control_get_method("self", app, body)
+        _check_control_get_method("profile", app, body)
+        _check_control_get_method("routes:routes-all", app, body)
+        # all routes of the test user are from today, graded 6a-6b
+        assert len(body["weeks"]) == 1
+        week = body["weeks"][0]
+        assert week["volume"] == 5
+        assert week["load"] == 161
+        assert week["intensity"] == 32.2
+        assert week["maxGrade"] == "6b"
+        assert week["acwr"] == 4.0
+        assert body["progression"] == [
+            {"discipline": "Bouldering", "maxGrade": ["6a+"]},
+            {"discipline": "Toprope", "maxGrade": ["6b"]},
+            {"discipline": "Lead", "maxGrade": ["6b"]}
+        ]
+
+        # linked from the user and the routes
+        body = json.loads(app.get("/api/users/1/").data)
+        _check_control_get_method("routes:training-load", app, body)
+        body = json.loads(app.get("/api/users/1/routes/").data)
+        _check_control_get_method("routes:training-load", app, body)
+
+        # the result is cached until the routes change
+        with query_budget(1, "TrainingLoad.get"):
+            resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+
+        route = _route_template()
+        route["date"] = datetime.today().strftime("%Y-%m-%d")
+        route["grade"] = "7a"
+        resp = app.post("/api/users/1/routes/", json=route)
+        location = resp.headers["Location"]
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert body["weeks"][-1]["volume"] == 6
+        assert body["weeks"][-1]["maxGrade"] == "7a"
+
+        app.delete(location)
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert body["weeks"][-1]["volume"] == 5
+        assert body["weeks"][-1]["maxGrade"] == "6b"
+
+        # a user without routes
+        resp = app.post("/api/users/", json=_user_template(3))
+        body = json.loads(app.get(resp.headers["Location"] + "analytics/").data)
+        assert body["weeks"] == []
+        assert body["progression"] == []
+
+    def test_training_load(self):
+        """
+        test the computation with routes over several weeks
+        """
+        import numpy as np
+        from routetracker.analytics import grade_rank, rank_name, training_load
+
+        assert grade_rank("6a") == 31
+        assert grade_rank("6A+") == 32
+        assert grade_rank("V4") == grade_rank("6b")
+        assert grade_rank("5") == grade_rank("5a")
+        assert grade_rank("5.12a") is None
+        assert rank_name(grade_rank("8c+")) == "8c+"
+
+        # Monday 2024-01-01 and the weeks after it, the last week is empty
+        days = np.array(["2024-01-01", "2024-01-03", "2024-01-10", "2024-01-24", "2024-02-01"], dtype="datetime64[D]")
+        days = days.astype(np.int64)
+        ranks = np.array([31, np.nan, 37, 33, 35], dtype=np.float64)
+        disciplines = np.array([1, 1, 2, 1, 2])
+        counts = np.array([2, 1, 1, 1, 1])
+        result = training_load(days, ranks, disciplines, counts)
+
+        weeks = result["weeks"]
+        assert [week["week"] for week in weeks] == [
+            "2024-01-01", "2024-01-08", "2024-01-15", "2024-01-22", "2024-01-29"
+        ]
+        assert [week["volume"] for week in weeks] == [3, 1, 0, 1, 1]
+        assert [week["load"] for week in weeks] == [62, 37, 0, 33, 35]
+        assert [week["intensity"] for week in weeks] == [31, 37, None, 33, 35]
+        assert [week["maxGrade"] for week in weeks] == ["6a", "7a", None, "6b", "6c"]
+        # acute load over the chronic weekly average of the last four weeks
+        assert weeks[0]["acwr"] == 4.0
+        assert weeks[1]["acwr"] == round(37 / (99 / 4.0), 3)
+        assert weeks[2]["acwr"] == 0.0
+        assert weeks[3]["acwr"] == round(33 / (132 / 4.0), 3)
+        assert weeks[4]["acwr"] == round(35 / (105 / 4.0), 3)
+        assert result["progression"] == {
+            1: ["6a", "6a", "6a", "6b", "6b"],
+            2: [None, "7a", "7a", "7a", "7a"]
+        }
+
+
+class TestRouteStream(object):
+    """
+    Test the Server-Sent Events stream of route changes
+    """
+
+    RESOURCE_URL = "/api/users/1/events/"
+
+    def test_get(self, app):
+        """
+        test that the writes of the user are pushed to the subscribers
+        """
+        broker = app.application.extensions["routetracker_streams"]
+        resp = app.get("/api/users/saddsa/events/")
+        assert resp.status_code == 404
+
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        stream = iter(resp.response)
+        assert next(stream) == b": subscribed\n\n"
+        assert broker.subscribers(1) == 1
+
+        app.post("/api/users/1/routes/", json=_route_template())
+        app.put("/api/users/1/routes/2/", json=_route_template())
+        app.delete("/api/users/1/routes/3/")
+        # writes of other users are not seen
+        app.delete("/api/users/2/routes/7/")
+
+        events = [next(stream).decode("utf-8") for i in range(3)]
+        assert [event.split("\n")[1] for event in events] == ["event: route"] * 3
+        data = [json.loads(event.split("\n")[2][len("data: "):]) for event in events]
+        assert [(item["op"], item["route"]) for item in data] == [("create", 11), ("update", 2), ("delete", 3)]
+        # the event ids are the change sequence values of the writes
+        assert events[2].startswith("id: {}\n".format(data[2]["seq"]))
+        assert data[0]["seq"] < data[1]["seq"] < data[2]["seq"]
+
+        # the client going away ends the subscription
+        resp.close()
+        assert broker.subscribers(1) == 0
+
+    def test_unread(self, app):
+        """
+        test that a stream closed before its body is read unsubscribes
+        """
+        flask_app = app.application
+        broker = flask_app.extensions["routetracker_streams"]
+        # the test client starts the body, the view is called directly here
+        with flask_app.test_request_context(self.RESOURCE_URL):
+            resp = flask_app.make_response(flask_app.dispatch_request())
+        assert broker.subscribers(1) == 1
+        resp.close()
+        assert broker.subscribers(1) == 0
+
+    def test_heartbeat(self, app):
+        """
+        test that idle streams get keepalive comments and reconnects a resync
+        """
+        app.application.config["SSE_HEARTBEAT"] = 0.01
+        resp = app.get(self.RESOURCE_URL, headers={"Last-Event-ID": "12"})
+        stream = iter(resp.response)
+        assert next(stream).decode("utf-8").startswith("event: resync\n")
+        assert next(stream) == b": keepalive\n\n"
+        resp.close()
+
+    def test_backpressure(self, app):
+        """
+        test that the events of a slow subscriber are coalesced
+        """
+        from routetracker.streams import Broker
+
+        broker = Broker(queue_size=2)
+        slow = broker.subscribe(1)
+        other = broker.subscribe(2)
+        for seq in range(1, 5):
+            broker.publish(1, {"op": "update", "route": 1, "seq": seq})
+        assert slow.get(0) == ("resync", {"seq": 4})
+        assert slow.get(0) is None
+        assert other.get(0) is None
+
+        # a queue that is not full keeps the events
+        broker.publish(1, {"op": "delete", "route": 1, "seq": 5})
+        assert slow.get(0) == ("route", {"op": "delete", "route": 1, "seq": 5})
+        broker.unsubscribe(slow)
+        assert broker.subscribers(1) == 0
+
+
+class TestRouteItem(object):
+    """
+    Test the route item resource: GET, PUT, PATCH, DELETE
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/1/"
+    INVALID_USER_URL = "/api/users/saddsa/routes/1/"
+    INVALID_ROUTE_URL = "/api/users/1/routes/122213/"
+
+    def test_get(self, app):
+        """
+        test get method to return the information of first route of first user
+        """
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "routes")
+        # check content
+        assert body["date"] == datetime.today().strftime('%Y-%m-%d')
+        assert body["location"] == "Oulun Kiipeilykeskus"
+        assert body["discipline"] == "Bouldering"
+        assert body["grade"] == "6A"
+        _check_control_get_method("self", app, body)
+        _check_control_get_method("profile", app, body)
+        _check_control_get_method("routes:routes-all", app, body)
+        _check_control_get_method("users:climbed-by", app, body)
+        _check_control_get_method("locations:in-location", app, body)
+        _check_control_get_method("disciplines:in-discipline", app, body)
+        _check_control_get_method("grades:in-grade", app, body)
+        _check_control_put_method("routes:edit-route", app, body, "routes")
+        _check_control_patch_method("routes:patch-route", app, body)
+        _check_control_delete_method("routes:delete", app, body)
+
+        # and see also that we get 404 if we try to access invalid user
+        resp = app.get(self.INVALID_USER_URL)
+        assert resp.status_code == 404
+        # and same for invalid route
+        resp = app.get(self.INVALID_ROUTE_URL)
+        assert resp.status_code == 404
+
+    def test_put_valid_request(self, app):
+        """
+        Tests put method to edit information of a route
+        """
+        valid = _route_template()
+
+        # wrong Content
+        resp = app.put(self.RESOURCE_URL, data=json.dumps(valid))
+        assert resp.status_code == 415
+
+        # for user not found
+        resp = app.put(self.INVALID_USER_URL, json=valid)
+        assert resp.status_code == 404
+
+        # for route not found
+        resp = app.put(self.INVALID_ROUTE_URL, json=valid)
+        assert resp.status_code == 404
+
+        # change only location
+        valid["location"] = "moon"
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+
+        # try wrong date information
+        valid["date"] = "yesterday"
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+
+        # location, discipline, or grade can not be empty string
+        valid = _route_template()
+        valid["location"] = ""
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+        valid = _route_template()
+        valid["discipline"] = ""
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+        valid = _route_template()
+        valid["grade"] = ""
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+
+        # should be accepted without extraInfo
+        valid = _route_template()
+        valid.pop("extraInfo")
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+
+        # remove email to see that it is not accepted
+        valid = _route_template()
+        valid.pop("date")
+        resp = app.put(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+
+    def test_patch(self, app):
+        """
+        Tests patch method to edit some of the information of a route
+        """
+        from routetracker.instrumentation import recorded_queries
+
+        # wrong Content
+        resp = app.patch(self.RESOURCE_URL, data=json.dumps({"grade": "7A"}))
+        assert resp.status_code == 415
+        resp = app.patch(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+
+        # for user or route not found
+        resp = app.patch(self.INVALID_USER_URL, json={})
+        assert resp.status_code == 404
+        resp = app.patch(self.INVALID_ROUTE_URL, json={})
+        assert resp.status_code == 404
+
+        # required fields can not be removed or emptied
+        resp = app.patch(self.RESOURCE_URL, json={"grade": None})
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL, json={"location": ""})
+        assert resp.status_code == 400
+        resp = app.patch(self.RESOURCE_URL, json={"date": "yesterday"})
+        assert resp.status_code == 400
+
+        # change the grade and the date and remove the extra information
+        resp = app.patch(
+                    self.RESOURCE_URL,
+                    data=json.dumps({"grade": "7A", "date": "2020-01-02", "extraInfo": None}),
+                    content_type="application/merge-patch+json"
+                    )
+        assert resp.status_code == 204
+        body = json.loads(app.get(self.RESOURCE_URL).data)
+        assert body["date"] == "2020-01-02"
+        assert body["location"] == "Oulun Kiipeilykeskus"
+        assert body["discipline"] == "Bouldering"
+        assert body["grade"] == "7A"
+        assert body["extraInfo"] is None
+
+        # only the changed column is updated
+        with recorded_queries("RouteItem.patch") as recorder:
+            resp = app.patch(self.RESOURCE_URL, json={"extraInfo": "slab"})
+        assert resp.status_code == 204
+        updates = [statement for statement in recorder.statements if statement.startswith("UPDATE route")]
+        assert len(updates) == 1
+        assert "extraInfo" in updates[0]
+        assert "date" not in updates[0]
+
+        # patch without changes is not written
+        with recorded_queries("RouteItem.patch") as recorder:
+            resp = app.patch(self.RESOURCE_URL, json={"grade": "7A", "extraInfo": "slab"})
+        assert resp.status_code == 204
+        assert not any(statement.startswith("UPDATE") for statement in recorder.statements)
+
+    def test_delete(self, app):
+        """
+        test delete method
+        """
+        # delete user
+        resp = app.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        # cannot delete it second time
+        resp = app.delete(self.RESOURCE_URL)
+        assert resp.status_code == 404
+        # cannot delete route for user that does not exist
+        resp = app.delete(self.INVALID_USER_URL)
+        assert resp.status_code == 404
+        # cannot delete route that does not exist
+        resp = app.delete(self.INVALID_ROUTE_URL)
+        assert resp.status_code == 404
+
+
+class TestLocationCollection(object):
+    """
+    Test the location collection resource: GET
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/locations/"
+    INVALID_URL = "/api/users/saddsa/routes/locations/"
+
+    def test_get(self, app):
+        """
+        test get method to return the locations lists for user
+        """
+        # for user not found
+        resp = app.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+        # test the list
+        resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(app, body, "locations")
+        _check_control_get_method("self", app, body)
+        _check_control_get_method("users:climbed-by", app, body)
+        _check_control_get_method("routes:routes-all", app, body)
+        assert len(body["items"]) == 4  # number of UNIQUE locations created above
+        for item in body["items"]:
+            assert "location" in item
+            _check_control_get_method("self", app, item)
+            _check_control_get_method("locations:in-location", app, item)
+            _check_control_get_method("profile", app, item)
+
+
+class TestLocationItem(object):
     """
     Test the location item resource: GET
     """
@@ -845,3 +2424,510 @@ class TestGradeItem(object):
         # and same for invalid location
         resp = app.get(self.INVALID_GRADE_URL)
         assert resp.status_code == 404
+
+
+class TestContentNegotiation(object):
+    """
+    Test the msgpack encoding of responses and request bodies
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+
+    def test_get_msgpack(self, app):
+        """
+        test that the same document is returned in msgpack when asked for
+        """
+        msgpack = pytest.importorskip("msgpack")
+        resp = app.get(self.RESOURCE_URL)
+        expected = json.loads(resp.data)
+
+        for mimetype in ["application/msgpack", "application/vnd.mason+msgpack"]:
+            resp = app.get(self.RESOURCE_URL, headers={"Accept": mimetype})
+            assert resp.status_code == 200
+            assert resp.mimetype == mimetype
+            assert msgpack.unpackb(resp.data, raw=False) == expected
+
+        # errors are encoded as well
+        resp = app.get("/api/users/saddsa/", headers={"Accept": "application/msgpack"})
+        assert resp.status_code == 404
+        assert "@error" in msgpack.unpackb(resp.data, raw=False)
+
+        # JSON is still the default
+        resp = app.get(self.RESOURCE_URL, headers={"Accept": "*/*"})
+        assert resp.mimetype == "application/vnd.mason+json"
+
+    def test_post_msgpack(self, app):
+        """
+        test that routes can be created with msgpack request bodies
+        """
+        msgpack = pytest.importorskip("msgpack")
+        resp = app.post(
+                    self.RESOURCE_URL,
+                    data=msgpack.packb(_route_template()),
+                    content_type="application/msgpack"
+                    )
+        assert resp.status_code == 201
+
+        resp = app.get(resp.headers["Location"])
+        body = json.loads(resp.data)
+        assert body["location"] == "Olympics"
+
+        # broken bodies are rejected
+        resp = app.post(self.RESOURCE_URL, data=b"\xc1", content_type="application/msgpack")
+        assert resp.status_code == 400
+
+
+class TestCompression(object):
+    """
+    Test compression of API responses and the precompressed static assets
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+
+    def test_compressed_response(self, app):
+        """
+        test that large enough responses are compressed when accepted
+        """
+        plain = app.get(self.RESOURCE_URL)
+        assert "Content-Encoding" not in plain.headers
+
+        resp = app.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in resp.headers["Vary"]
+        assert gzip.decompress(resp.data) == plain.data
+
+        # responses under the threshold are sent as they are
+        app.application.config["COMPRESS_MIN_SIZE"] = len(plain.data) + 1
+        resp = app.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+
+    def test_assets(self, app):
+        """
+        test that the client page links to fingerprinted, cacheable assets
+        """
+        resp = app.get("/login/", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Cache-Control"] == "no-cache"
+        page = gzip.decompress(resp.data).decode("utf-8")
+        assert '"/static/scripts/jquery.js"' not in page
+        start = page.index("/assets/scripts/jquery.")
+        href = page[start:page.index('"', start)]
+
+        # compressed on the first request only
+        assets = app.application.extensions["routetracker_assets"]
+        fingerprinted = href[len("/assets/"):]
+        assert "gzip" not in assets.files[fingerprinted]
+        resp = app.get(href, headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert "immutable" in resp.headers["Cache-Control"]
+        with open(os.path.join(os.path.dirname(__file__), "..", "routetracker", "static", "scripts", "jquery.js"), "rb") as handle:
+            assert gzip.decompress(resp.data) == handle.read()
+        assert assets.files[fingerprinted]["gzip"] == resp.data
+        assert "Content-Encoding" not in app.get(href).headers
+
+        resp = app.get("/assets/scripts/jquery.0000.js")
+        assert resp.status_code == 404
+
+
+class TestServerTiming(object):
+    """
+    Test the opt-in Server-Timing instrumentation
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+
+    def test_server_timing(self, app):
+        """
+        test that phases are reported only when enabled and collected to
+        the endpoint histograms
+        """
+        from routetracker.instrumentation import get_histogram, get_histograms, reset_histograms
+
+        resp = app.get(self.RESOURCE_URL)
+        assert "Server-Timing" not in resp.headers
+
+        reset_histograms()
+        app.application.config["SERVER_TIMING"] = True
+        for i in range(3):
+            resp = app.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        timing = resp.headers["Server-Timing"]
+        for phase in ["sql", "build", "encode", "total"]:
+            assert phase + ";dur=" in timing
+        assert "queries" in timing
+
+        histogram = get_histogram("api.routecollection", "GET", "total")
+        assert histogram.count == 3
+        assert histogram.quantile(0.5) > 0
+        histograms = get_histograms("api.routecollection")
+        assert ("api.routecollection", "GET", "sql") in histograms
+        assert get_histograms("api.useritem") == {}
+
+
+def _add_routes(client, count, user=1):
+    """
+    add routes for user, each with a new location, discipline and grade
+    """
+    with client.application.app_context():
+        db_user = User.query.filter_by(id=user).first()
+        for i in range(count):
+            db.session.add(Route(
+                            user=db_user,
+                            date=datetime.today(),
+                            location=Location(name="budget location {}".format(i)),
+                            discipline=Discipline(name="budget discipline {}".format(i)),
+                            grade=Grade(name="bg {}".format(i))
+                            ))
+        db.session.commit()
+
+
+class TestQueryBudgets(object):
+    """
+    Test that the number of queries of the GET handlers does not grow with
+    the number of routes
+    """
+
+    BUDGETS = [
+        ("/api/users/", "UserCollection.get", 1),
+        ("/api/users/1/", "UserItem.get", 1),
+        ("/api/users/1/routes/", "RouteCollection.get", 1),
+        ("/api/users/1/routes/?embed=locations,disciplines,grades", "RouteCollection.get", 1),
+        ("/api/users/1/?embed=routes,locations,disciplines,grades", "UserItem.get", 2),
+        ("/api/users/1/routes/1/", "RouteItem.get", 1),
+        ("/api/users/1/routes/locations/", "LocationCollection.get", 2),
+        ("/api/users/1/routes/locations/1/", "LocationItem.get", 1),
+        ("/api/users/1/routes/disciplines/", "DisciplineCollection.get", 2),
+        ("/api/users/1/routes/disciplines/1/", "DisciplineItem.get", 1),
+        ("/api/users/1/routes/grades/", "GradeCollection.get", 2),
+        ("/api/users/1/routes/grades/1/", "GradeItem.get", 1),
+    ]
+
+    def test_budgets(self, app):
+        """
+        test the query budgets with a growing number of routes
+        """
+        from routetracker.instrumentation import query_budget
+
+        for count in [0, 20]:
+            _add_routes(app, count)
+            for url, resource, budget in self.BUDGETS:
+                with query_budget(budget, resource) as used:
+                    resp = app.get(url)
+                assert resp.status_code == 200
+                assert len(used.statements) > 0
+
+    def test_item_writes(self, app):
+        """
+        test that the route item checks the owner in the same statement
+        """
+        from routetracker.instrumentation import query_budget
+
+        # the delete, the change sequence (update and select) and the tombstone
+        with query_budget(4, "RouteItem.delete"):
+            resp = app.delete("/api/users/1/routes/1/")
+        assert resp.status_code == 204
+        # the user is looked up only to tell which one was not found
+        with query_budget(2, "RouteItem.delete"):
+            resp = app.delete("/api/users/1/routes/1/")
+        assert resp.status_code == 404
+        # route of another user is not found
+        resp = app.delete("/api/users/1/routes/6/")
+        assert resp.status_code == 404
+
+        # ownership check, the three lookups, the change sequence (update and
+        # select) and the update
+        valid = _route_template()
+        valid["location"] = "Magic Woods"
+        valid["discipline"] = "Lead"
+        valid["grade"] = "6B"
+        with query_budget(7, "RouteItem.put"):
+            resp = app.put("/api/users/1/routes/2/", json=valid)
+        assert resp.status_code == 204
+
+    def test_budget_exceeded(self, app):
+        """
+        test that exceeding the budget fails
+        """
+        from routetracker.instrumentation import query_budget, QueryBudgetExceeded
+
+        with pytest.raises(QueryBudgetExceeded):
+            with query_budget(0):
+                app.get("/api/users/1/routes/")
+
+    def test_query_stats(self, app):
+        """
+        test that statements and rows are attributed to the resource method
+        """
+        from routetracker.instrumentation import get_query_stats, reset_query_stats
+
+        reset_query_stats()
+        app.get("/api/users/1/routes/")
+        app.get("/api/users/1/routes/")
+        stats = get_query_stats("RouteCollection.get")["RouteCollection.get"]
+        assert stats["requests"] == 2
+        assert stats["statements"] == 2
+        # the user and the five routes with their related rows
+        assert stats["rows"] >= 12
+        assert stats["time"] > 0
+        assert get_query_stats("UserCollection.get") == {}
+
+
+class TestMetrics(object):
+    """
+    Test the /metrics endpoint and the metric primitives
+    """
+
+    def test_get(self, app):
+        """
+        test that requests and queries show up in the metrics
+        """
+        app.get("/api/users/1/routes/")
+        resp = app.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.data.decode("utf-8")
+        assert "# TYPE routetracker_requests_total counter" in text
+        assert 'routetracker_requests_total{resource="RouteCollection.get",status="200"}' in text
+        assert 'routetracker_request_duration_seconds_bucket{resource="RouteCollection.get",le="+Inf"}' in text
+        assert 'routetracker_response_size_bytes_count{resource="RouteCollection.get"}' in text
+        assert 'routetracker_db_queries_total{resource="RouteCollection.get"}' in text
+        assert "routetracker_db_query_duration_seconds_sum" in text
+        assert "# TYPE routetracker_cache_requests_total counter" in text
+
+    def test_connections(self):
+        """
+        test that opening connections and the time they are held are
+        recorded, and that an app without metrics records nothing
+        """
+        import time
+        from routetracker.instrumentation import DB_CONNECTION_HOLD, DB_CONNECTION_OPEN, DB_QUERIES
+
+        db_fd, db_fname = tempfile.mkstemp()
+        flask_app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": 1, "max_overflow": 0},
+            "TESTING": True
+        })
+        with flask_app.app_context():
+            engine = db.engine
+        # the connections opened by create_app are closed
+        engine.dispose()
+        opened = DB_CONNECTION_OPEN.labels().snapshot()
+        held = DB_CONNECTION_HOLD.labels().snapshot()
+
+        connection = engine.connect()
+        time.sleep(0.2)
+        connection.close()
+        # the pooled connection is not opened again
+        engine.connect().close()
+        engine.dispose()
+        engine.connect().close()
+
+        assert DB_CONNECTION_OPEN.labels().snapshot()["count"] == opened["count"] + 2
+        after = DB_CONNECTION_HOLD.labels().snapshot()
+        assert after["count"] == held["count"] + 3
+        assert after["sum"] - held["sum"] >= 0.2
+        engine.dispose()
+
+        # the metrics of another app do not turn them on for this one
+        quiet = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "METRICS": False,
+            "TESTING": True
+        })
+        queries = DB_QUERIES.labels("background").value
+        with quiet.app_context():
+            db.create_all()
+            db.engine.dispose()
+        assert DB_QUERIES.labels("background").value == queries
+        for each in (flask_app, quiet):
+            each.extensions["routetracker_jobs"].shutdown()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    def test_threads(self, app):
+        """
+        test that concurrent updates are not lost
+        """
+        import threading
+        from routetracker import metrics
+
+        family = metrics.MetricFamily("test_total", "test", "counter", ["thread"])
+        hist = metrics.Histogram(buckets=(1, 2))
+
+        def work():
+            for i in range(1000):
+                family.labels("all").inc()
+                hist.observe(1.5)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert family.labels("all").value == 8000
+        assert hist.snapshot()["counts"] == [0, 8000, 0]
+        assert 'test_total{thread="all"} 8000' in family.render()
+
+
+class TestProfiling(object):
+    """
+    Test capturing profiles of single requests
+    """
+
+    RESOURCE_URL = "/api/users/1/routes/"
+
+    def test_profile_request(self, app, tmpdir):
+        """
+        test that only requests with a valid signature are profiled
+        """
+        import pstats
+        from routetracker.profiling import PROFILE_HEADER, list_profiles, sign_path, write_callgrind
+
+        flask_app = app.application
+        flask_app.config["PROFILE_DIR"] = str(tmpdir)
+        expires = time.time() + 60
+        token = sign_path(self.RESOURCE_URL, "secret", expires)
+
+        # disabled by default, and never with the default key
+        resp = app.get(self.RESOURCE_URL, headers={PROFILE_HEADER: token})
+        assert "X-Profile-Id" not in resp.headers
+        flask_app.config["PROFILE_REQUESTS"] = True
+        resp = app.get(self.RESOURCE_URL, headers={PROFILE_HEADER: sign_path(self.RESOURCE_URL, "dev", expires)})
+        assert "X-Profile-Id" not in resp.headers
+        with pytest.raises(ValueError):
+            create_app({
+                "SQLALCHEMY_DATABASE_URI": flask_app.config["SQLALCHEMY_DATABASE_URI"],
+                "TESTING": True,
+                "PROFILE_REQUESTS": True
+            })
+
+        flask_app.config["SECRET_KEY"] = "secret"
+        resp = app.get(self.RESOURCE_URL, headers={PROFILE_HEADER: "forged"})
+        assert "X-Profile-Id" not in resp.headers
+        resp = app.get("/api/users/1/", headers={PROFILE_HEADER: token})
+        assert "X-Profile-Id" not in resp.headers
+        # the expiry is signed too
+        resp = app.get(self.RESOURCE_URL, headers={PROFILE_HEADER: str(int(expires) + 60) + token[token.index("."):]})
+        assert "X-Profile-Id" not in resp.headers
+        expired = sign_path(self.RESOURCE_URL, "secret", time.time() - 1)
+        resp = app.get(self.RESOURCE_URL, headers={PROFILE_HEADER: expired})
+        assert "X-Profile-Id" not in resp.headers
+        assert list_profiles(flask_app) == []
+
+        resp = app.get(self.RESOURCE_URL + "?embed=grades", headers={PROFILE_HEADER: token})
+        assert resp.status_code == 200
+        profiles = list_profiles(flask_app)
+        assert len(profiles) == 1
+        assert profiles[0]["name"] == resp.headers["X-Profile-Id"]
+        assert profiles[0]["endpoint"] == "api.routecollection"
+        assert profiles[0]["view_args"] == {"user": "1"}
+        assert profiles[0]["args"] == {"embed": ["grades"]}
+        assert pstats.Stats(profiles[0]["stats"]).total_calls > 0
+
+        callgrind = tmpdir.join("callgrind.out")
+        with open(str(callgrind), "w") as handle:
+            write_callgrind(profiles[0]["stats"], handle)
+        assert callgrind.read().startswith("events: Microseconds")
+        assert "calls=" in callgrind.read()
+
+
+class TestSamplingProfiler(object):
+    """
+    Test the background sampling profiler
+    """
+
+    def test_sample(self, tmpdir):
+        """
+        test sampling, flushing and exporting the stacks of a request thread
+        """
+        import io
+        from routetracker.profiling import SamplingProfiler, load_samples, write_collapsed
+
+        profiler = SamplingProfiler(directory=str(tmpdir))
+        profiler.enter("RouteCollection.get")
+        profiler.sample()
+        profiler.sample()
+        profiler.leave()
+        profiler.sample()
+        profiler.flush()
+
+        samples = load_samples(str(tmpdir))
+        assert list(samples) == ["RouteCollection.get"]
+        stacks = samples["RouteCollection.get"]
+        assert sum(stacks.values()) == 2
+        stack = list(stacks)[0]
+        assert stack.endswith("sample (routetracker/profiling.py)")
+        assert "test_sample (" in stack
+
+        out = io.StringIO()
+        write_collapsed(stacks, out)
+        assert out.getvalue() == "{} 2\n".format(stack)
+
+    def test_app(self, tmpdir):
+        """
+        test that the profiler runs when configured and samples requests
+        """
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": True,
+            "SAMPLING_PROFILER": True,
+            "SAMPLING_INTERVAL": 0.001,
+            "SAMPLING_DIR": str(tmpdir)
+            })
+        with app.app_context():
+            db.create_all()
+            _populate_db()
+        profiler = app.extensions["routetracker_sampler"]
+        client = app.test_client()
+        deadline = time.time() + 5
+        while not profiler.samples and time.time() < deadline:
+            client.get("/api/users/1/routes/")
+        profiler.stop()
+        assert "RouteCollection.get" in profiler.samples
+        assert profiler.active == {}
+
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+class TestQueryPlans(object):
+    """
+    Test the slow query log and the query plan check
+    """
+
+    def test_slow_query_log(self, app, caplog):
+        """
+        test that queries over the threshold are logged with their plan
+        """
+        import logging
+
+        app.get("/api/users/1/routes/")
+        assert "slow query" not in caplog.text
+
+        app.application.config["SLOW_QUERY_THRESHOLD"] = 0
+        with caplog.at_level(logging.WARNING, logger="routetracker.slow_queries"):
+            app.get("/api/users/1/routes/")
+        assert "slow query" in caplog.text
+        assert "in RouteCollection.get" in caplog.text
+        assert "parameters: " in caplog.text
+        assert "SEARCH route USING INDEX" in caplog.text
+
+    def test_no_full_scans(self, app):
+        """
+        test that no resource scans the whole route table
+        """
+        from routetracker.query_plans import check_query_plans, is_full_scan
+
+        assert is_full_scan("SCAN route", "route")
+        assert is_full_scan("SCAN TABLE route", "route")
+        assert not is_full_scan("SCAN route USING INDEX ix_route_user_date", "route")
+        assert not is_full_scan("SEARCH route USING INTEGER PRIMARY KEY (rowid=?)", "route")
+
+        with app.application.app_context():
+            assert check_query_plans(app.application) == []
+            # the user collection is a full scan of the user table by design
+            assert len(check_query_plans(app.application, "user")) > 0